@@ -20,6 +20,9 @@
 ####################################################################################################
 ####################################################################################################
 import LAMDA_Lib as ll
+import LAMDA_scheduler as ls
+import LAMDA_instrumentation as li
+import os, time
 
 
 ee = ll.ee
@@ -91,6 +94,17 @@ dilatePixels = 2.5
 # How many periods to include in persistence
 persistence_n_periods = 3
 
+# GDAL cache (MB) each post processing job can use
+# (how many run at once is the size of the scheduler's cpu pool below)
+gdal_cache_mb = 512
+
+# Compression of local outputs (see output_profiles in raster_processing_lib)
+# The default is plain DEFLATE with a single compression thread per writer
+# e.g. a predictor or ZSTD for raw outputs, or LERC with a max error (in raw units) for smaller uploads
+# ll.rpl.set_output_profile("raw", predictor=2)
+# ll.rpl.set_output_profile("raw", compress="ZSTD", predictor=2)
+# ll.rpl.set_output_profile("raw", compress="LERC_ZSTD", max_z_error=0.5)
+
 # If available, bring in preComputed cloudScore offsets and TDOM stats
 # Set to null if computing on-the-fly is wanted
 # These have been pre-computed for all CONUS, AK, and HI for MODIS. If outside these areas, set to None below
@@ -159,6 +173,35 @@ local_output_dir = r"Q:\LAMDA_workspace\Outputs_Scratch"  # r'Q:\RTFD_gee_method
 # May need a full path to the location if it's not in the PATH
 gsutil_path = "gsutil.cmd"
 
+# Number of concurrent downloads/uploads to and from GCS
+transfer_n_workers = 8
+
+# Whether to run gsutil for transfers instead of transferring in-process (requires the google-cloud-storage package)
+use_gsutil = False
+
+# Whether to compare what the run should make with a snapshot of the export bucket, local folder, deliverable bucket,
+# and ingested assets and only run what's missing
+plan = True
+
+# Whether to only print the plan for each area without running anything
+dry_run = False
+
+# Areas to run
+# All areas share the scheduler pools below, and areas listed first get their jobs run first
+export_area_names = ["CONUS", "AK"]
+
+# Number of jobs that can run at once across all areas
+# cpu: post processing and persistence (GDAL), network: transfers, gee: starting exports and ingesting,
+# wait: waiting on exports (one per area so every area's exports are waited on at once)
+scheduler_pool_sizes = {"cpu": 4, "network": 2, "gee": 2, "wait": len(export_area_names)}
+
+# How often (seconds) the GEE task list is checked for finished exports (once for all areas)
+export_poll_seconds = 30
+
+# JSON lines file to record the time, bytes, pixels, and memory of each stage to (None to turn off)
+# A summary table by stage is printed at the end of the run
+instrumentation_jsonl = os.path.join(local_output_dir, "LAMDA_instrumentation.jsonl")
+
 # Regex to filter outputs
 output_filter_strings = ["*CONUS_LAMDA*", "*AK_LAMDA*"]
 
@@ -272,62 +315,76 @@ tree_mask = ee.Image.cat([lcmsTreeMask, tcc, hansen]).reduce(ee.Reducer.max()).s
 # print(tracking_filenames_tifs)
 # sync_rtfd_outputs(exportBucket,local_output_dir,tracking_filenames_tifs)
 if __name__ == "__main__":
+    run_start = time.time()
+    if instrumentation_jsonl != None:
+        li.enable(instrumentation_jsonl)
+    scheduler = ls.Scheduler(scheduler_pool_sizes)
+    export_watcher = ls.ExportWatcher(ll.get_export_states, export_poll_seconds)
 
-    for exportAreaName in ["CONUS", "AK"]:
+    for priority, exportAreaName in enumerate(export_area_names):
         crs = crs_dict[exportAreaName]
         transform = transform_dict[exportAreaName]
         nDays = nDaysDict[exportAreaName]
         exportArea = export_area_dict[exportAreaName]
-        p = ll.Process(
-            target=ll.operational_lamda,
-            args=(
-                initialStartJulian,
-                frequency,
-                nDays,
-                zBaselineLength,
-                tddEpochLength,
-                baselineGap,
-                indexNames,
-                zThresh,
-                slopeThresh,
-                zReducer,
-                tddAnnualReducer,
-                zenithThresh,
-                addLookAngleBands,
-                applyCloudScore,
-                applyTDOM,
-                cloudScoreThresh,
-                performCloudScoreOffset,
-                cloudScorePctl,
-                zScoreThresh,
-                shadowSumThresh,
-                contractPixels,
-                dilatePixels,
-                resampleMethod,
-                preComputedCloudScoreOffset,
-                preComputedTDOMIRMean,
-                preComputedTDOMIRStdDev,
-                tree_mask,
-                crs,
-                transform,
-                scale,
-                exportBucket,
-                exportAreaName,
-                exportArea,
-                exportRawZ,
-                exportRawSlope,
-                local_output_dir,
-                gsutil_path,
-                crs_dict,
-                post_process_dict,
-                persistence_n_periods,
-                deliverable_output_bucket,
-            ),
+        ll.schedule_operational_lamda(
+            scheduler,
+            initialStartJulian,
+            frequency,
+            nDays,
+            zBaselineLength,
+            tddEpochLength,
+            baselineGap,
+            indexNames,
+            zThresh,
+            slopeThresh,
+            zReducer,
+            tddAnnualReducer,
+            zenithThresh,
+            addLookAngleBands,
+            applyCloudScore,
+            applyTDOM,
+            cloudScoreThresh,
+            performCloudScoreOffset,
+            cloudScorePctl,
+            zScoreThresh,
+            shadowSumThresh,
+            contractPixels,
+            dilatePixels,
+            resampleMethod,
+            preComputedCloudScoreOffset,
+            preComputedTDOMIRMean,
+            preComputedTDOMIRStdDev,
+            tree_mask,
+            crs,
+            transform,
+            scale,
+            exportBucket,
+            exportAreaName,
+            exportArea,
+            exportRawZ,
+            exportRawSlope,
+            local_output_dir,
+            gsutil_path,
+            crs_dict,
+            post_process_dict,
+            persistence_n_periods,
+            deliverable_output_bucket,
+            gdal_cache_mb=gdal_cache_mb,
+            transfer_n_workers=transfer_n_workers,
+            use_gsutil=use_gsutil,
+            plan=plan,
+            dry_run=dry_run,
+            priority=priority,
+            export_watcher=export_watcher,
         )
-        p.start()
-    ll.limitProcesses(1)
 
-    register_cogs
+    # Wait on every job from every area
+    scheduler.wait()
+    scheduler.report()
+    if li.is_enabled():
+        li.print_summary(since=run_start)
+    export_watcher.close()
+    scheduler.close()
 
 # calc_persistence_wrapper(local_output_dir,exportAreaName,indexNames,time.localtime()[0], post_process_dict)
 # After exports are done, pull them down locally
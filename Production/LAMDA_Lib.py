@@ -18,7 +18,7 @@
 # This method is a pixel-wise adaptation of the original RTFD (Real Time Forest Disturbance) algorithms
 # Intended to work within the geeViz package
 ####################################################################################################
-import json, time, glob, ee, os, subprocess, multiprocessing
+import json, time, glob, ee, os, subprocess, multiprocessing, concurrent.futures, math, functools, inspect
 from google.cloud import storage
 from multiprocessing import Process
 
@@ -39,6 +39,9 @@ ee.Initialize(project="gtac-lamda")
 import geeViz.changeDetectionLib as gv
 import geeViz.taskManagerLib as tml
 import LAMDA_register_cogs as rc
+import LAMDA_state_store as sl
+import LAMDA_products as lp
+import LAMDA_transfer_lib as tl
 
 
 # import geeViz.cloudStorageManagerLib as csl
@@ -47,6 +50,10 @@ ee = gv.ee
 Map = gv.Map
 Map.clearMap()
 import raster_processing_lib as rpl
+import detection_history_lib as dh
+import LAMDA_instrumentation as li
+import LAMDA_plan as lplan
+import LAMDA_scheduler as ls
 
 # Set environment variable for GCS use
 # os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = key_file
@@ -144,7 +151,6 @@ def getZ(
         del args["args"]
     # print(args)
 
-    current_tasks = tml.getTasks()
     # Filter image dates
     images = images.filter(ee.Filter.calendarRange(startJulian, endJulian))
 
@@ -183,7 +189,8 @@ def getZ(
         forExport = analysisZ.multiply(1000).clamp(-32767, 32767).int16()  # .clamp(-10,10).add(10).multiply(10).byte()#.clamp(-32767,32767).int16()
         # Map.addLayer(forExport,{'min':0,'max':200,'palette':'F00,888,00F'},rawZOutputName)
         # if not csl.gcs_exists(exportBucket, rawZOutputName + ".tif") and rawZOutputName not in current_tasks["ready"] and rawZOutputName not in current_tasks["running"]:
-        gv.exportToCloudStorageWrapper(forExport, rawZOutputName, exportBucket, exportArea, scale, crs, transform, outputNoData=-32768, overwrite=False)
+        with li.span("export_submit", rawZOutputName):
+            gv.exportToCloudStorageWrapper(forExport, rawZOutputName, exportBucket, exportArea, scale, crs, transform, outputNoData=-32768, overwrite=False)
         # else:
         #     print(rawZOutputName, " already exists or is in queue to run")
     # Return raw z score and masked year image
@@ -220,8 +227,6 @@ def getTrend(
         del args["args"]
     # print(args)
 
-    current_tasks = tml.getTasks()
-
     # Filter image dates
     images = images.filter(ee.Filter.calendarRange(startJulian, endJulian))
 
@@ -256,7 +261,8 @@ def getTrend(
         forExport = slope.multiply(10000).clamp(-32767, 32767).int16()  # .clamp(-0.2,0.2).add(0.2).multiply(500).byte()#.multiply(100000).clamp(-32767,32767).int16()
         # Map.addLayer(forExport,{'min':0,'max':200,'palette':'F00,888,00F'},rawSlopeOutputName)
         # if not gcs_exists(exportBucket, rawSlopeOutputName + ".tif") and rawSlopeOutputName not in current_tasks["ready"] and rawSlopeOutputName not in current_tasks["running"]:
-        gv.exportToCloudStorageWrapper(forExport, rawSlopeOutputName, exportBucket, exportArea, scale, crs, transform, outputNoData=-32768, overwrite=False)
+        with li.span("export_submit", rawSlopeOutputName):
+            gv.exportToCloudStorageWrapper(forExport, rawSlopeOutputName, exportBucket, exportArea, scale, crs, transform, outputNoData=-32768, overwrite=False)
         # else:
         #     print(rawSlopeOutputName, " already exists or is in queue to run")
 
@@ -413,41 +419,84 @@ def lamda_wrapper(
 
 
 # Function to bring outputs from GCS to local folder
-def sync_outputs(gs_bucket, output_folder, output_filter_strings, gsutil_path="gsutil.cmd"):
+# Files are downloaded concurrently by n_workers threads
+# Only objects that are new or changed since they were downloaded are downloaded (see LAMDA_transfer_lib.sync_tracked)
+# Re-downloaded products have their processing stages cleared and their outputs removed so they are processed again
+# Synced raw tifs are recorded in the local state store as each one lands
+# on_complete is called with each transfer result so downstream work can start on it right away
+# Objects that have already been listed (e.g. from a LAMDA_plan snapshot) can be provided as listed_objs
+# Returns a summary of the number of files and bytes transferred and skipped
+# Set use_gsutil to True to fall back on running gsutil
+@li.traced("sync", product_arg="output_filter_strings")
+def sync_outputs(gs_bucket, output_folder, output_filter_strings, gsutil_path="gsutil.cmd", n_workers=8, on_complete=None, use_gsutil=False, listed_objs=None):
+    if use_gsutil:
+        return sync_outputs_gsutil(gs_bucket, output_folder, output_filter_strings, gsutil_path)
+
+    conn = sl.open_state_store(output_folder)
+    results = tl.sync_tracked(conn, tl.get_backend(gs_bucket, is_bucket=True), output_filter_strings, output_folder, n_workers, on_complete, listed_objs)
+
+    # Log any raw tifs that were already here but haven't been logged
+    for output_filter_string in output_filter_strings:
+        tifs = glob.glob(os.path.join(output_folder, output_filter_string))
+        tifs = [i for i in tifs if tl.is_raw_tif(i)]
+        tifs = [i for i in tifs if not sl.is_stage_done(conn, i, "synced")]
+        sl.mark_stages_done(conn, tifs, "synced", [sl.get_fingerprint(i) for i in tifs])
+    conn.close()
+    return tl.summarize_transfers(results)
+
+
+# Legacy version of sync_outputs that runs gsutil
+def sync_outputs_gsutil(gs_bucket, output_folder, output_filter_strings, gsutil_path="gsutil.cmd"):
 
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    call = None
-    # Track previous commands to speed things up
-    copy_done_file = os.path.join(output_folder, ".COPY_FINISHED")
-    if os.path.exists(copy_done_file):
-        o = open(copy_done_file, "r")
-        commands = o.read().split(",")
-        o.close()
-    else:
-        commands = []
+    calls = []
+    commands = []
 
     # Run each command provided
     for output_filter_string in output_filter_strings:
         sync_command = "{} -m cp -n -r gs://{}/{} {}".format(gsutil_path, gs_bucket, output_filter_string, output_folder)
 
         if sync_command not in commands:
-            call = subprocess.Popen(sync_command)
+            calls.append(subprocess.Popen(sync_command))
 
             commands.append(sync_command)
         else:
             print("Already ran:", sync_command)
-    if call != None:
+
+    # Wait on every command
+    for call in calls:
         while call.poll() == None:
             print("Still syncing")
             time.sleep(5)
-    # Log which commands have been run
-    # o = open(copy_done_file,'w')
-    # o.write(','.join(commands))
-    # o.close()
-
 
-def upload_outputs(exportAreaName, local_folder, gs_bucket, extension, gsutil_path="gsutil.cmd"):
+    # Log which files have been synced
+    conn = sl.open_state_store(output_folder)
+    for output_filter_string in output_filter_strings:
+        tifs = glob.glob(os.path.join(output_folder, output_filter_string))
+        tifs = [i for i in tifs if tl.is_raw_tif(i)]
+        tifs = [i for i in tifs if not sl.is_stage_done(conn, i, "synced")]
+        sl.mark_stages_done(conn, tifs, "synced", [sl.get_fingerprint(i) for i in tifs])
+    conn.close()
+
+
+# Upload local outputs to GCS
+# Uploads are tracked in the local state store (see LAMDA_transfer_lib.upload_tracked)
+# Use the extension tif.aux.xml for the stats sidecars of raw COGs that weren't rewritten (see raster_processing_lib.update_cog_header)
+@li.traced("upload", product_arg="extension")
+def upload_outputs(exportAreaName, local_folder, gs_bucket, extension, gsutil_path="gsutil.cmd", n_workers=8, on_complete=None, use_gsutil=False):
+    if use_gsutil:
+        return upload_outputs_gsutil(exportAreaName, local_folder, gs_bucket, extension, gsutil_path)
+
+    conn = sl.open_state_store(local_folder)
+    files = glob.glob(os.path.join(local_folder, "{}*.{}".format(exportAreaName, extension)))
+    results = tl.upload_tracked(conn, tl.get_backend(gs_bucket, is_bucket=True), files, n_workers, on_complete)
+    conn.close()
+    return results
+
+
+# Legacy version of upload_outputs that runs gsutil
+def upload_outputs_gsutil(exportAreaName, local_folder, gs_bucket, extension, gsutil_path="gsutil.cmd"):
     sync_command = "{} -m cp -n -r {}/{}*.{} gs://{}".format(gsutil_path, local_folder, exportAreaName, extension, gs_bucket)
     print(sync_command)
     call = subprocess.Popen(sync_command)
@@ -457,84 +506,228 @@ def upload_outputs(exportAreaName, local_folder, gs_bucket, extension, gsutil_pa
             print("Still syncing")
             time.sleep(5)
 
+    if call.returncode == 0:
+        conn = sl.open_state_store(local_folder)
+        files = glob.glob(os.path.join(local_folder, "{}*.{}".format(exportAreaName, extension)))
+        sl.mark_stages_done(conn, files, "uploaded", [sl.get_fingerprint(i) for i in files])
+        conn.close()
 
-###############################################################
-# Function to correct projection, set no data, update stats, and stretch to 8 bit
-def post_process_local_outputs(local_output_dir, exportAreaName, crs_dict, post_process_dict):
-
-    # Track files that are already finished
-    done_file = os.path.join(local_output_dir, ".{}_POST_PROCESS_DONE".format(exportAreaName))
-    if os.path.exists(done_file):
-        o = open(done_file)
-        done_files = o.read().split(",")
-        o.close()
-    else:
-        done_files = []
 
-    # Iterate across each key provided
+###############################################################
+# Get the post processing jobs (arguments of raster_processing_lib.post_process_tif) of the raw tifs that aren't done yet
+# Progress is tracked in the local state store (bringing in any progress from the legacy done file)
+def get_post_process_jobs(local_output_dir, exportAreaName, crs_dict, post_process_dict, products=None):
+    conn = sl.open_state_store(local_output_dir)
+    sl.import_done_file(conn, os.path.join(local_output_dir, ".{}_POST_PROCESS_DONE".format(exportAreaName)), "cog-fixed")
+
+    if products == None:
+        products = lp.build_product_index(lp.list_products(local_output_dir))
+    existing_8bit = set(p.name for p in lp.query_products(products, area=exportAreaName, kind="8bit"))
+
+    # Iterate across each key provided and set up the post processing for each raw tif
+    jobs = []
     for k in list(post_process_dict.keys()):
 
         # Filter out raw tifs for given key
-        tifs = glob.glob(os.path.join(local_output_dir, "{}*{}*.tif".format(exportAreaName, k)))
-        tifs = [i for i in tifs if i.find("8bit") == -1 and i.find("_persistence") == -1]
-
-        # Update projection, no data, and stats for each raw output
-        for tif in tifs:
-            if tif not in done_files:
+        raws = lp.query_products(products, area=exportAreaName, method=lp.get_method(k), kind="raw", cog=False, extension=".tif")
+
+        # Update projection, no data, and stats for each raw output that isn't done yet
+        # Stretch raw to 8 bit (skipped if the 8 bit output already exists)
+        for raw in raws:
+            tif = raw.path
+            update = not sl.is_stage_done(conn, tif, "cog-fixed", sl.get_fingerprint(tif))
+            out_8bit = rpl.get_8bit_name(tif, post_process_dict[k]["stretch"])
+            if not update and os.path.basename(out_8bit) in existing_8bit and sl.is_stage_done(conn, out_8bit, "8-bit"):
+                print("Already post processed:", tif)
+                continue
 
-                crs_key = os.path.basename(tif).split("_")[0]
-                crs = crs_dict[crs_key]
-                rpl.update_cog(tif, crs, -32768, update_stats=True, stat_stretch_type="stdDev", stretch_n_stdDev=5)
+            crs = crs_dict[raw.area]
+            jobs.append((tif, crs, -32768, post_process_dict[k]["scale_factor"], post_process_dict[k]["stretch"], post_process_dict[k]["palette"], update, post_process_dict[k]["thresh"]))
+    conn.close()
+    return jobs
 
-                done_files.append(tif)
 
-            else:
-                print("Already post processed:", tif)
+# Run a single post processing job and log it in the local state store
+def run_post_process_job(local_output_dir, job):
+    tif, updated, seconds = rpl.post_process_tif(*job)
+    print("Finished post processing {} in {:.1f} seconds".format(tif, seconds))
+    conn = sl.open_state_store(local_output_dir)
+    outputs = log_post_processed(conn, tif, updated, job[4])
+    conn.close()
+    return outputs
 
-            # Stretch raw to 8 bit
-            rpl.stretch_to_8bit(tif, -32768, post_process_dict[k]["scale_factor"], post_process_dict[k]["stretch"], post_process_dict[k]["palette"])
-            print()
 
-    # Log files tifhat have been processed
-    o = open(done_file, "w")
-    o.write(",".join(done_files))
-    o.close()
+###############################################################
+# Function to correct projection, set no data, update stats, and stretch to 8 bit
+# Progress is tracked in the local state store, keyed by product and the fingerprint of the file when each stage finished
+# Files that have changed since (e.g. a re-synced export) are processed again
+# If n_workers > 1, tifs are processed in parallel by a pool of worker processes
+# Each worker can use up to gdal_cache_mb of GDAL block cache (GDAL's default is used if None)
+# A product index (from LAMDA_products.build_product_index) of the local folder can be provided so it isn't listed again
+def post_process_local_outputs(local_output_dir, exportAreaName, crs_dict, post_process_dict, n_workers=1, gdal_cache_mb=None, products=None):
+    conn = sl.open_state_store(local_output_dir)
+    jobs = get_post_process_jobs(local_output_dir, exportAreaName, crs_dict, post_process_dict, products)
+
+    # Run the jobs (in any order) and log each file as soon as it finishes
+    start = time.time()
+    if n_workers > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(n_workers, initializer=rpl.init_worker, initargs=(gdal_cache_mb, rpl.output_profiles))
+        futures = {pool.submit(rpl.post_process_tif, *job): job for job in jobs}
+        results = concurrent.futures.as_completed(futures)
+    else:
+        pool = None
+        rpl.init_worker(gdal_cache_mb)
+        results = jobs
+
+    for result in results:
+        try:
+            if pool != None:
+                job = futures[result]
+                tif, updated, seconds = result.result()
+            else:
+                job = result
+                tif, updated, seconds = rpl.post_process_tif(*result)
+        except Exception as e:
+            print("Post processing failed:", e)
+            continue
+
+        print("Finished post processing {} in {:.1f} seconds".format(tif, seconds))
+        print()
+        log_post_processed(conn, tif, updated, job[4])
+
+    if pool != None:
+        pool.shutdown()
+    conn.close()
+    print("Post processed {} tifs in {:.1f} seconds".format(len(jobs), time.time() - start))
+
+
+# Log the stages of a post processed raw tif that have been done
+# Returns the list of outputs (raw tif, 8 bit tif, and jpg) that exist
+def log_post_processed(conn, tif, updated, stretch):
+    if updated:
+        sl.mark_stage_done(conn, tif, "cog-fixed", sl.get_fingerprint(tif))
+    out_8bit = rpl.get_8bit_name(tif, stretch)
+    out_jpg = os.path.splitext(out_8bit)[0] + ".jpg"
+    outputs = [tif]
+    if os.path.exists(out_8bit):
+        sl.mark_stage_done(conn, out_8bit, "8-bit", sl.get_fingerprint(out_8bit))
+        outputs.append(out_8bit)
+    if os.path.exists(out_jpg):
+        sl.mark_stage_done(conn, out_jpg, "jpg", sl.get_fingerprint(out_jpg))
+        outputs.append(out_jpg)
+    return outputs
 
 
 ###############################################################
-def calc_persistence_wrapper(local_output_dir, exportAreaName, indexNames, year, post_process_dict, persistence_n_periods=3):
+# Get the name of the persistence output for a window of raw tifs and their starting julian days
+# Windows of a GEE tile keep its suffix (e.g. -0000000000-0000000000) so the tiles of a window don't collide
+def get_persistence_name(window_tifs, window_jds, tile=None):
+    return window_tifs[-1].split("_jd")[0] + "_jds{}{}_persistence.tif".format("-".join([str(jd) for jd in window_jds]), tile or "")
+
+
+# Bring the detection history of an area, method, indices, and year up to date with its raw tifs
+# Periods that haven't been added (or whose raw tif has changed since) are added from their persistence masks
+# The history is made again if a period falls off its grid (e.g. an earlier first period) or the threshold changed
+# Each GEE tile has its own history
+# Returns the name and info of the history
+def update_detection_history(local_output_dir, area, method, indices, year, jds, tifs, scale_factor, thresh, tile=None):
+    history_name = dh.get_history_name(local_output_dir, area, method, indices, year, tile)
+    frequency = functools.reduce(math.gcd, [b - a for a, b in zip(jds[:-1], jds[1:])], 0) or 1
+
+    info = None
+    if os.path.exists(history_name) and os.path.exists(history_name + ".json"):
+        info = dh.read_history_info(history_name)
+        if info["scale_factor"] != scale_factor or info["thresh"] != thresh or any(dh.get_period_bit(info, jd) == None for jd in jds):
+            print("Remaking detection history:", history_name)
+            info = None
+
+    for jd, tif in zip(jds, tifs):
+        fingerprint = sl.get_fingerprint(tif)
+        if info != None and dh.has_period(info, jd, fingerprint):
+            continue
+        change, no_data, projection, geotransform = rpl.read_persistence_masks(tif, scale_factor, thresh)
+        if info == None:
+            info = dh.create_history(history_name, change.shape[1], change.shape[0], jds[0], frequency, scale_factor, thresh, projection, geotransform, (jds[-1] - jds[0]) // frequency + 1)
+        print("Adding period {} to detection history: {}".format(jd, history_name))
+        info = dh.add_period(history_name, jd, change, no_data, fingerprint)
+    return history_name, info
+
+
+# Compute persistence for each window of persistence_n_periods consecutive periods
+# By default periods are walked in order with a rolling count so each raw tif is only read once
+# If use_history is True, each raw tif is added to a bit-packed detection history once (see detection_history_lib)
+# and each window is computed from the history with popcounts (windows that span a missing period still use the rolling count)
+# The history path is off by default until its outputs have been checked against the rolling persistence outputs
+# Raw tifs are grouped by GEE tile and each tile gets its own windows
+# A product index (from LAMDA_products.build_product_index) of the local folder can be provided so it isn't listed again
+@li.traced("persistence", product_arg="exportAreaName")
+def calc_persistence_wrapper(local_output_dir, exportAreaName, indexNames, year, post_process_dict, persistence_n_periods=3, products=None, use_history=False):
+    conn = sl.open_state_store(local_output_dir)
+
+    # List and parse the local outputs
+    if products == None:
+        products = lp.build_product_index(lp.list_products(local_output_dir))
 
     # Iterate across each key provided
     for k in list(post_process_dict.keys()):
-        tifs = glob.glob(os.path.join(local_output_dir, "*{}*{}*{}*{}*.tif".format(exportAreaName, k, "-".join(indexNames), year)))
-        tifs = [i for i in tifs if i.find("8bit") == -1 and i.find("_persistence") == -1]
-
-        jds = list(set(int(os.path.basename(i).split("_jd")[-1].split("-")[0]) for i in tifs))
-        jds.sort()
-
-        jds_persist = jds[persistence_n_periods - 1 :]
-
-        for i, jd_persist in enumerate(jds_persist):
-            jds_t = jds[i : i + persistence_n_periods]
-
-            tifs_t = [i for i in tifs if int(os.path.basename(i).split("_jd")[-1].split("-")[0]) in jds_t]
-            output_persist = tifs_t[-1].split("_jd")[0] + "_jds{}_persistence.tif".format("-".join([str(i) for i in jds_t]))
-            if not os.path.exists(output_persist):
-                print(jds_t, len(tifs_t) == persistence_n_periods, output_persist)
-                rpl.calc_persistence(tifs_t, output_persist, post_process_dict[k]["scale_factor"], post_process_dict[k]["thresh"])
-            else:
-                print(output_persist, "already exists")
-            # out_jpg = os.path.splitext(output_persist)[0]+ '.jpg'
-            # rpl.translate(output_persist,out_jpg)
+        method = lp.get_method(k)
+        raws = lp.query_products(products, area=exportAreaName, method=method, indices="-".join(indexNames), year=year, kind="raw", cog=False, extension=".tif")
+        existing = set(p.name for p in lp.query_products(products, area=exportAreaName, method=method, indices="-".join(indexNames), year=year, kind="persistence", extension=".tif"))
+
+        # Group the tifs by tile and order each tile's tifs by their starting julian day
+        tile_dict = {}
+        for p in raws:
+            tile_dict.setdefault(p.tile, {})[p.start_julian] = p.path
+
+        for tile in sorted(tile_dict.keys(), key=lambda t: t or ""):
+            tif_dict = tile_dict[tile]
+            jds = sorted(tif_dict.keys())
+            tifs = [tif_dict[jd] for jd in jds]
+
+            # Find which persistence outputs still need made
+            output_names = []
+            for i in range(len(jds) - persistence_n_periods + 1):
+                jds_t = jds[i : i + persistence_n_periods]
+
+                output_persist = get_persistence_name(tifs[i : i + persistence_n_periods], jds_t, tile)
+                if os.path.basename(output_persist) not in existing:
+                    print(jds_t, output_persist)
+                    output_names.append(output_persist)
+                else:
+                    print(output_persist, "already exists")
+                    output_names.append(None)
+
+            to_roll = list(output_names)
+            if use_history and len([i for i in output_names if i != None]) > 0:
+                history_name, info = update_detection_history(local_output_dir, exportAreaName, method, "-".join(indexNames), year, jds, tifs, post_process_dict[k]["scale_factor"], post_process_dict[k]["thresh"], tile)
+
+                # Windows of consecutive periods on the grid of the history come straight from it
+                for i, output_persist in enumerate(output_names):
+                    jds_t = jds[i : i + persistence_n_periods]
+                    if output_persist == None or jds_t[-1] - jds_t[0] != (persistence_n_periods - 1) * info["frequency"]:
+                        continue
+                    print("Computing persistence from detection history:", output_persist)
+                    count = dh.get_persistence(history_name, jds_t[-1], persistence_n_periods)
+                    rpl.write_persistence_cog(count, output_persist, info["projection"], info["geotransform"])
+                    rpl.translate_preview(output_persist, os.path.splitext(output_persist)[0] + ".jpg")
+                    to_roll[i] = None
+                    count = None
+
+            rpl.calc_persistence_rolling(tifs, to_roll, post_process_dict[k]["scale_factor"], post_process_dict[k]["thresh"], persistence_n_periods)
+
+            # Log persistence outputs that have been made
+            made = [i for i in output_names if i != None and os.path.exists(i)]
+            sl.mark_stages_done(conn, made, "persistence", [sl.get_fingerprint(i) for i in made])
+    conn.close()
 
 
 def convert_to_cog(folder):
-    tifs = glob.glob(os.path.join(folder, "*.tif"))
-    tifs = [i for i in tifs if os.path.basename(i).find("_cog.tif") == -1]
-    for tif in tifs:
+    names = set(os.listdir(folder))
+    tifs = [i for i in names if os.path.splitext(i)[1] == ".tif" and i.find("_cog.tif") == -1]
+    for tif in sorted(tifs):
         output = os.path.splitext(tif)[0] + "_cog.tif"
-        if not os.path.exists(output):
-            rpl.translate(tif, output, rpl.cogArgs)
+        if output not in names:
+            rpl.translate(os.path.join(folder, tif), os.path.join(folder, output), rpl.cogArgs)
 
 
 ###############################################################
@@ -553,6 +746,40 @@ def get_most_recent_MODIS_date(collection="MODIS/061/MYD09GQ"):
 
 
 ###############################################################
+# Get the tracking names (export descriptions) of an area's exports
+# Names that aren't LAMDA product names (e.g. other exports in the shared tracking list) are left out
+def get_area_tracking_filenames(tracking_filenames, exportAreaName):
+    products = [(i, lp.parse_product_name(i + ".tif")) for i in tracking_filenames]
+    return [i for i, p in products if p != None and p.area == exportAreaName]
+
+
+# Get the state of the most recent GEE task of each export (the task list is newest first)
+# Used by the LAMDA_scheduler.ExportWatcher of schedule_operational_lamda
+def get_export_states():
+    states = {}
+    for t in ee.data.getTaskList():
+        states.setdefault(t["description"], t["state"])
+    return states
+
+
+# Plan the work of an operational run for an area (see LAMDA_plan)
+# The GEE task list and the ingested asset collections are each read once
+# Returns the units that need work and the snapshot they were planned from
+def get_run_plan(exportAreaName, indexNames, year, startJulians, nDays, zBaselineLength, tddEpochLength, baselineGap, exportRawZ, exportRawSlope, post_process_dict, persistence_n_periods, local_output_dir, exportBucket, deliverable_output_bucket):
+    running_exports = [t["description"] for t in ee.data.getTaskList() if t["state"] in ["READY", "RUNNING"]]
+    ingested = [name for names in rc.get_existing_assets().values() for name in names]
+    snapshot = lplan.take_snapshot([exportAreaName], local_output_dir, exportBucket, deliverable_output_bucket, running_exports, ingested)
+
+    units = lplan.get_expected_units(exportAreaName, indexNames, year, startJulians, nDays, zBaselineLength, tddEpochLength, baselineGap, exportRawZ, exportRawSlope, post_process_dict, persistence_n_periods)
+    run_plan = lplan.plan_units(units, snapshot)
+    print("Plan for {} {} ({} periods):".format(exportAreaName, year, len(startJulians)))
+    lplan.print_plan(run_plan, len(units))
+    return run_plan, snapshot
+
+
+###############################################################
+# With plan, only the work a snapshot of the buckets, local folder, and assets shows is missing is run
+# With dry_run, the plan is printed and returned without running anything
 def operational_lamda(
     first_run,
     frequency,
@@ -595,68 +822,210 @@ def operational_lamda(
     post_process_dict,
     persistence_n_periods,
     deliverable_output_bucket,
+    post_process_n_workers=1,
+    gdal_cache_mb=None,
+    transfer_n_workers=8,
+    use_gsutil=False,
+    exports_only=False,
+    plan=False,
+    dry_run=False,
 ):
-    most_recent_modis = get_most_recent_MODIS_date()
+    run_start = time.time()
+    with li.span("modis_date"):
+        most_recent_modis = get_most_recent_MODIS_date()
     year = int(most_recent_modis.split("-")[0])  # time.localtime()[0]
     jd = int(most_recent_modis.split("-")[1]) - nDays  # time.localtime()[7]
     startJulians = list(range(first_run, jd + 1, frequency))
 
+    # Compare what the run should make with a snapshot of what already exists and only run the missing work
+    run_plan = None
+    if plan or dry_run:
+        with li.span("plan", exportAreaName):
+            run_plan, snapshot = get_run_plan(exportAreaName, indexNames, year, startJulians, nDays, zBaselineLength, tddEpochLength, baselineGap, exportRawZ, exportRawSlope, post_process_dict, persistence_n_periods, local_output_dir, exportBucket, deliverable_output_bucket)
+        if dry_run:
+            return run_plan
+        export_groups = lplan.get_export_groups(run_plan)
+    else:
+        export_groups = {(exportRawZ, exportRawSlope): startJulians}
+
     # Run LAMDA GEE portion (get MODIS, cloud cloud shadow bust, make raw Z score and trend products)
-    tracking_filenames = lamda_wrapper(
-        [year],
-        startJulians,
-        nDays,
-        zBaselineLength,
-        tddEpochLength,
-        baselineGap,
-        indexNames,
-        zThresh,
-        slopeThresh,
-        zReducer,
-        tddAnnualReducer,
-        zenithThresh,
-        addLookAngleBands,
-        applyCloudScore,
-        applyTDOM,
-        cloudScoreThresh,
-        performCloudScoreOffset,
-        cloudScorePctl,
-        zScoreThresh,
-        shadowSumThresh,
-        contractPixels,
-        dilatePixels,
-        resampleMethod,
-        preComputedCloudScoreOffset,
-        preComputedTDOMIRMean,
-        preComputedTDOMIRStdDev,
-        tree_mask,
-        crs,
-        transform,
-        scale,
-        exportBucket,
-        exportAreaName,
-        exportArea,
-        exportRawZ,
-        exportRawSlope,
-    )
+    # With a plan, graphs are only built for the periods that need exporting
+    # Graph time includes submitting the exports (each is also its own export_submit span)
+    tracking_filenames = []
+    for (export_z, export_tdd), export_julians in export_groups.items():
+        with li.span("graph", exportAreaName):
+            tracking_filenames = lamda_wrapper(
+                [year],
+                export_julians,
+                nDays,
+                zBaselineLength,
+                tddEpochLength,
+                baselineGap,
+                indexNames,
+                zThresh,
+                slopeThresh,
+                zReducer,
+                tddAnnualReducer,
+                zenithThresh,
+                addLookAngleBands,
+                applyCloudScore,
+                applyTDOM,
+                cloudScoreThresh,
+                performCloudScoreOffset,
+                cloudScorePctl,
+                zScoreThresh,
+                shadowSumThresh,
+                contractPixels,
+                dilatePixels,
+                resampleMethod,
+                preComputedCloudScoreOffset,
+                preComputedTDOMIRMean,
+                preComputedTDOMIRStdDev,
+                tree_mask,
+                crs,
+                transform,
+                scale,
+                exportBucket,
+                exportAreaName,
+                exportArea,
+                export_z,
+                export_tdd,
+            )
+
+    # Also wait on exports that were already running and pass on the outputs that only need local work
+    if run_plan != None:
+        tracking_filenames = get_area_tracking_filenames(tracking_filenames, exportAreaName)
+        tracking_filenames = list(dict.fromkeys(tracking_filenames + lplan.get_wait_names(run_plan) + lplan.get_work_names(run_plan)))
+
+    # Only start the exports (used by schedule_operational_lamda)
+    # The tracking list is shared by every area run in this process, so only keep this area's exports
+    if exports_only:
+        tracking_filenames = get_area_tracking_filenames(tracking_filenames, exportAreaName)
+        return year, startJulians, tracking_filenames
 
     # Wait until exports are finished to proced
-    tml.trackTasks2(id_list=tracking_filenames)
+    with li.span("export_wait", exportAreaName):
+        tml.trackTasks2(id_list=tracking_filenames)
     print(tracking_filenames, "finished exporting")
 
     # Copy outputs to local folder
-    output_filter_strings = ["*{}_LAMDA_Z_{}_*_ay{}*".format(exportAreaName, "-".join(indexNames), year), "*{}_LAMDA_TDD_{}_yrs*-{}*".format(exportAreaName, "-".join(indexNames), year)]
-    sync_outputs(exportBucket, local_output_dir, output_filter_strings, gsutil_path)
+    # With a plan, only the new exports are listed (the rest were listed in the snapshot)
+    if run_plan == None:
+        output_filter_strings = ["*{}_LAMDA_Z_{}_*_ay{}*".format(exportAreaName, "-".join(indexNames), year), "*{}_LAMDA_TDD_{}_yrs*-{}*".format(exportAreaName, "-".join(indexNames), year)]
+        sync_outputs(exportBucket, local_output_dir, output_filter_strings, gsutil_path, transfer_n_workers, use_gsutil=use_gsutil)
+    else:
+        new_exports = [u.raw_names[0] for u in run_plan if "export" in u.stages or "wait" in u.stages]
+        sync_outputs(exportBucket, local_output_dir, [i + "*" for i in new_exports], gsutil_path, transfer_n_workers, use_gsutil=use_gsutil, listed_objs=lplan.get_sync_objs(run_plan, snapshot))
+
+    # List and parse the local outputs once for the following stages
+    products = lp.build_product_index(lp.list_products(local_output_dir))
 
     # Correct crs, no data, and convert to 8 bit
-    post_process_local_outputs(local_output_dir, exportAreaName, crs_dict, post_process_dict)
+    post_process_local_outputs(local_output_dir, exportAreaName, crs_dict, post_process_dict, post_process_n_workers, gdal_cache_mb, products)
 
     # Compute persistence
-    calc_persistence_wrapper(local_output_dir, exportAreaName, indexNames, year, post_process_dict, persistence_n_periods)
+    if run_plan == None or any("persistence" in u.stages for u in run_plan):
+        calc_persistence_wrapper(local_output_dir, exportAreaName, indexNames, year, post_process_dict, persistence_n_periods, products)
 
     # #Upload outputs
-    upload_outputs(exportAreaName, local_output_dir, deliverable_output_bucket, "tif")
-    upload_outputs(exportAreaName, local_output_dir, deliverable_output_bucket, "jpg")
+    tif_results = []
+    if run_plan == None or any("upload" in u.stages for u in run_plan):
+        tif_results = upload_outputs(exportAreaName, local_output_dir, deliverable_output_bucket, "tif", gsutil_path, transfer_n_workers, use_gsutil=use_gsutil)
+        upload_outputs(exportAreaName, local_output_dir, deliverable_output_bucket, "jpg", gsutil_path, transfer_n_workers, use_gsutil=use_gsutil)
+        upload_outputs(exportAreaName, local_output_dir, deliverable_output_bucket, "tif.aux.xml", gsutil_path, transfer_n_workers, use_gsutil=use_gsutil)
 
     # Ingest as COG-backed assets
-    rc.ingest_lamda()
+    # With a plan, only the planned tifs are ingested rather than listing the bucket and collections again
+    if run_plan == None or use_gsutil:
+        rc.ingest_lamda(local_output_dir)
+    else:
+        uploaded = [r.name for r in tif_results if r.ok or r.skipped]
+        to_ingest = lplan.get_ingest_names(run_plan, snapshot, uploaded)
+        if len(to_ingest) > 0:
+            conn = sl.open_state_store(local_output_dir)
+            sl.mark_stages_done(conn, rc.ingest_products(to_ingest), "ingested")
+            conn.close()
+
+    # Print how long each stage took if instrumentation is on
+    if li.is_enabled():
+        li.print_summary(since=run_start)
+
+
+###############################################################
+# Schedule the stages of operational_lamda for an area as jobs on a LAMDA_scheduler.Scheduler
+# Takes the same arguments as operational_lamda
+# Exports and ingesting run on the gee pool, waiting on exports on the wait pool (so a long wait never holds a gee slot
+# other areas need to start their exports), transfers on the network pool, and post processing and persistence on the cpu pool
+# Each raw tif is post processed as its own job, most recent period first
+# so how many raw tifs are post processed at once is set by the size of the scheduler's cpu pool
+# (post_process_n_workers isn't used and must be left at 1)
+# Waits on exports block until export_watcher (a LAMDA_scheduler.ExportWatcher shared by every area) sees them finish
+# If export_watcher is None, one is made for the area
+# Areas with a lower priority run first
+# With plan, only the planned exports are started and waited on (the later stages keep their own checks)
+# Returns the export job (the rest of the jobs are submitted as each stage finishes)
+def schedule_operational_lamda(scheduler, *args, priority=0, export_watcher=None, **kwargs):
+    a = inspect.signature(operational_lamda).bind(*args, **kwargs)
+    a.apply_defaults()
+    a = dict(a.arguments)
+    area = a["exportAreaName"]
+    local_output_dir = a["local_output_dir"]
+    if a["post_process_n_workers"] != 1:
+        raise ValueError("post_process_n_workers isn't used by schedule_operational_lamda (each raw tif is its own job). Set the size of the scheduler's cpu pool instead")
+    if export_watcher == None:
+        export_watcher = ls.ExportWatcher(get_export_states)
+    rpl.init_worker(a["gdal_cache_mb"])
+
+    # Only print the plan (the job's result is the plan)
+    if a["dry_run"]:
+        return scheduler.submit("{} plan".format(area), "gee", operational_lamda, kwargs=a, priority=priority * 1000)
+
+    def wait_on_exports(export_job):
+        year, startJulians, tracking_filenames = export_job.result
+        with li.span("export_wait", area):
+            states = export_watcher.wait(tracking_filenames)
+        failed = [name for name, state in states.items() if state not in [None, "COMPLETED"]]
+        if len(failed) > 0:
+            print("Exports that didn't complete:", failed)
+        print(tracking_filenames, "finished exporting")
+
+    def sync(export_job):
+        year, startJulians, tracking_filenames = export_job.result
+        output_filter_strings = ["*{}_LAMDA_Z_{}_*_ay{}*".format(area, "-".join(a["indexNames"]), year), "*{}_LAMDA_TDD_{}_yrs*-{}*".format(area, "-".join(a["indexNames"]), year)]
+        sync_outputs(a["exportBucket"], local_output_dir, output_filter_strings, a["gsutil_path"], a["transfer_n_workers"], use_gsutil=a["use_gsutil"])
+
+        # Post process each raw tif as its own job and follow with persistence, uploading, and ingesting
+        products = lp.build_product_index(lp.list_products(local_output_dir))
+        post_jobs = []
+        for job in get_post_process_jobs(local_output_dir, area, a["crs_dict"], a["post_process_dict"], products):
+            jd = lp.parse_product_name(job[0]).start_julian
+            post_jobs.append(scheduler.submit("{} post process {}".format(area, os.path.basename(job[0])), "cpu", run_post_process_job, (local_output_dir, job), priority=priority * 1000 - jd))
+
+        persistence_job = scheduler.submit(
+            "{} persistence".format(area),
+            "cpu",
+            calc_persistence_wrapper,
+            (local_output_dir, area, a["indexNames"], year, a["post_process_dict"], a["persistence_n_periods"]),
+            priority=priority * 1000,
+            depends_on=post_jobs,
+            run_if_failed=True,
+        )
+        upload_jobs = [
+            scheduler.submit(
+                "{} upload {}".format(area, extension),
+                "network",
+                upload_outputs,
+                (area, local_output_dir, a["deliverable_output_bucket"], extension, a["gsutil_path"], a["transfer_n_workers"]),
+                {"use_gsutil": a["use_gsutil"]},
+                priority=priority * 1000,
+                depends_on=[persistence_job],
+                run_if_failed=True,
+            )
+            for extension in ["tif", "jpg", "tif.aux.xml"]
+        ]
+        scheduler.submit("{} ingest".format(area), "gee", rc.ingest_lamda, (local_output_dir,), priority=priority * 1000, depends_on=upload_jobs)
+
+    export_job = scheduler.submit("{} exports".format(area), "gee", operational_lamda, kwargs=dict(a, exports_only=True), priority=priority * 1000)
+    wait_job = scheduler.submit("{} wait on exports".format(area), "wait", wait_on_exports, (export_job,), priority=priority * 1000, depends_on=[export_job])
+    scheduler.submit("{} sync".format(area), "network", sync, (export_job,), priority=priority * 1000, depends_on=[wait_job])
+    return export_job
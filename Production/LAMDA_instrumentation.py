@@ -0,0 +1,249 @@
+"""
+   Copyright 2021 Ian Housman, RedCastle Resources Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Script to time the stages of LAndscape Monitoring and Detection Application (LAMDA) operational runs
+# Stages are wrapped in spans:
+#   with li.span("sync", product=name) as s:
+#       ...
+#       s.add(pixels=width * height)
+# or whole functions are wrapped with the traced decorator:
+#   @li.traced("upload", product_arg="exportAreaName")
+# Each span records its wall time, bytes read and written, pixels processed, and peak RSS
+# and is written as a line of JSON to the file instrumentation was enabled with
+# A summary table of all spans by stage can be printed at the end of a run
+#
+# Byte counts come from the I/O counters of the process (psutil, /proc/self/io, or getrusage)
+# so they include everything the process did while the span was open (e.g. other threads)
+# Peak RSS is the peak of the process so far
+# When instrumentation isn't enabled, span returns a shared span that does nothing
+####################################################################################################
+import os, sys, json, time, threading, contextlib, collections, functools, inspect
+
+# Environment variable holding the JSON lines file so worker processes (spawned or forked) write to it too
+env_var = "LAMDA_INSTRUMENTATION_JSONL"
+
+jsonl_path = os.environ.get(env_var)
+write_lock = threading.Lock()
+
+try:
+    import psutil
+
+    this_process = psutil.Process()
+except ImportError:
+    psutil = None
+    this_process = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+####################################################################################################
+# Turn instrumentation on and write spans to a JSON lines file (appended to if it exists)
+def enable(path):
+    global jsonl_path
+    jsonl_path = os.path.abspath(path)
+    os.environ[env_var] = jsonl_path
+    if not os.path.exists(os.path.dirname(jsonl_path)):
+        os.makedirs(os.path.dirname(jsonl_path))
+
+
+def disable():
+    global jsonl_path
+    jsonl_path = None
+    os.environ.pop(env_var, None)
+
+
+def is_enabled():
+    return jsonl_path != None
+
+
+####################################################################################################
+# Get the bytes read and written by this process so far
+def get_io_bytes():
+    if this_process != None:
+        try:
+            counters = this_process.io_counters()
+            return counters.read_bytes, counters.write_bytes
+        except Exception:
+            pass
+    if os.path.exists("/proc/self/io"):
+        values = {}
+        for line in open("/proc/self/io"):
+            k, v = line.split(":")
+            values[k] = int(v)
+        return values.get("read_bytes", 0), values.get("write_bytes", 0)
+    if resource != None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+    return 0, 0
+
+
+# Get the peak resident memory of this process so far in MB
+def get_peak_rss_mb():
+    if resource != None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024.0 / 1024.0 if sys.platform == "darwin" else peak / 1024.0
+    if this_process != None:
+        info = this_process.memory_info()
+        return getattr(info, "peak_wset", info.rss) / 1024.0 / 1024.0
+    return None
+
+
+####################################################################################################
+# A timed stage of a run
+# Counts (e.g. pixels) and any other attributes can be added while it is open
+class Span:
+    def __init__(self, stage, product=None, **attrs):
+        self.stage = stage
+        self.product = product
+        self.attrs = attrs
+        self.pixels = 0
+
+    def add(self, pixels=0, **attrs):
+        self.pixels += pixels
+        self.attrs.update(attrs)
+
+    def start(self):
+        self.start_time = time.time()
+        self.start_counter = time.perf_counter()
+        self.start_read, self.start_write = get_io_bytes()
+
+    def finish(self, error=None):
+        read, write = get_io_bytes()
+        record = {
+            "stage": self.stage,
+            "product": self.product,
+            "start": self.start_time,
+            "seconds": time.perf_counter() - self.start_counter,
+            "bytes_read": read - self.start_read,
+            "bytes_written": write - self.start_write,
+            "pixels": self.pixels,
+            "peak_rss_mb": get_peak_rss_mb(),
+            "ok": error == None,
+            "error": str(error) if error != None else None,
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+        }
+        record.update(self.attrs)
+        write_record(record)
+
+
+# Span used when instrumentation is off
+class NullSpan:
+    def add(self, pixels=0, **attrs):
+        pass
+
+
+null_span = NullSpan()
+
+
+@contextlib.contextmanager
+def span(stage, product=None, **attrs):
+    if jsonl_path == None:
+        yield null_span
+        return
+
+    s = Span(stage, product, **attrs)
+    s.start()
+    try:
+        yield s
+    except BaseException as e:
+        s.finish(e)
+        raise
+    s.finish()
+
+
+# Decorator that wraps each call of a function in a span
+# product_arg is the name of the argument to use as the product of the span (its default if it isn't passed)
+def traced(stage, product_arg=None):
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if jsonl_path == None:
+                return func(*args, **kwargs)
+            product = None
+            if product_arg != None:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                product = bound.arguments.get(product_arg)
+            with span(stage, product):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def write_record(record):
+    line = json.dumps(record, default=str) + "\n"
+    with write_lock:
+        o = open(jsonl_path, "a")
+        o.write(line)
+        o.close()
+
+
+####################################################################################################
+# Read the spans from a JSON lines file (the enabled file if not provided)
+# Only spans that started at or after since (seconds since the epoch) are returned if it is provided
+def read_spans(path=None, since=None):
+    path = path if path != None else jsonl_path
+    if path == None or not os.path.exists(path):
+        return []
+    spans = []
+    for line in open(path):
+        line = line.strip()
+        if line != "":
+            record = json.loads(line)
+            if since == None or record["start"] >= since:
+                spans.append(record)
+    return spans
+
+
+# Summarize spans by stage
+# Returns a dictionary of stage: {n, seconds, mean_seconds, max_seconds, mb_read, mb_written, mpix, peak_rss_mb, n_failed}
+def summarize(spans):
+    summary = collections.OrderedDict()
+    for record in sorted(spans, key=lambda r: r["start"]):
+        s = summary.setdefault(record["stage"], {"n": 0, "seconds": 0.0, "max_seconds": 0.0, "mb_read": 0.0, "mb_written": 0.0, "mpix": 0.0, "peak_rss_mb": 0.0, "n_failed": 0})
+        s["n"] += 1
+        s["seconds"] += record["seconds"]
+        s["max_seconds"] = max(s["max_seconds"], record["seconds"])
+        s["mb_read"] += record["bytes_read"] / 1024.0 / 1024.0
+        s["mb_written"] += record["bytes_written"] / 1024.0 / 1024.0
+        s["mpix"] += record["pixels"] / 1e6
+        s["peak_rss_mb"] = max(s["peak_rss_mb"], record["peak_rss_mb"] or 0)
+        s["n_failed"] += 0 if record["ok"] else 1
+    for s in summary.values():
+        s["mean_seconds"] = s["seconds"] / s["n"]
+    return summary
+
+
+# Print a table of the spans by stage
+def print_summary(path=None, since=None):
+    summary = summarize(read_spans(path, since))
+    if len(summary) == 0:
+        return summary
+
+    header = ["stage", "n", "seconds", "mean", "max", "MB read", "MB written", "Mpix", "peak RSS MB", "failed"]
+    print("".join(h.ljust(14) for h in header))
+    for stage, s in summary.items():
+        row = [stage, s["n"], s["seconds"], s["mean_seconds"], s["max_seconds"], s["mb_read"], s["mb_written"], s["mpix"], s["peak_rss_mb"], s["n_failed"]]
+        print("".join((("{:.1f}".format(v) if isinstance(v, float) else str(v))[:13]).ljust(14) for v in row))
+    return summary
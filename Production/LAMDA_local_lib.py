@@ -0,0 +1,586 @@
+"""
+   Copyright 2021 Ian Housman, RedCastle Resources Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Script to run the LAndscape Monitoring and Detection Application (LAMDA) methods locally for backfills and experiments
+# Runs on a local stack of MODIS index rasters rather than in GEE, so nothing goes through export queues or quotas
+# The statistics are in local_stats_lib and this script reads the stack and writes the outputs
+#
+# The stack is a folder of rasters with one band per index (e.g. NBR and NDVI) for each MODIS observation
+# Each raster is named with the MODIS acquisition date (e.g. MYD09GQ.A2024153.NBR-NDVI.tif is year 2024 julian day 153)
+# Bands are matched to indexNames by their band descriptions (or band_names if provided)
+# Every raster must already be on the grid of the export area (the crs and transform the outputs are exported on)
+# and cloud, cloud shadow, and tree masking should already be applied (masked observations are no data)
+#
+# Outputs are written chunk by chunk with the same names, int16 scaling, and no data as the GEE exports
+# (see getZ and getTrend) so they can be post processed, uploaded, and ingested like any other export
+####################################################################################################
+import os, re, glob, collections, time, argparse
+import numpy
+import raster_processing_lib as rpl
+import local_stats_lib as lsl
+import baseline_climatology_lib as bcl
+import LAMDA_plan as lplan
+import LAMDA_instrumentation as li
+
+gdal = rpl.gdal
+
+# MODIS style acquisition date in a file name (A{year}{julian day})
+stack_date_regex = re.compile(r"(?:^|[._])A(?P<year>\d{4})(?P<julian>\d{3})(?=[._]|$)")
+
+# Image in a local stack
+StackImage = collections.namedtuple("StackImage", ["path", "year", "julian"])
+
+
+####################################################################################################
+# List the images of a local stack sorted by date
+# Files that don't have a date in their name are skipped
+def list_stack(folder, pattern="*.tif"):
+    images = []
+    for path in glob.glob(os.path.join(folder, pattern)):
+        m = stack_date_regex.search(os.path.basename(path))
+        if m != None:
+            images.append(StackImage(path, int(m.group("year")), int(m.group("julian"))))
+    return sorted(images, key=lambda i: (i.year, i.julian, i.path))
+
+
+# Open the images of a stack and find the band of each index
+# Returns a list of (dataset, [band of each index], [no data of each index])
+def open_stack(images, indexNames, band_names=None):
+    opened = []
+    for image in images:
+        ds = gdal.Open(image.path)
+        if ds == None:
+            raise ValueError("Could not open: {}".format(image.path))
+        names = band_names if band_names != None else [ds.GetRasterBand(i + 1).GetDescription() for i in range(ds.RasterCount)]
+        missing = [n for n in indexNames if n not in names]
+        if len(missing) > 0:
+            raise ValueError("{} does not have bands for: {} (bands: {})".format(image.path, missing, names))
+        bands = [ds.GetRasterBand(names.index(n) + 1) for n in indexNames]
+        opened.append((ds, bands, [b.GetNoDataValue() for b in bands]))
+    return opened
+
+
+# Generator of each image of a chunk of an opened stack as a float32 array of shape (bands, rows, columns)
+# No data values (and pixels where mask is False) are set to nan
+# value_scale converts stored values to index values (e.g. 0.0001 for indices stored as int16 x 10000)
+def iter_stack_chunk(opened, xoff, yoff, xsize, ysize, mask=None, value_scale=1.0):
+    for ds, bands, no_datas in opened:
+        out = numpy.empty((len(bands), ysize, xsize), dtype="float32")
+        for b, (band, no_data) in enumerate(zip(bands, no_datas)):
+            values = band.ReadAsArray(xoff, yoff, xsize, ysize).astype("float32")
+            if no_data != None:
+                values[values == no_data] = numpy.nan
+            out[b] = values
+        if value_scale != 1.0:
+            out *= value_scale
+        if mask is not None:
+            out[:, ~mask] = numpy.nan
+        yield out
+
+
+# Read a chunk of an opened stack into a float32 array of shape (time, bands, rows, columns) (see iter_stack_chunk)
+def read_stack_chunk(opened, xoff, yoff, xsize, ysize, mask=None, value_scale=1.0):
+    out = numpy.empty((len(opened), len(opened[0][1]) if len(opened) > 0 else 0, ysize, xsize), dtype="float32")
+    for t, values in enumerate(iter_stack_chunk(opened, xoff, yoff, xsize, ysize, mask, value_scale)):
+        out[t] = values
+    return out
+
+
+# Generator of (xoff, yoff, xsize, ysize) chunks covering a grid
+def iter_chunks(width, height, chunk_size=512):
+    for yoff in range(0, height, chunk_size):
+        for xoff in range(0, width, chunk_size):
+            yield xoff, yoff, min(chunk_size, width - xoff), min(chunk_size, height - yoff)
+
+
+# Read a chunk of a mask raster (e.g. a tree mask) as a boolean array (True where the pixel is kept)
+def read_mask_chunk(mask_ds, xoff, yoff, xsize, ysize):
+    if mask_ds == None:
+        return None
+    band = mask_ds.GetRasterBand(1)
+    values = band.ReadAsArray(xoff, yoff, xsize, ysize)
+    keep = values != 0
+    if band.GetNoDataValue() != None:
+        keep &= values != band.GetNoDataValue()
+    return keep
+
+
+####################################################################################################
+# Create an uncompressed tiled scratch tif that an int16 export is written to chunk by chunk
+def create_export_scratch(scratch_name, width, height, projection, geotransform):
+    driver = gdal.GetDriverByName("GTiff")
+    ds = driver.Create(scratch_name, width, height, 1, gdal.GDT_Int16, options=["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512", "BIGTIFF=IF_SAFER"])
+    ds.SetProjection(projection)
+    ds.SetGeoTransform(geotransform)
+    ds.GetRasterBand(1).SetNoDataValue(lsl.export_no_data)
+    return ds
+
+
+# Copy a finished scratch tif to a COGtif (like the GEE exports) and remove the scratch tif
+def finish_export(scratch_ds, scratch_name, output_name):
+    ds2 = gdal.GetDriverByName("COG").CreateCopy(output_name, scratch_ds, options=["OVERVIEW_RESAMPLING=NEAREST"] + rpl.get_cog_options("raw"))
+    ds2 = None
+    scratch_ds = None
+    gdal.GetDriverByName("GTiff").Delete(scratch_name)
+
+
+# Get the grid (width, height, projection, geotransform) of a stack
+# Raises an error if any image is on a different grid
+def get_stack_grid(opened):
+    ds = opened[0][0]
+    grid = (ds.RasterXSize, ds.RasterYSize, ds.GetProjection(), ds.GetGeoTransform())
+    for other, bands, no_datas in opened[1:]:
+        if (other.RasterXSize, other.RasterYSize) != grid[:2] or other.GetGeoTransform() != grid[3]:
+            raise ValueError("Stack images must all be on the same grid: {}".format(other.GetDescription()))
+    return grid
+
+
+####################################################################################################
+# Run a local method over a stack chunk by chunk and write its raw exports
+# outputs is a list of (output name without extension, scale factor) of each export
+# compute is called with each chunk of the stack (see read_stack_chunk), the years and julian days of its observations,
+# and the chunk's window (xoff, yoff, xsize, ysize) and returns the values of each output (nan where masked)
+# If streaming is True, compute gets a generator of the chunk's images (see iter_stack_chunk) instead of the stack
+# so the chunk is never held all at once
+# Only the images keep is True for are read
+# tree_mask is an optional raster on the same grid (0 or no data is masked)
+# Returns the output names
+def run_local_export(images, keep, indexNames, output_folder, outputs, compute, stage, chunk_size=512, band_names=None, tree_mask=None, value_scale=1.0, overwrite=False, streaming=False):
+    output_names = [os.path.join(output_folder, output_base + ".tif") for output_base, scale_factor in outputs]
+    todo = []
+    for i, output_name in enumerate(output_names):
+        if os.path.exists(output_name) and not overwrite:
+            print(output_name, "already exists")
+        else:
+            todo.append(i)
+    if len(todo) == 0:
+        return output_names
+
+    images = [i for i, k in zip(images, keep) if k]
+    if len(images) == 0:
+        raise ValueError("No stack images found for: {}".format(outputs[todo[0]][0]))
+
+    print("Running {} over {} images for: {}".format(stage, len(images), ", ".join([outputs[i][0] for i in todo])))
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    opened = open_stack(images, indexNames, band_names)
+    width, height, projection, geotransform = get_stack_grid(opened)
+    years = numpy.array([i.year for i in images])
+    julians = numpy.array([i.julian for i in images])
+    mask_ds = gdal.Open(tree_mask) if tree_mask != None else None
+
+    scratch_names = {i: os.path.join(output_folder, outputs[i][0] + "_tmp.tif") for i in todo}
+    scratch_dss = {i: create_export_scratch(scratch_names[i], width, height, projection, geotransform) for i in todo}
+    with li.span(stage, outputs[todo[0]][0]) as s:
+        for xoff, yoff, xsize, ysize in iter_chunks(width, height, chunk_size):
+            read_chunk = iter_stack_chunk if streaming else read_stack_chunk
+            stack = read_chunk(opened, xoff, yoff, xsize, ysize, read_mask_chunk(mask_ds, xoff, yoff, xsize, ysize), value_scale)
+            values = compute(stack, years, julians, xoff, yoff, xsize, ysize)
+            for i in todo:
+                scratch_dss[i].GetRasterBand(1).WriteArray(lsl.to_export_int16(values[i], outputs[i][1]), xoff, yoff)
+        s.add(pixels=width * height * len(todo), n_images=len(images), n_outputs=len(todo))
+
+    for i in todo:
+        finish_export(scratch_dss[i], scratch_names[i], output_names[i])
+    scratch_dss = None
+    opened = None
+    mask_ds = None
+    return output_names
+
+
+# Local version of getZ
+# Writes the raw z score export ({area}_LAMDA_Z_..._jd{startJulian}-{endJulian}.tif) to output_folder
+# zPercentile is the percentile of zReducer (e.g. 70 for ee.Reducer.percentile([70]))
+# ddof and percentile_method set how the baseline standard deviation and percentile are computed (see local_stats_lib)
+# If climatology_folder is provided and has the baseline years (see update_climatology), the baseline comes from
+# their bins and only the analysis year observations are read
+# (the baseline is read from the stack if the window isn't on the bin grid or a bin is missing)
+# If sketch_bins is provided, the stack is streamed one image at a time and the zPercentile percentile comes from
+# a PercentileSketch of sketch_bins bins over sketch_range in z score units (see local_stats_lib.get_z_streaming)
+# Any other keyword arguments (e.g. tree_mask or chunk_size) are passed on to run_local_export
+# Returns the output name
+def run_local_z(
+    images,
+    indexNames,
+    startJulian,
+    endJulian,
+    analysisYear,
+    output_folder,
+    exportAreaName,
+    baselineLength=3,
+    baselineGap=1,
+    zPercentile=70,
+    zThresh=-3,
+    ddof=0,
+    percentile_method="linear",
+    climatology_folder=None,
+    sketch_bins=None,
+    sketch_range=(-10.0, 10.0),
+    **kwargs
+):
+    rawZOutputName = lplan.get_raw_name(exportAreaName, "Z", indexNames, analysisYear, startJulian, endJulian - startJulian + 1, baselineLength, 0, baselineGap)
+
+    # Only read the observations of the baseline and analysis years within the julian range
+    baselineStartYear, baselineEndYear = lsl.get_baseline_years(analysisYear, baselineLength, baselineGap)
+    years = [i.year for i in images]
+    julians = [i.julian for i in images]
+    analysis = lsl.filter_dates(years, julians, startJulian, endJulian, analysisYear, analysisYear)
+    keep = lsl.filter_dates(years, julians, startJulian, endJulian, baselineStartYear, baselineEndYear) | analysis
+
+    climatology_names = get_baseline_climatologies(climatology_folder, exportAreaName, indexNames, startJulian, endJulian, baselineStartYear, baselineEndYear) if climatology_folder != None else None
+    if climatology_names != None:
+        keep = analysis
+
+    def compute(stack, years, julians, xoff, yoff, xsize, ysize):
+        baseline = None
+        if climatology_names != None:
+            baseline = bcl.get_baseline_stats(climatology_names, startJulian, endJulian, xoff, yoff, xsize, ysize, ddof)
+        if sketch_bins != None:
+            return [lsl.get_z_streaming(stack, years, julians, startJulian, endJulian, analysisYear, baselineLength, baselineGap, zPercentile, zThresh, ddof, percentile_method, sketch_range, sketch_bins, baseline, (len(indexNames), ysize, xsize))[0]]
+        if baseline != None:
+            return [lsl.get_analysis_z(stack, baseline[0], baseline[1], zPercentile, zThresh, percentile_method)[0]]
+        return [lsl.get_z(stack, years, julians, startJulian, endJulian, analysisYear, baselineLength, baselineGap, zPercentile, zThresh, ddof, percentile_method)[0]]
+
+    return run_local_export(images, keep, indexNames, output_folder, [(rawZOutputName, lsl.z_scale_factor)], compute, "local_z", streaming=sketch_bins != None, **kwargs)[0]
+
+
+# Local version of getTrend
+# Writes the raw trend export ({area}_LAMDA_TDD_..._jd{startJulian}-{endJulian}.tif) to output_folder
+# annualPercentile is the percentile of tddAnnualReducer (e.g. 50 for ee.Reducer.percentile([50]))
+# joint_mask leaves a year out of every band of a pixel if any band is masked (see local_stats_lib.ols_slope)
+# If sketch_bins is provided, the stack is streamed one image at a time and each annual composite comes from
+# a PercentileSketch of sketch_bins bins over sketch_range (see local_stats_lib.get_trend_streaming)
+# Returns the output name
+def run_local_trend(
+    images,
+    indexNames,
+    startJulian,
+    endJulian,
+    analysisYear,
+    output_folder,
+    exportAreaName,
+    epochLength=5,
+    annualPercentile=50,
+    slopeThresh=-0.05,
+    percentile_method="linear",
+    joint_mask=True,
+    sketch_bins=None,
+    sketch_range=(-1.0, 1.0),
+    **kwargs
+):
+    rawSlopeOutputName = lplan.get_raw_name(exportAreaName, "TDD", indexNames, analysisYear, startJulian, endJulian - startJulian + 1, 0, epochLength, 0)
+
+    # Only read the observations of the epoch within the julian range
+    epochStartYear, epochEndYear = lsl.get_epoch_years(analysisYear, epochLength)
+    keep = lsl.filter_dates([i.year for i in images], [i.julian for i in images], startJulian, endJulian, epochStartYear, epochEndYear)
+
+    def compute(stack, years, julians, xoff, yoff, xsize, ysize):
+        if sketch_bins != None:
+            return [lsl.get_trend_streaming(stack, years, julians, startJulian, endJulian, analysisYear, epochLength, annualPercentile, slopeThresh, percentile_method, joint_mask, sketch_range, sketch_bins, (len(indexNames), ysize, xsize))[0]]
+        return [lsl.get_trend(stack, years, julians, startJulian, endJulian, analysisYear, epochLength, annualPercentile, slopeThresh, percentile_method, joint_mask)[0]]
+
+    return run_local_export(images, keep, indexNames, output_folder, [(rawSlopeOutputName, lsl.tdd_scale_factor)], compute, "local_trend", streaming=sketch_bins != None, **kwargs)[0]
+
+
+# Local versions of getZ and getTrend for every period of a season of an analysis year at once
+# Periods start on startJulians and are nDays long (nDays must be a multiple of frequency and startJulians on the frequency grid)
+# Overlapping periods share their sub-windows of frequency days (see local_stats_lib.get_season_z), so each image
+# is read once for the whole season rather than once for each period that covers it
+# Writes the same outputs as run_local_z and run_local_trend for each period (periods that are already done are skipped)
+# Any other keyword arguments (e.g. tree_mask or chunk_size) are passed on to run_local_export
+# Returns the output names
+def run_local_season(
+    images,
+    indexNames,
+    startJulians,
+    nDays,
+    frequency,
+    analysisYear,
+    output_folder,
+    exportAreaName,
+    exportRawZ=True,
+    exportRawSlope=True,
+    zBaselineLength=3,
+    tddEpochLength=5,
+    baselineGap=1,
+    zPercentile=70,
+    tddAnnualPercentile=50,
+    zThresh=-3,
+    slopeThresh=-0.05,
+    ddof=0,
+    percentile_method="linear",
+    joint_mask=True,
+    climatology_folder=None,
+    **kwargs
+):
+    lsl.get_sub_windows(startJulians, nDays, frequency)
+    methods = [m for m, export in [("Z", exportRawZ), ("TDD", exportRawSlope)] if export]
+    scale_factors = {"Z": lsl.z_scale_factor, "TDD": lsl.tdd_scale_factor}
+    raw_names = {(m, jd): lplan.get_raw_name(exportAreaName, m, indexNames, analysisYear, jd, nDays, zBaselineLength, tddEpochLength, baselineGap) for m in methods for jd in startJulians}
+    output_names = [os.path.join(output_folder, raw_names[(m, jd)] + ".tif") for jd in sorted(startJulians) for m in methods]
+
+    # Only run the periods that still need an output
+    pending = sorted(set(jd for (m, jd), name in raw_names.items() if kwargs.get("overwrite", False) or not os.path.exists(os.path.join(output_folder, name + ".tif"))))
+    if len(pending) == 0:
+        print("All outputs of {} periods already exist for: {}".format(len(startJulians), analysisYear))
+        return output_names
+
+    # Only read the observations of the years the methods need within the season
+    read_years = set([analysisYear])
+    climatology_names = None
+    if exportRawZ:
+        baselineStartYear, baselineEndYear = lsl.get_baseline_years(analysisYear, zBaselineLength, baselineGap)
+        if climatology_folder != None:
+            climatology_names = {jd: get_baseline_climatologies(climatology_folder, exportAreaName, indexNames, jd, jd + nDays - 1, baselineStartYear, baselineEndYear) for jd in pending}
+            if any(names == None for names in climatology_names.values()):
+                climatology_names = None
+        if climatology_names == None:
+            read_years.update(range(baselineStartYear, baselineEndYear + 1))
+    if exportRawSlope:
+        epochStartYear, epochEndYear = lsl.get_epoch_years(analysisYear, tddEpochLength)
+        read_years.update(range(epochStartYear, epochEndYear + 1))
+    keep = lsl.filter_dates([i.year for i in images], [i.julian for i in images], pending[0], pending[-1] + nDays - 1) & numpy.isin([i.year for i in images], sorted(read_years))
+
+    def compute(stack, years, julians, xoff, yoff, xsize, ysize):
+        if exportRawZ:
+            baselines = None
+            if climatology_names != None:
+                baselines = {jd: bcl.get_baseline_stats(climatology_names[jd], jd, jd + nDays - 1, xoff, yoff, xsize, ysize, ddof) for jd in pending}
+            z = lsl.get_season_z(stack, years, julians, pending, nDays, frequency, analysisYear, zBaselineLength, baselineGap, zPercentile, zThresh, ddof, percentile_method, baselines)
+        if exportRawSlope:
+            tdd = lsl.get_season_trend(stack, years, julians, pending, nDays, frequency, analysisYear, tddEpochLength, tddAnnualPercentile, slopeThresh, percentile_method, joint_mask)
+        values = []
+        for jd in pending:
+            if exportRawZ:
+                values.append(z[jd][0])
+            if exportRawSlope:
+                values.append(tdd[jd][0])
+        return values
+
+    outputs = [(raw_names[(m, jd)], scale_factors[m]) for jd in pending for m in methods]
+    run_local_export(images, keep, indexNames, output_folder, outputs, compute, "local_season", **kwargs)
+    return output_names
+
+
+####################################################################################################
+# Bring the baseline climatology of a year up to date with a local stack (see baseline_climatology_lib)
+# Bins of bin_days days are made from first_julian through last_julian
+# Bins are only made again if the observations that fall in them have changed (e.g. a year that was still in progress)
+# and the whole climatology is made again if its bin grid or value_scale changed
+# Returns the name of the climatology
+def update_climatology(images, indexNames, year, climatology_folder, exportAreaName, first_julian, last_julian, bin_days=8, chunk_size=512, band_names=None, value_scale=1.0):
+    climatology_name = bcl.get_climatology_name(climatology_folder, exportAreaName, "-".join(indexNames), year)
+    images = [i for i in images if i.year == year]
+    if len(images) == 0:
+        raise ValueError("No stack images found for: {}".format(year))
+
+    info = None
+    if os.path.exists(climatology_name) and os.path.exists(climatology_name + ".json"):
+        info = bcl.read_climatology_info(climatology_name)
+        grid = (info["first_julian"], info["bin_days"], info["value_scale"], info["n_bands"])
+        if grid != (first_julian, bin_days, value_scale, len(indexNames)) or bcl.get_bin_range(info, info["n_bins"] - 1)[1] < last_julian:
+            print("Remaking baseline climatology:", climatology_name)
+            info = None
+
+    if info == None:
+        if not os.path.exists(climatology_folder):
+            os.makedirs(climatology_folder)
+        width, height, projection, geotransform = get_stack_grid(open_stack(images[:1], indexNames, band_names))
+        info = bcl.create_climatology(climatology_name, width, height, len(indexNames), first_julian, last_julian, bin_days, value_scale, projection, geotransform)
+
+    for b in range(info["n_bins"]):
+        bin_start, bin_end = bcl.get_bin_range(info, b)
+        bin_images = [i for i in images if i.julian >= bin_start and i.julian <= bin_end]
+        sources = [os.path.basename(i.path) for i in bin_images]
+        if bcl.has_bin(info, b, sources):
+            continue
+
+        print("Adding julian days {}-{} ({} images) to baseline climatology: {}".format(bin_start, bin_end, len(bin_images), climatology_name))
+        with li.span("climatology", os.path.basename(climatology_name)) as s:
+            cube = bcl.open_climatology(climatology_name, "r+")
+            if len(bin_images) == 0:
+                cube[:, b] = 0
+            else:
+                opened = open_stack(bin_images, indexNames, band_names)
+                if get_stack_grid(opened)[:2] != (info["width"], info["height"]):
+                    raise ValueError("Stack images must be on the grid of: {}".format(climatology_name))
+                for xoff, yoff, xsize, ysize in iter_chunks(info["width"], info["height"], chunk_size):
+                    bcl.write_bin_chunk(cube, b, xoff, yoff, read_stack_chunk(opened, xoff, yoff, xsize, ysize, None, value_scale))
+                opened = None
+            cube.flush()
+            cube = None
+            s.add(pixels=info["width"] * info["height"], n_images=len(bin_images))
+        info = bcl.set_bin_sources(climatology_name, info, b, sources)
+    return climatology_name
+
+
+# Get the climatologies of the baseline years of a window if they can make its baseline
+# Returns None if any year is missing or the window isn't made up of bins that have been made
+def get_baseline_climatologies(climatology_folder, exportAreaName, indexNames, startJulian, endJulian, baselineStartYear, baselineEndYear):
+    climatology_names = [bcl.get_climatology_name(climatology_folder, exportAreaName, "-".join(indexNames), yr) for yr in range(baselineStartYear, baselineEndYear + 1)]
+    for climatology_name in climatology_names:
+        if not os.path.exists(climatology_name + ".json"):
+            print("No baseline climatology for {}, reading the baseline from the stack".format(climatology_name))
+            return None
+        info = bcl.read_climatology_info(climatology_name)
+        bins = bcl.get_window_bins(info, startJulian, endJulian)
+        if bins == None or not all(bcl.has_bin(info, b) for b in bins):
+            print("Julian days {}-{} are not covered by {}, reading the baseline from the stack".format(startJulian, endJulian, climatology_name))
+            return None
+    return climatology_names
+
+
+####################################################################################################
+# Backfill raw exports for every analysis year and period from a local stack
+# Periods start every frequency days from first_julian through last_julian and are nDays long (like operational_lamda)
+# Set exportRawZ or exportRawSlope to False to skip a method
+# If climatology_folder is provided, the baseline climatology of each baseline year is brought up to date first
+# (with bins of frequency days) and every z score period takes its baseline from it
+# If shared_windows is True (and nDays is a multiple of frequency), the periods of each analysis year are run together
+# so overlapping periods share their reads and sub-window sums (see run_local_season)
+# If sketch_bins is provided, each period is run on its own with its percentiles from streaming sketches
+# (see run_local_z and run_local_trend) so no period's observations are ever held all at once
+# Any other keyword arguments (e.g. tree_mask or chunk_size) are passed on to run_local_export
+def backfill(
+    stack_folder,
+    output_folder,
+    exportAreaName,
+    indexNames,
+    analysisYears,
+    first_julian,
+    last_julian,
+    frequency=8,
+    nDays=16,
+    zBaselineLength=3,
+    tddEpochLength=5,
+    baselineGap=1,
+    zPercentile=70,
+    tddAnnualPercentile=50,
+    zThresh=-3,
+    slopeThresh=-0.05,
+    exportRawZ=True,
+    exportRawSlope=True,
+    climatology_folder=None,
+    shared_windows=True,
+    sketch_bins=None,
+    **kwargs
+):
+    images = list_stack(stack_folder)
+    if exportRawZ and climatology_folder != None:
+        climatology_kwargs = {k: kwargs[k] for k in ["chunk_size", "band_names", "value_scale"] if k in kwargs}
+        baseline_years = set()
+        for analysisYear in analysisYears:
+            baselineStartYear, baselineEndYear = lsl.get_baseline_years(analysisYear, zBaselineLength, baselineGap)
+            baseline_years.update(range(baselineStartYear, baselineEndYear + 1))
+        for yr in sorted(baseline_years):
+            update_climatology(images, indexNames, yr, climatology_folder, exportAreaName, first_julian, last_julian + nDays - 1, frequency, **climatology_kwargs)
+
+    outputs = []
+    startJulians = list(range(first_julian, last_julian + 1, frequency))
+    for analysisYear in analysisYears:
+        if shared_windows and sketch_bins == None and nDays % frequency == 0:
+            start = time.time()
+            outputs.extend(
+                run_local_season(
+                    images,
+                    indexNames,
+                    startJulians,
+                    nDays,
+                    frequency,
+                    analysisYear,
+                    output_folder,
+                    exportAreaName,
+                    exportRawZ,
+                    exportRawSlope,
+                    zBaselineLength,
+                    tddEpochLength,
+                    baselineGap,
+                    zPercentile,
+                    tddAnnualPercentile,
+                    zThresh,
+                    slopeThresh,
+                    climatology_folder=climatology_folder,
+                    **kwargs
+                )
+            )
+            print("Finished {} periods of {} in {:.1f} seconds".format(len(startJulians), analysisYear, time.time() - start))
+            continue
+
+        for startJulian in startJulians:
+            endJulian = startJulian + nDays - 1
+            if exportRawZ:
+                start = time.time()
+                outputs.append(run_local_z(images, indexNames, startJulian, endJulian, analysisYear, output_folder, exportAreaName, zBaselineLength, baselineGap, zPercentile, zThresh, climatology_folder=climatology_folder, sketch_bins=sketch_bins, **kwargs))
+                print("Finished {} in {:.1f} seconds".format(outputs[-1], time.time() - start))
+            if exportRawSlope:
+                start = time.time()
+                outputs.append(run_local_trend(images, indexNames, startJulian, endJulian, analysisYear, output_folder, exportAreaName, tddEpochLength, tddAnnualPercentile, slopeThresh, sketch_bins=sketch_bins, **kwargs))
+                print("Finished {} in {:.1f} seconds".format(outputs[-1], time.time() - start))
+    return outputs
+
+
+####################################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill LAMDA raw z score and trend outputs from a local stack of MODIS index rasters")
+    parser.add_argument("stack_folder", help="Folder of MODIS index rasters (on the export grid)")
+    parser.add_argument("output_folder", help="Folder to write the outputs to")
+    parser.add_argument("--area", default="CONUS", help="Export area name used in the output names")
+    parser.add_argument("--indices", nargs="+", default=["NBR", "NDVI"], help="Index names (band descriptions)")
+    parser.add_argument("--years", type=int, nargs="+", required=True, help="Analysis years")
+    parser.add_argument("--first_julian", type=int, default=145)
+    parser.add_argument("--last_julian", type=int, default=273)
+    parser.add_argument("--frequency", type=int, default=8)
+    parser.add_argument("--nDays", type=int, default=16)
+    parser.add_argument("--zBaselineLength", type=int, default=3)
+    parser.add_argument("--tddEpochLength", type=int, default=5)
+    parser.add_argument("--baselineGap", type=int, default=0)
+    parser.add_argument("--zPercentile", type=float, default=50)
+    parser.add_argument("--tddAnnualPercentile", type=float, default=50)
+    parser.add_argument("--zThresh", type=float, default=-2.5)
+    parser.add_argument("--slopeThresh", type=float, default=-0.05)
+    parser.add_argument("--methods", nargs="+", default=["Z", "TDD"], help="Methods to run (Z and/or TDD)")
+    parser.add_argument("--tree_mask", default=None, help="Tree mask raster on the export grid")
+    parser.add_argument("--value_scale", type=float, default=1.0, help="Scale applied to stored index values")
+    parser.add_argument("--per_period", action="store_true", help="Run each period on its own rather than sharing reads across overlapping periods")
+    parser.add_argument("--sketch_bins", type=int, default=None, help="Stream each period and take percentiles from sketches with this many bins (exact if not provided)")
+    parser.add_argument("--climatology_folder", default=None, help="Folder of baseline climatologies to make and take z score baselines from")
+    args = parser.parse_args()
+
+    backfill(
+        args.stack_folder,
+        args.output_folder,
+        args.area,
+        args.indices,
+        args.years,
+        args.first_julian,
+        args.last_julian,
+        args.frequency,
+        args.nDays,
+        args.zBaselineLength,
+        args.tddEpochLength,
+        args.baselineGap,
+        args.zPercentile,
+        args.tddAnnualPercentile,
+        args.zThresh,
+        args.slopeThresh,
+        exportRawZ="Z" in args.methods,
+        exportRawSlope="TDD" in args.methods,
+        climatology_folder=args.climatology_folder,
+        shared_windows=not args.per_period,
+        sketch_bins=args.sketch_bins,
+        tree_mask=args.tree_mask,
+        value_scale=args.value_scale,
+    )
@@ -0,0 +1,255 @@
+"""
+   Copyright 2021 Ian Housman, RedCastle Resources Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Script to plan LAndscape Monitoring and Detection Application (LAMDA) operational runs
+# The full set of products a run should make is built from the run parameters and compared with
+# a single snapshot of everywhere products end up:
+#   the export bucket (raw outputs from GEE) and the GEE exports that are still running
+#   the local folder and its state store
+#   the deliverable bucket
+#   the ingested asset collections
+# Each (area, method, period) unit then lists only the stages it still needs
+# so a run can skip straight to the missing work (or just print the plan)
+#
+# Products are compared by name with any GEE tile suffix and _cog removed
+# so a tiled export or a COG copy counts as the product it came from
+# GEE is never called from here (the running exports and ingested assets are passed in)
+####################################################################################################
+import os, collections
+import LAMDA_products as lp
+import LAMDA_state_store as sl
+import LAMDA_transfer_lib as tl
+
+# Stages a unit can need in the order they run
+# wait is used in place of export when the export is already running
+plan_stages = ["export", "wait", "sync", "post_process", "persistence", "upload", "ingest"]
+
+# A unit of work
+# kind is raw (the raw output and its 8 bit outputs) or persistence (a persistence window)
+# julians are the starting julian days of the periods the unit covers (the window for persistence)
+# raw_names are the names (without extension) of the raw outputs the unit is made from
+# outputs are the names of every product the unit delivers
+# stages are the stages it still needs (see plan_stages)
+PlanUnit = collections.namedtuple("PlanUnit", ["area", "method", "kind", "start_julian", "julians", "raw_names", "outputs", "stages"])
+
+# Snapshot of where products are
+# export_objs and deliverable_objs are dictionaries of product key: list of StorageObject (more than one if GEE tiled the export)
+# local, cog_fixed, and manifest cover the local folder, its state store, and the manifest of what was downloaded
+# running_exports are the names of GEE exports that are ready or running and ingested are the product keys of ingested assets
+Snapshot = collections.namedtuple("Snapshot", ["export_objs", "running_exports", "local", "cog_fixed", "manifest", "deliverable_objs", "ingested"])
+
+
+####################################################################################################
+# Get the key a product is compared by (its name without any tile suffix or _cog)
+def get_product_key(name):
+    p = lp.parse_product_name(name)
+    if p == None:
+        return os.path.basename(name)
+    key = p.name
+    if p.tile != None:
+        key = key.replace(p.tile, "", 1)
+    if p.cog:
+        key = key.replace("_cog" + p.extension, p.extension)
+    return key
+
+
+# Get the name (without extension) of a raw output the same way getZ and getTrend name their exports
+def get_raw_name(area, method, indexNames, year, startJulian, nDays, zBaselineLength, tddEpochLength, baselineGap):
+    endJulian = startJulian + nDays - 1
+    if method == "Z":
+        baselineStartYear = year - baselineGap - zBaselineLength
+        baselineEndYear = year - baselineGap - 1
+        return "{}_LAMDA_Z_{}_bl{}-{}_ay{}_jd{}-{}".format(area, "-".join(indexNames), baselineStartYear, baselineEndYear, year, startJulian, endJulian)
+    return "{}_LAMDA_TDD_{}_yrs{}-{}_jd{}-{}".format(area, "-".join(indexNames), year - tddEpochLength + 1, year, startJulian, endJulian)
+
+
+# Get the persistence windows (consecutive startJulians) the same way the persistence stage does
+def get_persistence_windows(startJulians, persistence_n_periods):
+    startJulians = sorted(startJulians)
+    return [startJulians[i : i + persistence_n_periods] for i in range(len(startJulians) - persistence_n_periods + 1)]
+
+
+####################################################################################################
+# Build every unit a run should make
+# Stages are left empty until the units are compared with a snapshot (see plan_units)
+def get_expected_units(area, indexNames, year, startJulians, nDays, zBaselineLength, tddEpochLength, baselineGap, exportRawZ, exportRawSlope, post_process_dict, persistence_n_periods):
+    keys = {lp.get_method(k): k for k in post_process_dict.keys()}
+    methods = [m for m, export in [("Z", exportRawZ), ("TDD", exportRawSlope)] if export]
+
+    units = []
+    for method in methods:
+        stretch = post_process_dict[keys[method]]["stretch"]
+        raw_names = {jd: get_raw_name(area, method, indexNames, year, jd, nDays, zBaselineLength, tddEpochLength, baselineGap) for jd in startJulians}
+        for jd in sorted(startJulians):
+            name = raw_names[jd]
+            outputs = [name + ".tif", "{}_{}_8bit.tif".format(name, stretch), "{}_{}_8bit.jpg".format(name, stretch)]
+            units.append(PlanUnit(area, method, "raw", jd, (jd,), [name], outputs, []))
+
+        for window_jds in get_persistence_windows(startJulians, persistence_n_periods):
+            name = raw_names[window_jds[-1]].split("_jd")[0] + "_jds{}_persistence".format("-".join([str(jd) for jd in window_jds]))
+            units.append(PlanUnit(area, method, "persistence", window_jds[-1], tuple(window_jds), [raw_names[jd] for jd in window_jds], [name + ".tif", name + ".jpg"], []))
+    return units
+
+
+####################################################################################################
+# Take a snapshot of where the products of the areas are
+# Each bucket is listed once (narrowed to the areas) and the state store is read once
+# running_exports are the names of GEE exports that are ready or running (e.g. from ee.data.getTaskList)
+# ingested are the names of the ingested assets (e.g. the system:index of each asset collection)
+def take_snapshot(areas, local_output_dir, exportBucket, deliverable_output_bucket, running_exports=[], ingested=[]):
+    export_backend = tl.get_backend(exportBucket, is_bucket=True)
+    deliverable_backend = tl.get_backend(deliverable_output_bucket, is_bucket=True)
+
+    export_objs = {}
+    deliverable_objs = {}
+    for area in areas:
+        for obj in export_backend.list("{}_LAMDA_*".format(area)):
+            export_objs.setdefault(get_product_key(obj.name), []).append(obj)
+        for obj in deliverable_backend.list("{}_LAMDA_*".format(area)):
+            deliverable_objs.setdefault(get_product_key(obj.name), []).append(obj)
+
+    local = set(get_product_key(p.name) for p in lp.list_products(local_output_dir))
+    conn = sl.open_state_store(local_output_dir)
+    cog_fixed = set(get_product_key(p) for p in sl.get_done_products(conn, "cog-fixed"))
+    manifest = sl.get_manifest(conn, export_backend.location)
+    conn.close()
+
+    return Snapshot(export_objs, set(running_exports), local, cog_fixed, manifest, deliverable_objs, set(get_product_key(i + ".tif") for i in ingested))
+
+
+# Check whether any export object of a product differs from what was last downloaded
+def _export_changed(snapshot, key):
+    for obj in snapshot.export_objs.get(key, []):
+        entry = snapshot.manifest.get(sl.get_product_key(obj.name))
+        if entry != None and not tl.same_content(obj, tl.StorageObject(obj.name, updated=None, **entry)):
+            return True
+    return False
+
+
+####################################################################################################
+# Compare the expected units with a snapshot and fill in the stages each unit still needs
+# A raw output that changed in the export bucket is post processed and uploaded again
+# along with every persistence window that includes it (the sync removes their old outputs)
+# Returns only the units that need something
+def plan_units(units, snapshot):
+    changed_raws = set(u.raw_names[0] for u in units if u.kind == "raw" and _export_changed(snapshot, u.outputs[0]))
+
+    # Persistence windows that need to be computed need their raw outputs locally
+    needs_raw_local = set()
+    planned = []
+    for u in units:
+        if u.kind != "persistence":
+            continue
+        stages = []
+        changed = any(n in changed_raws for n in u.raw_names)
+        if changed or any(o not in snapshot.local and o not in snapshot.deliverable_objs for o in u.outputs):
+            stages.append("persistence")
+            needs_raw_local.update(u.raw_names)
+        if changed or any(o not in snapshot.deliverable_objs for o in u.outputs):
+            stages.append("upload")
+        if u.outputs[0] not in snapshot.ingested:
+            stages.append("ingest")
+        planned.append(u._replace(stages=stages))
+
+    for u in units:
+        if u.kind != "raw":
+            continue
+        raw, out_8bit, out_jpg = u.outputs
+        raw_name = u.raw_names[0]
+        stages = []
+
+        post_process = any(o not in snapshot.local and o not in snapshot.deliverable_objs for o in [out_8bit, out_jpg])
+        post_process = post_process or (raw not in snapshot.deliverable_objs and raw not in snapshot.cog_fixed)
+        changed = raw_name in changed_raws
+        sync = (raw not in snapshot.local and (post_process or raw not in snapshot.deliverable_objs or raw_name in needs_raw_local)) or changed
+
+        # A raw output that has already been delivered is never exported again
+        # (a persistence window that needs it only gets it if it's still in the export bucket)
+        if sync and raw not in snapshot.export_objs:
+            if raw in snapshot.deliverable_objs:
+                sync = False
+            else:
+                stages.append("wait" if raw_name in snapshot.running_exports else "export")
+        if sync:
+            stages.append("sync")
+        if post_process or changed:
+            stages.append("post_process")
+        if any(o not in snapshot.deliverable_objs for o in u.outputs) or changed:
+            stages.append("upload")
+        if raw not in snapshot.ingested:
+            stages.append("ingest")
+        planned.append(u._replace(stages=stages))
+
+    order = {(u.method, u.kind, u.julians): i for i, u in enumerate(units)}
+    planned = sorted(planned, key=lambda u: (u.area, order[(u.method, u.kind, u.julians)]))
+    return [u for u in planned if len(u.stages) > 0]
+
+
+####################################################################################################
+# Get the raw outputs that need to be exported
+# Returns a dictionary of (exportRawZ, exportRawSlope): startJulians so each set of periods can be run as a single graph
+def get_export_groups(plan):
+    z = set(u.start_julian for u in plan if u.kind == "raw" and u.method == "Z" and "export" in u.stages)
+    tdd = set(u.start_julian for u in plan if u.kind == "raw" and u.method == "TDD" and "export" in u.stages)
+    groups = {(True, True): sorted(z & tdd), (True, False): sorted(z - tdd), (False, True): sorted(tdd - z)}
+    return {k: v for k, v in groups.items() if len(v) > 0}
+
+
+# Get the names (without extension) of the raw outputs that need to be waited on (running exports)
+def get_wait_names(plan):
+    return [u.raw_names[0] for u in plan if "wait" in u.stages]
+
+
+# Get the names (without extension) of the raw outputs the local stages need (every raw unit with local work
+# and every raw output of a persistence window that needs to be computed)
+def get_work_names(plan):
+    names = []
+    for u in plan:
+        if u.kind == "raw" and any(s in u.stages for s in ["sync", "post_process", "upload"]):
+            names.append(u.raw_names[0])
+        elif u.kind == "persistence" and "persistence" in u.stages:
+            names.extend(u.raw_names)
+    return sorted(set(names), key=names.index)
+
+
+# Get the export bucket objects that already exist and need to be synced
+def get_sync_objs(plan, snapshot):
+    return [obj for u in plan if u.kind == "raw" and "sync" in u.stages for obj in snapshot.export_objs.get(u.outputs[0], [])]
+
+
+# Get the names of the deliverable tifs that need to be ingested
+# uploaded_names are the names of tifs uploaded since the snapshot (tifs already in the bucket are taken from the snapshot)
+def get_ingest_names(plan, snapshot, uploaded_names=[]):
+    keys = set(u.outputs[0] for u in plan if "ingest" in u.stages)
+    names = list(uploaded_names) + [obj.name for k in keys for obj in snapshot.deliverable_objs.get(k, [])]
+    products = [lp.parse_product_name(n) for n in names]
+    return sorted(set(p.name for p in products if p != None and not p.cog and get_product_key(p.name) in keys))
+
+
+####################################################################################################
+# Print a plan as a table of units and the stages they need along with the number of units that need each stage
+def print_plan(plan, n_expected=None):
+    header = ["area", "method", "kind", "julians"] + plan_stages
+    print("".join(h.ljust(14) for h in header))
+    for u in plan:
+        row = [u.area, u.method, u.kind, "-".join([str(jd) for jd in u.julians])] + ["x" if s in u.stages else "" for s in plan_stages]
+        print("".join(str(v).ljust(14) for v in row))
+
+    counts = collections.OrderedDict((s, len([u for u in plan if s in u.stages])) for s in plan_stages)
+    if n_expected != None:
+        print("{} of {} units need work".format(len(plan), n_expected))
+    print(", ".join("{}: {}".format(s, n) for s, n in counts.items()))
+    return counts
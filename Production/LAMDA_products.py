@@ -0,0 +1,158 @@
+"""
+   Copyright 2021 Ian Housman, RedCastle Resources Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Script to parse the names of LAndscape Monitoring and Detection Application (LAMDA) products
+# Names are parsed once into records and grouped into an in-memory index so each stage can query it
+# rather than globbing and splitting file names again
+#
+# Product names follow:
+# Raw Z:        {area}_LAMDA_Z_{indices}_bl{baselineStartYear}-{baselineEndYear}_ay{analysisYear}_jd{startJulian}-{endJulian}.tif
+# Raw TDD:      {area}_LAMDA_TDD_{indices}_yrs{epochStartYear}-{analysisYear}_jd{startJulian}-{endJulian}.tif
+# 8 bit:        {raw name}_{stretch}_8bit.tif (and .jpg)
+# Persistence:  {raw name up to _jd}_jds{julian}-{julian}-{julian}_persistence.tif (and .jpg)
+# COG copies:   {name}_cog.tif
+# Persistence masks (kept out of the product listing): .LAMDA_persistence_masks/{raw name}_mask_{scale factor}_{threshold}.tif
+# GEE can split large exports into tiles which adds a -{row offset}-{column offset} suffix to the raw name
+####################################################################################################
+import os, re, glob, collections
+
+product_name_regex = re.compile(
+    r"^(?P<area>.+?)_LAMDA_(?P<method>Z|TDD)_(?P<indices>[^_]+)_"
+    r"(?:bl(?P<baseline_start_year>\d{4})-(?P<baseline_end_year>\d{4})_ay(?P<analysis_year>\d{4})|yrs(?P<epoch_start_year>\d{4})-(?P<epoch_end_year>\d{4}))_"
+    r"(?:jds(?P<julians>\d{1,3}(?:-\d{1,3})*)|jd(?P<start_julian>\d+)-(?P<end_julian>\d+))"
+    r"(?P<tile>-\d{10}-\d{10})?"
+    r"(?:_(?P<stretch>-?[\d.]+)_8bit|(?P<persistence>_persistence))?"
+    r"(?P<cog>_cog)?"
+    r"(?P<extension>\.\w+)$"
+)
+
+# Parsed product name
+# kind is one of raw, 8bit, or persistence
+# year is the analysis year for Z and the last year of the epoch for TDD
+# julians are the starting julian days of each period (only more than one for persistence)
+# start_julian and end_julian are the period the product represents (the last period for persistence)
+LamdaProduct = collections.namedtuple(
+    "LamdaProduct",
+    ["path", "name", "area", "method", "indices", "baseline_start_year", "baseline_end_year", "epoch_start_year", "epoch_end_year", "year", "julians", "start_julian", "end_julian", "tile", "kind", "stretch", "cog", "extension"],
+)
+
+
+####################################################################################################
+# Parse a product path or name
+# Returns None if it isn't a LAMDA product name
+def parse_product_name(path):
+    name = os.path.basename(path)
+    m = product_name_regex.match(name)
+    if m == None:
+        return None
+    g = m.groupdict()
+
+    to_int = lambda v: int(v) if v != None else None
+    if g["julians"] != None:
+        julians = tuple(int(jd) for jd in g["julians"].split("-"))
+        start_julian = julians[-1]
+        end_julian = julians[-1]
+    else:
+        start_julian = int(g["start_julian"])
+        end_julian = int(g["end_julian"])
+        julians = (start_julian,)
+
+    if g["persistence"] != None:
+        kind = "persistence"
+    elif g["stretch"] != None:
+        kind = "8bit"
+    else:
+        kind = "raw"
+
+    return LamdaProduct(
+        path=path,
+        name=name,
+        area=g["area"],
+        method=g["method"],
+        indices=g["indices"],
+        baseline_start_year=to_int(g["baseline_start_year"]),
+        baseline_end_year=to_int(g["baseline_end_year"]),
+        epoch_start_year=to_int(g["epoch_start_year"]),
+        epoch_end_year=to_int(g["epoch_end_year"]),
+        year=to_int(g["analysis_year"]) if g["method"] == "Z" else to_int(g["epoch_end_year"]),
+        julians=julians,
+        start_julian=start_julian,
+        end_julian=end_julian,
+        tile=g["tile"],
+        kind=kind,
+        stretch=g["stretch"],
+        cog=g["cog"] != None,
+        extension=g["extension"],
+    )
+
+
+# Parse a list of paths or names, skipping any that aren't LAMDA products
+def parse_product_names(paths):
+    products = [parse_product_name(p) for p in paths]
+    return [p for p in products if p != None]
+
+
+# List and parse all products in a local folder (a single directory listing)
+def list_products(folder):
+    if not os.path.exists(folder):
+        return []
+    return parse_product_names([os.path.join(folder, f) for f in os.listdir(folder)])
+
+
+####################################################################################################
+# Get the name of the persistence masks of an image saved during fused post processing (see raster_processing_lib.post_process_tif_fused)
+# They are kept in a hidden folder next to the image so they are never listed or uploaded as products
+persistence_mask_folder = ".LAMDA_persistence_masks"
+
+
+def get_persistence_mask_name(in_image, scale_factor, thresh):
+    name = "{}_mask_{}_{}.tif".format(os.path.splitext(os.path.basename(in_image))[0], scale_factor, thresh)
+    return os.path.join(os.path.dirname(in_image), persistence_mask_folder, name)
+
+
+# Get the saved persistence masks of an image for any scale factor and threshold
+def list_persistence_masks(in_image):
+    name = os.path.splitext(os.path.basename(in_image))[0]
+    return glob.glob(os.path.join(glob.escape(os.path.join(os.path.dirname(in_image), persistence_mask_folder)), glob.escape(name) + "_mask_*.tif"))
+
+
+####################################################################################################
+# Group products by (area, method, indices, year, start_julian)
+def build_product_index(products):
+    index = collections.defaultdict(list)
+    for p in products:
+        index[(p.area, p.method, p.indices, p.year, p.start_julian)].append(p)
+    return index
+
+
+# Get products from an index (or list of products) matching the provided fields
+# Fields are any of the LamdaProduct fields (e.g. area="CONUS", method="Z", kind="raw", extension=".tif")
+# Results are sorted by year and start_julian
+def query_products(index, area=None, method=None, indices=None, year=None, start_julian=None, **fields):
+    if isinstance(index, dict):
+        keys = [k for k in index.keys() if (area == None or k[0] == area) and (method == None or k[1] == method) and (indices == None or k[2] == indices) and (year == None or k[3] == year) and (start_julian == None or k[4] == start_julian)]
+        products = [p for k in keys for p in index[k]]
+    else:
+        products = [p for p in index if (area == None or p.area == area) and (method == None or p.method == method) and (indices == None or p.indices == indices) and (year == None or p.year == year) and (start_julian == None or p.start_julian == start_julian)]
+
+    for field, value in fields.items():
+        products = [p for p in products if getattr(p, field) == value]
+    return sorted(products, key=lambda p: (p.year, p.start_julian, p.julians, p.name))
+
+
+# Get the method (Z or TDD) of a post_process_dict key (e.g. _Z_)
+def get_method(post_process_key):
+    return post_process_key.strip("_")
@@ -9,6 +9,9 @@ ee_project = "gtac-lamda"
 ee.Initialize(project=ee_project)
 import geeViz.cloudStorageManagerLib as cml
 import geeViz.assetManagerLib as aml
+import LAMDA_state_store as sl
+import LAMDA_products as lp
+import LAMDA_instrumentation as li
 
 
 session = AuthorizedSession(ee.data.get_persistent_credentials().with_quota_project(ee_project))
@@ -30,14 +33,16 @@ z_persistence_collection = ee_folder + "/z_persistence"
 ###########################################################################################
 # Ingest functions
 def ingest_raw_z(raw_z_tifs):
+    ingested = []
     for raw_z in raw_z_tifs:
         asset_basename = os.path.splitext(raw_z)[0]
         asset_name = f"{z_raw_collection}/{asset_basename}"
 
         print("Ingesting:", raw_z)
-        yr = raw_z.split("_ay")[1].split("_")[0]
-        startDay = raw_z.split("_jd")[1].split("-")[0]
-        endDay = raw_z.split("_jd")[1].split("-")[1].split(".tif")[0]
+        product = lp.parse_product_name(raw_z)
+        yr = product.year
+        startDay = product.start_julian
+        endDay = product.end_julian
         startDate = datetime.datetime.strptime(f"{yr} {startDay}", "%Y %j").strftime("%Y-%m-%dT%H:%M:%SZ")
         endDate = datetime.datetime.strptime(f"{yr} {endDay}", "%Y %j").strftime("%Y-%m-%dT%H:%M:%SZ")
 
@@ -58,19 +63,24 @@ def ingest_raw_z(raw_z_tifs):
         response = session.post(url=import_endpoint, data=json.dumps(request))
 
         pprint(json.loads(response.content))
+        if response.ok:
+            ingested.append(raw_z)
+    return ingested
 
 
 ###########################################
 def ingest_raw_tdd(raw_tdd_tifs):
+    ingested = []
     for raw_tdd in raw_tdd_tifs:
         asset_basename = os.path.splitext(raw_tdd)[0]
         asset_name = f"{tdd_raw_collection}/{asset_basename}"
 
         print("Ingesting:", raw_tdd)
-        yr = raw_tdd.split("_yrs")[1].split("-")[1].split("_")[0]
+        product = lp.parse_product_name(raw_tdd)
+        yr = product.year
         print(yr)
-        startDay = raw_tdd.split("_jd")[1].split("-")[0]
-        endDay = raw_tdd.split("_jd")[1].split("-")[1].split(".tif")[0]
+        startDay = product.start_julian
+        endDay = product.end_julian
         print(startDay, endDay)
         startDate = datetime.datetime.strptime(f"{yr} {startDay}", "%Y %j").strftime("%Y-%m-%dT%H:%M:%SZ")
         endDate = datetime.datetime.strptime(f"{yr} {endDay}", "%Y %j").strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -90,17 +100,22 @@ def ingest_raw_tdd(raw_tdd_tifs):
         response = session.post(url=import_endpoint, data=json.dumps(request))
 
         pprint(json.loads(response.content))
+        if response.ok:
+            ingested.append(raw_tdd)
+    return ingested
 
 
 ###########################################
 def ingest_persistence_z(persistence_z_tifs):
+    ingested = []
     for persistence_z in persistence_z_tifs:
         asset_basename = os.path.splitext(persistence_z)[0]
         asset_name = f"{z_persistence_collection}/{asset_basename}"
 
         print("Ingesting:", persistence_z)
-        yr = persistence_z.split("_ay")[1].split("_")[0]
-        startDay = persistence_z.split("_jds")[1].split("-")[-1].split("_")[0]
+        product = lp.parse_product_name(persistence_z)
+        yr = product.year
+        startDay = product.start_julian
         endDay = startDay
 
         startDate = datetime.datetime.strptime(f"{yr} {startDay}", "%Y %j").strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -123,17 +138,22 @@ def ingest_persistence_z(persistence_z_tifs):
         response = session.post(url=import_endpoint, data=json.dumps(request))
 
         pprint(json.loads(response.content))
+        if response.ok:
+            ingested.append(persistence_z)
+    return ingested
 
 
 ###########################################
 def ingest_persistence_tdd(persistence_tdd_tifs):
+    ingested = []
     for persistence_tdd in persistence_tdd_tifs:
         asset_basename = os.path.splitext(persistence_tdd)[0]
         asset_name = f"{tdd_persistence_collection}/{asset_basename}"
 
         print("Ingesting:", persistence_tdd)
-        yr = persistence_tdd.split("_yrs")[1].split("-")[1].split("_")[0]
-        startDay = persistence_tdd.split("_jds")[1].split("-")[-1].split("_")[0]
+        product = lp.parse_product_name(persistence_tdd)
+        yr = product.year
+        startDay = product.start_julian
         endDay = startDay
 
         startDate = datetime.datetime.strptime(f"{yr} {startDay}", "%Y %j").strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -154,10 +174,36 @@ def ingest_persistence_tdd(persistence_tdd_tifs):
         response = session.post(url=import_endpoint, data=json.dumps(request))
 
         pprint(json.loads(response.content))
+        if response.ok:
+            ingested.append(persistence_tdd)
+    return ingested
 
 
 ###############################################
-def ingest_lamda():
+# Get the names (system:index) of the assets in each collection
+# Returns a dictionary of collection: list of names
+def get_existing_assets():
+    collections = [z_raw_collection, tdd_raw_collection, z_persistence_collection, tdd_persistence_collection]
+    return {c: ee.ImageCollection(c).aggregate_histogram("system:index").keys().getInfo() for c in collections}
+
+
+###############################################
+# Ingests a list of tifs in the bucket (raw and persistence) into the matching collection
+@li.traced("ingest")
+def ingest_products(tifs):
+    products = lp.parse_product_names(tifs)
+    ingested = ingest_raw_z([p.path for p in products if p.kind == "raw" and p.method == "Z"])
+    ingested += ingest_raw_tdd([p.path for p in products if p.kind == "raw" and p.method == "TDD"])
+    ingested += ingest_persistence_z([p.path for p in products if p.kind == "persistence" and p.method == "Z"])
+    ingested += ingest_persistence_tdd([p.path for p in products if p.kind == "persistence" and p.method == "TDD"])
+    return ingested
+
+
+###############################################
+# Ingests all COGs in the bucket that aren't already assets
+# If local_output_dir is provided, ingested products are recorded in its state store
+@li.traced("ingest")
+def ingest_lamda(local_output_dir=None):
 
     # Create the image collections if they don't exist
     aml.create_asset(tdd_raw_collection, ee.data.ASSET_TYPE_IMAGE_COLL)
@@ -166,29 +212,38 @@ def ingest_lamda():
     aml.create_asset(z_persistence_collection, ee.data.ASSET_TYPE_IMAGE_COLL)
 
     # Find existing assets
-    existing_raw_z = ee.ImageCollection(z_raw_collection).aggregate_histogram("system:index").keys().getInfo()
-    existing_raw_tdd = ee.ImageCollection(tdd_raw_collection).aggregate_histogram("system:index").keys().getInfo()
-    existing_persistence_z = ee.ImageCollection(z_persistence_collection).aggregate_histogram("system:index").keys().getInfo()
-    existing_persistence_tdd = ee.ImageCollection(tdd_persistence_collection).aggregate_histogram("system:index").keys().getInfo()
+    existing = get_existing_assets()
+    existing_raw_z = existing[z_raw_collection]
+    existing_raw_tdd = existing[tdd_raw_collection]
+    existing_persistence_z = existing[z_persistence_collection]
+    existing_persistence_tdd = existing[tdd_persistence_collection]
 
     # Filter down cogs from gcs
     all_files = cml.list_files(bucket)
-    tifs = [f for f in all_files if os.path.splitext(f)[1] == ".tif"]
+    products = lp.parse_product_names(all_files)
+    tifs = [p for p in products if p.extension == ".tif" and not p.cog]
 
-    raw_tifs = [t for t in tifs if t.split("_")[-1].find("jd") > -1]
-    persistence_tifs = [t for t in tifs if t.split("_")[-1].find("persistence") > -1]
+    raw_tifs = [p for p in tifs if p.kind == "raw"]
+    persistence_tifs = [p for p in tifs if p.kind == "persistence"]
 
-    raw_z_tifs = [t for t in raw_tifs if t.find("_Z_") > -1 and os.path.splitext(t)[0] not in existing_raw_z]
-    raw_tdd_tifs = [t for t in raw_tifs if t.find("_TDD_") > -1 and os.path.splitext(t)[0] not in existing_raw_tdd]
+    raw_z_tifs = [p.path for p in raw_tifs if p.method == "Z" and os.path.splitext(p.path)[0] not in existing_raw_z]
+    raw_tdd_tifs = [p.path for p in raw_tifs if p.method == "TDD" and os.path.splitext(p.path)[0] not in existing_raw_tdd]
 
-    persistence_z_tifs = [t for t in persistence_tifs if t.find("_Z_") > -1 and os.path.splitext(t)[0] not in existing_persistence_z]
-    persistence_tdd_tifs = [t for t in persistence_tifs if t.find("_TDD_") > -1 and os.path.splitext(t)[0] not in existing_persistence_tdd]
+    persistence_z_tifs = [p.path for p in persistence_tifs if p.method == "Z" and os.path.splitext(p.path)[0] not in existing_persistence_z]
+    persistence_tdd_tifs = [p.path for p in persistence_tifs if p.method == "TDD" and os.path.splitext(p.path)[0] not in existing_persistence_tdd]
 
     print(raw_z_tifs, raw_tdd_tifs, persistence_z_tifs, persistence_tdd_tifs)
-    ingest_raw_z(raw_z_tifs)
-    ingest_raw_tdd(raw_tdd_tifs)
-    ingest_persistence_z(persistence_z_tifs)
-    ingest_persistence_tdd(persistence_tdd_tifs)
+    ingested = ingest_raw_z(raw_z_tifs)
+    ingested += ingest_raw_tdd(raw_tdd_tifs)
+    ingested += ingest_persistence_z(persistence_z_tifs)
+    ingested += ingest_persistence_tdd(persistence_tdd_tifs)
+
+    # Log products that have been ingested
+    if local_output_dir != None:
+        conn = sl.open_state_store(local_output_dir)
+        sl.mark_stages_done(conn, ingested, "ingested")
+        conn.close()
+    return ingested
 
 
 #########################################################################################
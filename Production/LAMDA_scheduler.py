@@ -0,0 +1,230 @@
+"""
+   Copyright 2021 Ian Housman, RedCastle Resources Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Script to schedule the stages of LAndscape Monitoring and Detection Application (LAMDA) operational runs
+# Jobs from all areas share separately sized pools (e.g. cpu for GDAL work, network for transfers, gee for Earth Engine,
+# and wait for jobs that mostly wait on something else, like GEE exports, so they don't hold a slot other work needs)
+# so the number of jobs of each kind running at once is limited across areas rather than per area
+# Each pool runs its ready jobs in priority order (lowest first, ties in the order they were submitted)
+# A job is ready once every job it depends on has finished
+# Workers and callers wait on conditions and events that are set as jobs finish (nothing sleep-polls)
+# GEE exports can only be polled, so a single ExportWatcher thread polls them for every area and sets an event as each finishes
+####################################################################################################
+import heapq, itertools, threading, time, traceback
+
+# Default number of jobs each pool runs at once
+default_pool_sizes = {"cpu": 4, "network": 8, "gee": 2, "wait": 8}
+
+
+####################################################################################################
+# A unit of work run on one of the pools of a Scheduler
+# done is set once the job has finished (ok or not), result holds what the function returned
+# and error holds the exception if it raised one
+class Job:
+    def __init__(self, name, pool, func, args=(), kwargs={}, priority=0, depends_on=[], run_if_failed=False):
+        self.name = name
+        self.pool = pool
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.depends_on = list(depends_on)
+        self.run_if_failed = run_if_failed
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.seconds = None
+        self.n_waiting_on = 0
+        self.dependents = []
+
+    @property
+    def ok(self):
+        return self.done.is_set() and self.error == None
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+####################################################################################################
+# Scheduler with a priority queue and fixed number of worker threads per pool
+# Jobs can be submitted from anywhere, including from inside running jobs
+# (e.g. a sync job submitting a post processing job for each file it brought down)
+# If a job fails, jobs that depend on it are skipped unless run_if_failed is True for them
+class Scheduler:
+    def __init__(self, pool_sizes=default_pool_sizes):
+        self.pool_sizes = dict(pool_sizes)
+        self.lock = threading.Condition()
+        self.queues = {pool: [] for pool in self.pool_sizes.keys()}
+        self.counter = itertools.count()
+        self.n_unfinished = 0
+        self.jobs = []
+        self.closed = False
+
+        self.workers = []
+        for pool, size in self.pool_sizes.items():
+            for i in range(size):
+                worker = threading.Thread(target=self._work, args=(pool,), name="{}_{}".format(pool, i), daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    # Submit a job
+    # priority: lower runs first (e.g. -startJulian runs the most recent period first)
+    # depends_on: jobs that must finish before this one is ready
+    def submit(self, name, pool, func, args=(), kwargs={}, priority=0, depends_on=[], run_if_failed=False):
+        if pool not in self.pool_sizes.keys():
+            raise ValueError("Unknown pool: {}. Must be one of: {}".format(pool, list(self.pool_sizes.keys())))
+
+        job = Job(name, pool, func, args, kwargs, priority, depends_on, run_if_failed)
+        with self.lock:
+            self.jobs.append(job)
+            self.n_unfinished += 1
+            for dependency in job.depends_on:
+                if not dependency.done.is_set():
+                    job.n_waiting_on += 1
+                    dependency.dependents.append(job)
+            if job.n_waiting_on == 0:
+                self._queue(job)
+        return job
+
+    # Wait until every job submitted (including jobs submitted by other jobs) has finished
+    # Returns the list of all jobs
+    def wait(self, timeout=None):
+        with self.lock:
+            self.lock.wait_for(lambda: self.n_unfinished == 0, timeout)
+            return list(self.jobs)
+
+    # Stop the workers once the queues are empty
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+    # Print out how each job went
+    def report(self):
+        for job in self.jobs:
+            state = "ok" if job.ok else ("failed: {}".format(job.error) if job.done.is_set() else "not finished")
+            seconds = "{:.1f} seconds".format(job.seconds) if job.seconds != None else ""
+            print("{} [{}] {} {}".format(job.name, job.pool, state, seconds))
+
+    ################################################################################################
+    # Must hold the lock
+    def _queue(self, job):
+        # Skip jobs that depend on a job that failed
+        failed = [d.name for d in job.depends_on if d.error != None]
+        if len(failed) > 0 and not job.run_if_failed:
+            job.error = "Skipped since {} failed".format(", ".join(failed))
+            self._finish(job)
+            return
+        heapq.heappush(self.queues[job.pool], (job.priority, next(self.counter), job))
+        self.lock.notify_all()
+
+    # Must hold the lock
+    def _finish(self, job):
+        job.done.set()
+        self.n_unfinished -= 1
+        for dependent in job.dependents:
+            dependent.n_waiting_on -= 1
+            if dependent.n_waiting_on == 0:
+                self._queue(dependent)
+        self.lock.notify_all()
+
+    def _work(self, pool):
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: len(self.queues[pool]) > 0 or self.closed)
+                if len(self.queues[pool]) == 0:
+                    return
+                priority, count, job = heapq.heappop(self.queues[pool])
+
+            print("Starting {} [{}]".format(job.name, job.pool))
+            start = time.time()
+            try:
+                job.result = job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                traceback.print_exc()
+                job.error = e
+            job.seconds = time.time() - start
+
+            with self.lock:
+                self._finish(job)
+
+
+####################################################################################################
+# Watch GEE exports for every area from a single thread
+# get_states returns a dictionary of export name: state for every export (e.g. from ee.data.getTaskList)
+# and is called once per poll for all the exports being waited on rather than once per area
+# Jobs waiting on exports block on an event per export that is set once it finishes, so they don't poll themselves
+# Any state other than those in unfinished_states counts as finished (e.g. COMPLETED, FAILED, CANCELLED)
+# An export that isn't in the states (e.g. never started since its output already existed) counts as finished with a state of None
+class ExportWatcher:
+    unfinished_states = ["UNSUBMITTED", "READY", "RUNNING"]
+
+    def __init__(self, get_states, poll_seconds=30):
+        self.get_states = get_states
+        self.poll_seconds = poll_seconds
+        self.lock = threading.Condition()
+        self.watching = {}
+        self.states = {}
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._watch, name="export_watcher", daemon=True)
+        self.thread.start()
+
+    # Wait until every named export has finished
+    # Returns a dictionary of export name: final state
+    def wait(self, names, timeout=None):
+        events = []
+        with self.lock:
+            for name in names:
+                if name not in self.states:
+                    events.append(self.watching.setdefault(name, threading.Event()))
+            self.lock.notify_all()
+
+        deadline = time.time() + timeout if timeout != None else None
+        for event in events:
+            if not event.wait(None if deadline == None else max(deadline - time.time(), 0)):
+                break
+        with self.lock:
+            return {name: self.states[name] for name in names if name in self.states}
+
+    # Stop polling
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+    def _watch(self):
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: len(self.watching) > 0 or self.closed)
+                if self.closed:
+                    return
+
+            try:
+                states = self.get_states()
+            except Exception as e:
+                print("Failed to get export states:", e)
+                states = None
+
+            with self.lock:
+                if states != None:
+                    for name in list(self.watching.keys()):
+                        if states.get(name) not in self.unfinished_states:
+                            self.states[name] = states.get(name)
+                            self.watching.pop(name).set()
+                    if len(self.watching) > 0:
+                        print("Waiting on {} exports".format(len(self.watching)))
+                self.lock.wait_for(lambda: self.closed, self.poll_seconds)
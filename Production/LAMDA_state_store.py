@@ -0,0 +1,174 @@
+"""
+   Copyright 2021 Ian Housman, RedCastle Resources Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Script to track the progress of the LAndscape Monitoring and Detection Application (LAMDA) local processing
+# Progress is kept in an embedded SQLite database in the local output folder
+# Each product (keyed by its file name so local and cloud copies share state) records which stages are done
+# along with a fingerprint of the file when the stage finished
+# Every update is its own transaction so a crash never loses finished work
+#
+# A manifest of the remote objects that have been downloaded (size and checksums) is also kept
+# so changed objects can be found without downloading them again
+####################################################################################################
+import os, sqlite3, time
+
+# Stages tracked for each product
+stages = ["synced", "cog-fixed", "8-bit", "jpg", "persistence", "uploaded", "ingested"]
+
+state_store_name = ".LAMDA_STATE.sqlite"
+
+
+####################################################################################################
+# Get the path of the state store for a local output folder
+def get_state_store_path(local_output_dir):
+    return os.path.join(local_output_dir, state_store_name)
+
+
+# Open (and create if needed) the state store for a local output folder
+def open_state_store(local_output_dir):
+    if not os.path.exists(local_output_dir):
+        os.makedirs(local_output_dir)
+
+    # Several areas can run at once, so wait on locks rather than failing
+    conn = sqlite3.connect(get_state_store_path(local_output_dir), timeout=120)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS product_stages (product TEXT NOT NULL, stage TEXT NOT NULL, fingerprint TEXT, updated REAL, PRIMARY KEY (product, stage))")
+    conn.execute("CREATE INDEX IF NOT EXISTS product_stages_stage ON product_stages (stage)")
+    migrate_remote_manifest(conn)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS remote_manifest (product TEXT NOT NULL, location TEXT NOT NULL, size INTEGER, crc32c TEXT, md5 TEXT, generation TEXT, updated REAL, PRIMARY KEY (product, location))"
+    )
+    conn.commit()
+    return conn
+
+
+# State stores made before the manifest was keyed by location too (a product name was only kept for a single location)
+# have their manifest rebuilt with the (product, location) key
+def migrate_remote_manifest(conn):
+    keys = [row[1] for row in conn.execute("PRAGMA table_info(remote_manifest)") if row[5] > 0]
+    if keys != ["product"]:
+        return
+    with conn:
+        conn.execute("ALTER TABLE remote_manifest RENAME TO remote_manifest_old")
+        conn.execute(
+            "CREATE TABLE remote_manifest (product TEXT NOT NULL, location TEXT NOT NULL, size INTEGER, crc32c TEXT, md5 TEXT, generation TEXT, updated REAL, PRIMARY KEY (product, location))"
+        )
+        conn.execute("INSERT INTO remote_manifest SELECT product, COALESCE(location, ''), size, crc32c, md5, generation, updated FROM remote_manifest_old")
+        conn.execute("DROP TABLE remote_manifest_old")
+
+
+####################################################################################################
+# Products are keyed by file name
+def get_product_key(path):
+    return os.path.basename(path)
+
+
+# Cheap fingerprint of a file's content (size and modification time)
+def get_fingerprint(path):
+    if not os.path.exists(path):
+        return None
+    stats = os.stat(path)
+    return "{}-{}".format(stats.st_size, stats.st_mtime_ns)
+
+
+####################################################################################################
+# Check whether a stage is done for a product
+# If a fingerprint is provided, it must match the one recorded when the stage finished
+# (a stage recorded without a fingerprint can't be matched, so it counts as stale)
+def is_stage_done(conn, path, stage, fingerprint=None):
+    row = conn.execute("SELECT fingerprint FROM product_stages WHERE product = ? AND stage = ?", (get_product_key(path), stage)).fetchone()
+    if row == None:
+        return False
+    return fingerprint == None or row[0] == fingerprint
+
+
+# Record that a stage is done for a product (committed immediately)
+def mark_stage_done(conn, path, stage, fingerprint=None):
+    if stage not in stages:
+        raise ValueError("Unknown stage: {}. Must be one of: {}".format(stage, stages))
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO product_stages (product, stage, fingerprint, updated) VALUES (?, ?, ?, ?)", (get_product_key(path), stage, fingerprint, time.time()))
+
+
+# Record that a stage is done for many products in a single transaction
+def mark_stages_done(conn, paths, stage, fingerprints=None):
+    if stage not in stages:
+        raise ValueError("Unknown stage: {}. Must be one of: {}".format(stage, stages))
+    if fingerprints == None:
+        fingerprints = [None] * len(paths)
+    now = time.time()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO product_stages (product, stage, fingerprint, updated) VALUES (?, ?, ?, ?)", [(get_product_key(p), stage, f, now) for p, f in zip(paths, fingerprints)])
+
+
+# Forget a stage (or all stages if stage is None) for a product so it gets redone
+def clear_stage(conn, path, stage=None):
+    with conn:
+        if stage == None:
+            conn.execute("DELETE FROM product_stages WHERE product = ?", (get_product_key(path),))
+        else:
+            conn.execute("DELETE FROM product_stages WHERE product = ? AND stage = ?", (get_product_key(path), stage))
+
+
+# Forget every stage of a product except the stages in keep
+# (e.g. keeping uploaded so a remade file is known to need uploading over its old copy)
+def clear_stages(conn, path, keep=()):
+    with conn:
+        conn.execute("DELETE FROM product_stages WHERE product = ? AND stage NOT IN ({})".format(",".join("?" * len(keep))), (get_product_key(path),) + tuple(keep))
+
+
+# Get the set of products a stage is done for
+def get_done_products(conn, stage):
+    return set(row[0] for row in conn.execute("SELECT product FROM product_stages WHERE stage = ?", (stage,)))
+
+
+####################################################################################################
+# Bring in progress from a legacy comma delimited done file (e.g. .CONUS_POST_PROCESS_DONE)
+# Each product is fingerprinted as it is now in the folder of the done file
+# so a file that changes after the import is processed again
+# Existing entries are kept
+def import_done_file(conn, done_file, stage):
+    if not os.path.exists(done_file):
+        return
+    o = open(done_file)
+    paths = [p for p in o.read().split(",") if p != ""]
+    o.close()
+    folder = os.path.dirname(done_file)
+    now = time.time()
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO product_stages (product, stage, fingerprint, updated) VALUES (?, ?, ?, ?)",
+            [(get_product_key(p), stage, get_fingerprint(os.path.join(folder, get_product_key(p))), now) for p in paths],
+        )
+
+
+####################################################################################################
+# Get the manifest of remote objects downloaded from a location (e.g. gs://lamda-raw-outputs)
+# Returns a dictionary of product: {size, crc32c, md5, generation}
+def get_manifest(conn, location):
+    rows = conn.execute("SELECT product, size, crc32c, md5, generation FROM remote_manifest WHERE location = ?", (location,))
+    return {row[0]: {"size": row[1], "crc32c": row[2], "md5": row[3], "generation": row[4]} for row in rows}
+
+
+# Record remote objects (anything with name, size, crc32c, md5, and generation) in the manifest in a single transaction
+def update_manifest(conn, objs, location):
+    now = time.time()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO remote_manifest (product, location, size, crc32c, md5, generation, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(get_product_key(o.name), location, o.size, o.crc32c, o.md5, str(o.generation) if o.generation != None else None, now) for o in objs],
+        )
@@ -0,0 +1,388 @@
+"""
+   Copyright 2021 Ian Housman, RedCastle Resources Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Script to move LAndscape Monitoring and Detection Application (LAMDA) outputs between storage locations
+# Transfers run in-process on a bounded pool of threads rather than through gsutil subprocesses
+# Each location is a storage backend (GCS bucket or local folder) so transfers can be run and checked offline
+# A callback is called for each file as soon as it lands so downstream work doesn't have to wait on the whole batch
+#
+# Files are written to a .part file and renamed once complete so a partial file is never picked up
+# Large GCS objects are split into chunks that are transferred concurrently
+# Syncs and uploads of a local output folder are tracked in its state store (see sync_tracked and upload_tracked)
+####################################################################################################
+import os, shutil, fnmatch, time, base64, hashlib, collections, concurrent.futures
+import LAMDA_state_store as sl
+import LAMDA_products as lp
+
+# Objects larger than this are transferred in concurrent chunks (GCS only)
+chunked_transfer_threshold_mb = 256
+chunk_size_mb = 64
+chunk_n_workers = 8
+
+# Object listed from a backend
+# name is relative to the backend root (e.g. the blob name)
+# crc32c and md5 are base64 encoded as GCS reports them (None if not available)
+StorageObject = collections.namedtuple("StorageObject", ["name", "size", "updated", "crc32c", "md5", "generation"])
+
+# Result of a single transfer
+# ok is False if the transfer failed (error holds the message) or was skipped (skipped is True)
+# obj is the StorageObject that was downloaded (None for uploads)
+TransferResult = collections.namedtuple("TransferResult", ["name", "local_path", "size", "seconds", "ok", "skipped", "error", "obj"])
+
+
+####################################################################################################
+# Get the base64 encoded md5 of a local file (the same encoding GCS uses)
+def get_md5(path, chunk_size=8 * 1024 * 1024):
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return base64.b64encode(h.digest()).decode()
+
+
+# Check whether two listings of an object have the same content
+# The strongest check both have is used (crc32c, then md5, then size and generation)
+def same_content(a, b):
+    if a.size != b.size:
+        return False
+    if a.crc32c != None and b.crc32c != None:
+        return a.crc32c == b.crc32c
+    if a.md5 != None and b.md5 != None:
+        return a.md5 == b.md5
+    # Generations are stored as text in the state store manifest
+    return a.generation != None and b.generation != None and str(a.generation) == str(b.generation)
+
+
+####################################################################################################
+# Local folder storage backend
+# Listings use the size and modification time of each file (the same fingerprint the state store uses)
+# as its generation rather than hashing every file, unless checksums is True
+class LocalBackend:
+    def __init__(self, root, checksums=False):
+        self.root = os.path.abspath(root)
+        self.location = self.root
+        self.checksums = checksums
+
+    def _path(self, name):
+        return os.path.join(self.root, *name.split("/"))
+
+    # List objects whose name matches a glob-style pattern (e.g. *CONUS_LAMDA*)
+    # The modification time stands in for the generation (the md5 is only computed if checksums is True)
+    def list(self, pattern="*"):
+        out = []
+        if not os.path.exists(self.root):
+            return out
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            rel_dir = os.path.relpath(dirpath, self.root).replace(os.sep, "/")
+            for f in filenames:
+                name = f if rel_dir == "." else rel_dir + "/" + f
+                if fnmatch.fnmatchcase(name, pattern) and not name.endswith(".part"):
+                    stats = os.stat(os.path.join(dirpath, f))
+                    md5 = get_md5(os.path.join(dirpath, f)) if self.checksums else None
+                    out.append(StorageObject(name, stats.st_size, stats.st_mtime, None, md5, stats.st_mtime_ns))
+        return sorted(out)
+
+    def exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def download(self, name, local_path):
+        shutil.copyfile(self._path(name), local_path)
+
+    def upload(self, local_path, name):
+        path = self._path(name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(local_path, path + ".part")
+        os.replace(path + ".part", path)
+
+
+####################################################################################################
+# Google Cloud Storage bucket storage backend
+# Requires the google-cloud-storage package
+class GCSBackend:
+    def __init__(self, bucket, project=None, client=None):
+        from google.cloud import storage
+
+        self.client = client if client != None else storage.Client(project=project)
+        self.bucket = self.client.bucket(bucket)
+        self.location = "gs://{}".format(bucket)
+
+    # List objects whose name matches a glob-style pattern (e.g. *CONUS_LAMDA*)
+    # Only the part before the first wildcard is used to narrow the listing server-side
+    def list(self, pattern="*"):
+        prefix = pattern
+        for c in "*?[":
+            prefix = prefix.split(c)[0]
+        blobs = self.client.list_blobs(self.bucket, prefix=prefix if prefix != "" else None)
+        out = [StorageObject(b.name, b.size, b.updated.timestamp() if b.updated != None else None, b.crc32c, b.md5_hash, b.generation) for b in blobs if fnmatch.fnmatchcase(b.name, pattern) and not b.name.endswith("/")]
+        return sorted(out)
+
+    def exists(self, name):
+        return self.bucket.blob(name).exists()
+
+    def download(self, name, local_path):
+        blob = self.bucket.blob(name)
+        blob.reload()
+        if blob.size != None and blob.size > chunked_transfer_threshold_mb * 1024 * 1024:
+            from google.cloud.storage import transfer_manager
+
+            transfer_manager.download_chunks_concurrently(blob, local_path, chunk_size=chunk_size_mb * 1024 * 1024, max_workers=chunk_n_workers, worker_type=transfer_manager.THREAD)
+        else:
+            blob.download_to_filename(local_path)
+
+    def upload(self, local_path, name):
+        blob = self.bucket.blob(name)
+        if os.path.getsize(local_path) > chunked_transfer_threshold_mb * 1024 * 1024:
+            from google.cloud.storage import transfer_manager
+
+            transfer_manager.upload_chunks_concurrently(local_path, blob, chunk_size=chunk_size_mb * 1024 * 1024, max_workers=chunk_n_workers, worker_type=transfer_manager.THREAD)
+        else:
+            blob.upload_from_filename(local_path)
+
+
+####################################################################################################
+# Get the storage backend for a location
+# gs://bucket (or a bare bucket name if is_bucket) is a GCS bucket, anything else is a local folder
+def get_backend(location, is_bucket=False, project=None):
+    if location.startswith("gs://"):
+        return GCSBackend(location[len("gs://") :].strip("/"), project=project)
+    elif is_bucket:
+        return GCSBackend(location, project=project)
+    return LocalBackend(location)
+
+
+####################################################################################################
+# Run transfer functions on a pool of threads
+# on_complete is called with each TransferResult from the calling thread as soon as that transfer finishes
+def _run_transfers(transfers, n_workers, on_complete):
+    results = []
+    if len(transfers) == 0:
+        return results
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, n_workers)) as pool:
+        futures = [pool.submit(fn, *args) for fn, args in transfers]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            if result.ok:
+                print("Transferred: {} ({:.1f} MB in {:.1f} seconds)".format(result.name, result.size / 1024.0 / 1024.0, result.seconds))
+            elif result.error != None:
+                print("Failed to transfer: {} {}".format(result.name, result.error))
+            results.append(result)
+            if on_complete != None:
+                on_complete(result)
+    return results
+
+
+def _download_one(backend, obj, local_path):
+    start = time.time()
+    part = local_path + ".part"
+    try:
+        backend.download(obj.name, part)
+        os.replace(part, local_path)
+        return TransferResult(obj.name, local_path, os.path.getsize(local_path), time.time() - start, True, False, None, obj)
+    except Exception as e:
+        if os.path.exists(part):
+            os.remove(part)
+        return TransferResult(obj.name, local_path, 0, time.time() - start, False, False, str(e), obj)
+
+
+def _upload_one(backend, local_path, name):
+    start = time.time()
+    try:
+        backend.upload(local_path, name)
+        return TransferResult(name, local_path, os.path.getsize(local_path), time.time() - start, True, False, None, None)
+    except Exception as e:
+        return TransferResult(name, local_path, 0, time.time() - start, False, False, str(e), None)
+
+
+####################################################################################################
+# Download all objects from a backend matching any of the patterns into a local folder
+# Objects are saved under their base name
+# Objects that already exist locally are skipped unless overwrite is True
+# If is_unchanged is provided (a function of the StorageObject and local path), existing local files
+# are only skipped if it returns True (e.g. checking the object against a manifest of what was downloaded)
+# Objects that have already been listed (e.g. from a snapshot of the backend) can be provided as listed_objs
+# Returns a list of TransferResult (skipped files included)
+def download_files(backend, patterns, local_folder, n_workers=8, on_complete=None, overwrite=False, is_unchanged=None, listed_objs=None):
+    if not os.path.exists(local_folder):
+        os.makedirs(local_folder)
+
+    objs = {obj.name: obj for obj in (listed_objs or [])}
+    for pattern in patterns:
+        for obj in backend.list(pattern):
+            objs[obj.name] = obj
+
+    transfers = []
+    skipped = []
+    for name in sorted(objs.keys()):
+        local_path = os.path.join(local_folder, os.path.basename(name))
+        if not overwrite and os.path.exists(local_path) and (is_unchanged == None or is_unchanged(objs[name], local_path)):
+            skipped.append(TransferResult(name, local_path, objs[name].size, 0, False, True, None, objs[name]))
+        else:
+            transfers.append((_download_one, (backend, objs[name], local_path)))
+
+    print("Downloading {} files from {} ({} unchanged)".format(len(transfers), backend.location, len(skipped)))
+    return skipped + _run_transfers(transfers, n_workers, on_complete)
+
+
+# Upload local files to a backend
+# Files are saved under their base name with an optional prefix (folder) in front
+# Files that already exist in the backend are skipped unless overwrite is True
+# Returns a list of TransferResult (skipped files included)
+def upload_files(backend, local_paths, prefix="", n_workers=8, on_complete=None, overwrite=False):
+    # List what already exists with a single listing narrowed to the names being uploaded
+    existing = set()
+    if not overwrite and len(local_paths) > 0:
+        common = os.path.commonprefix([os.path.basename(p) for p in local_paths])
+        existing = set(obj.name for obj in backend.list(prefix + common.replace("[", "[[]") + "*"))
+
+    transfers = []
+    skipped = []
+    for local_path in sorted(local_paths):
+        name = prefix + os.path.basename(local_path)
+        if name in existing:
+            skipped.append(TransferResult(name, local_path, os.path.getsize(local_path), 0, False, True, None, None))
+        else:
+            transfers.append((_upload_one, (backend, local_path, name)))
+
+    print("Uploading {} files to {} ({} already exist)".format(len(transfers), backend.location, len(skipped)))
+    return skipped + _run_transfers(transfers, n_workers, on_complete)
+
+
+####################################################################################################
+# Download objects from a backend into a local output folder, tracking them in its state store
+# Only objects that are new or whose size or checksum (CRC32C/MD5) differ from the manifest of what was downloaded are downloaded
+# Local files without a manifest entry (e.g. synced before the manifest existed) are only kept if they are
+# the same size as the object (and have the same md5 if the object has one), and are then added to the manifest
+# A local file that is downloaded again has its stages cleared and every output made from it removed (see remove_derived_outputs)
+# so it is processed again (its uploaded and ingested stages are kept so the new outputs are uploaded over the old ones)
+# Synced raw tifs are recorded in the state store as each one lands and passed on to on_complete
+# Returns a list of TransferResult (skipped files included)
+def sync_tracked(conn, backend, patterns, local_folder, n_workers=8, on_complete=None, listed_objs=None):
+    manifest = sl.get_manifest(conn, backend.location)
+    changed = set()
+
+    # Compare each remote object that is already here with what was downloaded
+    def is_unchanged(obj, local_path):
+        entry = manifest.get(sl.get_product_key(obj.name))
+        if entry != None:
+            unchanged = same_content(obj, StorageObject(obj.name, updated=None, **entry))
+        else:
+            unchanged = os.path.getsize(local_path) == obj.size and (obj.md5 == None or get_md5(local_path) == obj.md5)
+        if not unchanged:
+            changed.add(obj.name)
+        return unchanged
+
+    def synced(result):
+        if result.ok:
+            if result.obj.name in changed:
+                print("Re-synced changed object:", result.obj.name)
+                sl.clear_stages(conn, result.local_path, keep=["uploaded", "ingested"])
+                remove_derived_outputs(conn, result.local_path)
+            sl.update_manifest(conn, [result.obj], backend.location)
+            if is_raw_tif(result.local_path):
+                sl.mark_stage_done(conn, result.local_path, "synced", sl.get_fingerprint(result.local_path))
+        if on_complete != None:
+            on_complete(result)
+
+    results = download_files(backend, patterns, local_folder, n_workers, synced, is_unchanged=is_unchanged, listed_objs=listed_objs)
+
+    # Add files synced before the manifest existed
+    sl.update_manifest(conn, [r.obj for r in results if r.skipped and sl.get_product_key(r.obj.name) not in manifest], backend.location)
+    return results
+
+
+# Check whether a local file is a raw output (not an 8 bit or persistence output)
+def is_raw_tif(path):
+    return os.path.splitext(path)[1] == ".tif" and path.find("8bit") == -1 and path.find("_persistence") == -1
+
+
+# Remove the outputs made from a raw tif so they are made again (e.g. after it is re-synced)
+# This is its 8 bit tif and jpg, every persistence window (tif and jpg) that includes its period, and its saved persistence masks
+# Every stage of each is forgotten except uploaded so the remade outputs are uploaded over the old ones
+# Returns the removed paths
+def remove_derived_outputs(conn, tif):
+    raw = lp.parse_product_name(tif)
+    if raw == None:
+        return []
+    group = (raw.area, raw.method, raw.indices, raw.year, raw.tile)
+    products = lp.list_products(os.path.dirname(tif))
+    derived = [p.path for p in products if p.kind in ["8bit", "persistence"] and (p.area, p.method, p.indices, p.year, p.tile) == group and raw.start_julian in p.julians]
+    derived += lp.list_persistence_masks(tif)
+    for path in derived:
+        print("Removing output of changed raw tif:", path)
+        os.remove(path)
+        sl.clear_stages(conn, path, keep=["uploaded"])
+    return derived
+
+
+# Upload local files to a backend and record each upload in the local state store
+# Files already uploaded with their current fingerprint are skipped without listing the bucket
+# Files that changed since they were uploaded (e.g. remade from a re-synced raw tif) are uploaded over the old copy
+# Any other file is only uploaded if it isn't in the bucket yet
+# Returns a list of TransferResult (skipped files included)
+def upload_tracked(conn, backend, paths, n_workers=8, on_complete=None):
+    done = []
+    changed = []
+    new = []
+    for path in paths:
+        if sl.is_stage_done(conn, path, "uploaded", sl.get_fingerprint(path)):
+            done.append(TransferResult(os.path.basename(path), path, os.path.getsize(path), 0, False, True, None, None))
+        elif sl.is_stage_done(conn, path, "uploaded"):
+            changed.append(path)
+        else:
+            new.append(path)
+
+    def uploaded(result):
+        if result.ok:
+            sl.mark_stage_done(conn, result.local_path, "uploaded", sl.get_fingerprint(result.local_path))
+        if on_complete != None:
+            on_complete(result)
+
+    if len(changed) > 0:
+        print("Uploading {} changed files over their old copies".format(len(changed)))
+    results = upload_files(backend, changed, "", n_workers, uploaded, overwrite=True)
+    results += upload_files(backend, new, "", n_workers, uploaded)
+
+    # Files already in the bucket aren't transferred (so never reach uploaded) but are recorded too
+    skipped = [r.local_path for r in results if r.skipped]
+    sl.mark_stages_done(conn, skipped, "uploaded", [sl.get_fingerprint(path) for path in skipped])
+    return done + results
+
+
+####################################################################################################
+# Summarize a list of TransferResult
+# Returns a dictionary of the number of files and bytes transferred, skipped, and failed
+def summarize_transfers(results, print_summary=True):
+    summary = {"n_transferred": 0, "bytes_transferred": 0, "n_skipped": 0, "bytes_skipped": 0, "n_failed": 0, "seconds": 0}
+    for r in results:
+        if r.ok:
+            summary["n_transferred"] += 1
+            summary["bytes_transferred"] += r.size
+            summary["seconds"] += r.seconds
+        elif r.skipped:
+            summary["n_skipped"] += 1
+            summary["bytes_skipped"] += r.size if r.size != None else 0
+        else:
+            summary["n_failed"] += 1
+
+    if print_summary:
+        print(
+            "Transferred {} files ({:.1f} MB), skipped {} unchanged files ({:.1f} MB), {} failed".format(
+                summary["n_transferred"], summary["bytes_transferred"] / 1024.0 / 1024.0, summary["n_skipped"], summary["bytes_skipped"] / 1024.0 / 1024.0, summary["n_failed"]
+            )
+        )
+    return summary
@@ -0,0 +1,157 @@
+"""
+   Copyright 2021 Ian Housman, RedCastle Resources Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Script to keep a per-pixel baseline climatology of the index stacks of the local LAndscape Monitoring and Detection Application (LAMDA) engine
+# A climatology covers a single area, indices, and year
+# The season is split into julian day bins (first_julian + bin * bin_days) and each bin holds the per-pixel
+# sum, sum of squares, and count of the year's observations that fall in it for each index
+#
+# The baseline mean and standard deviation getZ needs for any window on the bin grid and any baseline years
+# are then put together by adding up a few bins, so z for a new period only needs a pass over its analysis year
+#
+# A climatology is stored as a .npy (memory mapped) of shape (3, n_bins, bands, height, width)
+# with a .json sidecar of its bin grid, georeferencing, and the observations each bin was made from
+# Sums are accumulated in float64 and stored as float32 (or dtype) to keep the cube small
+####################################################################################################
+import os, json
+import numpy
+import local_stats_lib as lsl
+
+sum_plane = 0
+sum_sq_plane = 1
+count_plane = 2
+
+
+####################################################################################################
+# Get the name of the climatology of an area, indices, and year
+def get_climatology_name(folder, area, indices, year):
+    return os.path.join(folder, "{}_LAMDA_climatology_{}_{}.npy".format(area, indices, year))
+
+
+# Create an empty climatology
+# Bins of bin_days days are made from first_julian through last_julian
+# value_scale is recorded so a climatology is never mixed with values on a different scale
+def create_climatology(climatology_name, width, height, n_bands, first_julian, last_julian, bin_days, value_scale=1.0, projection="", geotransform=None, dtype="float32"):
+    n_bins = (last_julian - first_julian) // bin_days + 1
+    cube = numpy.lib.format.open_memmap(climatology_name, mode="w+", dtype=dtype, shape=(3, n_bins, n_bands, height, width))
+    cube.flush()
+    cube = None
+
+    info = {
+        "width": width,
+        "height": height,
+        "n_bands": n_bands,
+        "n_bins": n_bins,
+        "first_julian": first_julian,
+        "bin_days": bin_days,
+        "value_scale": value_scale,
+        "projection": projection,
+        "geotransform": list(geotransform) if geotransform != None else None,
+        "bins": {},
+    }
+    write_climatology_info(climatology_name, info)
+    return info
+
+
+def read_climatology_info(climatology_name):
+    o = open(climatology_name + ".json")
+    info = json.load(o)
+    o.close()
+    return info
+
+
+def write_climatology_info(climatology_name, info):
+    o = open(climatology_name + ".json", "w")
+    json.dump(info, o, indent=1)
+    o.close()
+
+
+# Open the cube of a climatology (memory mapped)
+def open_climatology(climatology_name, mode="r"):
+    return numpy.load(climatology_name, mmap_mode=mode)
+
+
+####################################################################################################
+# Get the julian day range (inclusive) of a bin
+def get_bin_range(info, b):
+    start = info["first_julian"] + b * info["bin_days"]
+    return start, start + info["bin_days"] - 1
+
+
+# Get the bins that make up a julian day window (inclusive)
+# Returns None if the window doesn't start and end on the bin grid (or wraps around the end of the year)
+# A window that runs past the end of the year (e.g. 361-376) only needs the bins through day 366
+def get_window_bins(info, startJulian, endJulian):
+    endJulian = min(endJulian, 366)
+    start_offset = startJulian - info["first_julian"]
+    end_offset = endJulian - info["first_julian"] + 1
+    if startJulian > endJulian or start_offset < 0 or start_offset % info["bin_days"] != 0:
+        return None
+    if end_offset % info["bin_days"] != 0 and endJulian != 366:
+        return None
+    end_bin = -(-end_offset // info["bin_days"])
+    if end_bin > info["n_bins"]:
+        return None
+    return list(range(start_offset // info["bin_days"], end_bin))
+
+
+# Check whether a bin has been made (from the same observations if sources is provided)
+def has_bin(info, b, sources=None):
+    if str(b) not in info["bins"]:
+        return False
+    return sources == None or info["bins"][str(b)] == list(sources)
+
+
+####################################################################################################
+# Write the sums of a chunk of a bin from the observations of the chunk that fall in it
+def write_bin_chunk(cube, b, xoff, yoff, stack):
+    ysize, xsize = stack.shape[-2:]
+    for plane, values in zip([sum_plane, sum_sq_plane, count_plane], lsl.get_sums(stack)):
+        cube[plane, b, :, yoff : yoff + ysize, xoff : xoff + xsize] = values
+
+
+# Record the observations a bin was made from once every chunk of it has been written
+def set_bin_sources(climatology_name, info, b, sources):
+    info["bins"][str(b)] = list(sources)
+    write_climatology_info(climatology_name, info)
+    return info
+
+
+####################################################################################################
+# Put together the baseline mean, standard deviation, and count of a chunk from the climatologies of the baseline years
+# The window (startJulian through endJulian) must be on the bin grid and every bin must have been made
+# ddof is the delta degrees of freedom of the standard deviation (see local_stats_lib.mean_std)
+# Returns the same as local_stats_lib.mean_std for the baseline observations of the chunk
+def get_baseline_stats(climatology_names, startJulian, endJulian, xoff, yoff, xsize, ysize, ddof=0):
+    total = None
+    for climatology_name in climatology_names:
+        info = read_climatology_info(climatology_name)
+        bins = get_window_bins(info, startJulian, endJulian)
+        if bins == None:
+            raise ValueError("Julian days {}-{} are not on the bin grid of {} (first julian: {}, bin days: {})".format(startJulian, endJulian, climatology_name, info["first_julian"], info["bin_days"]))
+        missing = [b for b in bins if not has_bin(info, b)]
+        if len(missing) > 0:
+            raise ValueError("Bins {} of {} have not been made".format(missing, climatology_name))
+        if xoff + xsize > info["width"] or yoff + ysize > info["height"]:
+            raise ValueError("Chunk is outside of the grid of {}".format(climatology_name))
+
+        cube = open_climatology(climatology_name)
+        sums = cube[:, bins[0] : bins[-1] + 1, :, yoff : yoff + ysize, xoff : xoff + xsize].sum(1, dtype="float64")
+        total = sums if total is None else total + sums
+        cube = None
+
+    total_sum, total_sum_sq, count = total
+    return lsl.sums_to_mean_std(total_sum, total_sum_sq, count.astype("int64"), ddof)
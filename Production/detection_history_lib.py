@@ -0,0 +1,249 @@
+"""
+   Copyright 2021 Ian Housman, RedCastle Resources Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Script to keep a bit-packed per-pixel detection history of LAndscape Monitoring and Detection Application (LAMDA) outputs
+# A history covers a single area, method, indices, and year (season)
+# Each period of the season is a bit: one bitplane records whether the pixel crossed the change threshold
+# and a second records whether the pixel had data (a period that hasn't been added has no data)
+# Bits are packed into uint64 words, so a whole season (~46 8 day periods) is a single word per plane
+#
+# Periods are placed on a fixed grid (first_julian + bit * frequency) so they can be added in any order
+# Persistence for any number of periods, detection counts, and first detection dates are then computed
+# with masks, popcounts, and bit tricks on the words without reading any raster again
+#
+# A history is stored as a .npy (memory mapped) of shape (2, n_words, height, width)
+# with a .json sidecar of its period grid, georeferencing, and the periods that have been added
+####################################################################################################
+import os, json
+import numpy
+
+word_bits = 64
+detection_plane = 0
+valid_plane = 1
+
+# Popcount of each byte value (fallback if numpy.bitwise_count isn't available)
+byte_popcount = numpy.array([bin(i).count("1") for i in range(256)], dtype="uint8")
+
+
+####################################################################################################
+# Count the set bits of each value of a uint64 array
+def popcount(words):
+    if hasattr(numpy, "bitwise_count"):
+        return numpy.bitwise_count(words)
+    words = numpy.ascontiguousarray(words)
+    return byte_popcount[words.view("uint8")].reshape(words.shape + (8,)).sum(-1, dtype="uint8")
+
+
+# Generator of (first row, last row + 1) blocks of rows
+# Planes are read and reduced block_rows rows at a time so memory doesn't grow with the size of the history
+def iter_row_blocks(height, block_rows=256):
+    for y0 in range(0, height, block_rows):
+        yield y0, min(y0 + block_rows, height)
+
+
+# Get the per-word uint64 masks for a range of n_bits bits starting at start_bit
+def get_range_masks(start_bit, n_bits, n_words):
+    mask = ((1 << n_bits) - 1) << start_bit
+    return [numpy.uint64((mask >> (w * word_bits)) & 0xFFFFFFFFFFFFFFFF) for w in range(n_words)]
+
+
+####################################################################################################
+# Get the name of the history of a raw LAMDA output (one per area, method, indices, year, and GEE tile if it was tiled)
+def get_history_name(folder, area, method, indices, year, tile=None):
+    return os.path.join(folder, "{}_LAMDA_{}_{}_{}{}_history.npy".format(area, method, indices, year, tile or ""))
+
+
+# Create an empty history
+# Room is made for n_periods periods on the grid starting at first_julian every frequency days
+# scale_factor and thresh are recorded so a history is never updated with masks from a different threshold
+def create_history(history_name, width, height, first_julian, frequency, scale_factor, thresh, projection="", geotransform=None, n_periods=word_bits):
+    n_words = max(1, int(numpy.ceil(n_periods / float(word_bits))))
+    words = numpy.lib.format.open_memmap(history_name, mode="w+", dtype="uint64", shape=(2, n_words, height, width))
+    words.flush()
+    words = None
+
+    info = {
+        "width": width,
+        "height": height,
+        "n_words": n_words,
+        "first_julian": first_julian,
+        "frequency": frequency,
+        "scale_factor": scale_factor,
+        "thresh": thresh,
+        "projection": projection,
+        "geotransform": list(geotransform) if geotransform != None else None,
+        "periods": {},
+    }
+    write_history_info(history_name, info)
+    return info
+
+
+def read_history_info(history_name):
+    o = open(history_name + ".json")
+    info = json.load(o)
+    o.close()
+    return info
+
+
+def write_history_info(history_name, info):
+    o = open(history_name + ".json", "w")
+    json.dump(info, o, indent=1)
+    o.close()
+
+
+# Open the words of a history (memory mapped)
+def open_history(history_name, mode="r"):
+    return numpy.load(history_name, mmap_mode=mode)
+
+
+# Get the bit of a period starting on julian day jd
+# Returns None if the period isn't on the grid of the history
+def get_period_bit(info, jd):
+    offset = jd - info["first_julian"]
+    if offset < 0 or offset % info["frequency"] != 0:
+        return None
+    return offset // info["frequency"]
+
+
+# Get the julian day a bit starts on
+def get_bit_julian(info, bit):
+    return info["first_julian"] + bit * info["frequency"]
+
+
+# Make room for more periods by copying the words into a larger history
+def grow_history(history_name, info, n_periods):
+    n_words = int(numpy.ceil(n_periods / float(word_bits)))
+    if n_words <= info["n_words"]:
+        return info
+
+    old = numpy.array(open_history(history_name))
+    words = numpy.lib.format.open_memmap(history_name, mode="w+", dtype="uint64", shape=(2, n_words, info["height"], info["width"]))
+    words[:, : info["n_words"]] = old
+    words.flush()
+    words = None
+    old = None
+
+    info["n_words"] = n_words
+    write_history_info(history_name, info)
+    return info
+
+
+####################################################################################################
+# Add a period to a history from its change (below threshold) and no data masks
+# source_id identifies the version of the raw output the masks came from (e.g. its fingerprint)
+# so a period can be added again if the raw output changes
+def add_period(history_name, jd, change, no_data, source_id=None, block_rows=256):
+    info = read_history_info(history_name)
+    bit = get_period_bit(info, jd)
+    if bit == None:
+        raise ValueError("Julian day {} is not on the period grid of {} (first julian: {}, frequency: {})".format(jd, history_name, info["first_julian"], info["frequency"]))
+    info = grow_history(history_name, info, bit + 1)
+
+    w = bit // word_bits
+    word_bit = numpy.uint64(bit % word_bits)
+    one = numpy.uint64(1)
+    clear = ~(one << word_bit)
+
+    words = open_history(history_name, "r+")
+    for y0, y1 in iter_row_blocks(info["height"], block_rows):
+        valid = no_data[y0:y1] == 0
+        detected = (change[y0:y1] != 0) & valid
+        words[detection_plane, w, y0:y1] = (words[detection_plane, w, y0:y1] & clear) | (detected.astype("uint64") << word_bit)
+        words[valid_plane, w, y0:y1] = (words[valid_plane, w, y0:y1] & clear) | (valid.astype("uint64") << word_bit)
+    words.flush()
+    words = None
+
+    info["periods"][str(jd)] = source_id
+    write_history_info(history_name, info)
+    return info
+
+
+# Check whether a period has been added (from the same version of the raw output if source_id is provided)
+def has_period(info, jd, source_id=None):
+    if str(jd) not in info["periods"]:
+        return False
+    return source_id == None or info["periods"][str(jd)] == source_id
+
+
+####################################################################################################
+# Compute persistence for the window of n_periods periods ending with the period starting on end_jd
+# Returns the number of periods each pixel was detected in the window
+# Pixels that don't have data in every period of the window are set to out_no_data
+def get_persistence(history_name, end_jd, n_periods, out_no_data=255, block_rows=256):
+    info = read_history_info(history_name)
+    end_bit = get_period_bit(info, end_jd)
+    if end_bit == None or end_bit - n_periods + 1 < 0 or end_bit >= info["n_words"] * word_bits:
+        raise ValueError("Window of {} periods ending on julian day {} is not covered by {}".format(n_periods, end_jd, history_name))
+    start_bit = end_bit - n_periods + 1
+
+    words = open_history(history_name)
+    masks = get_range_masks(start_bit, n_periods, info["n_words"])
+    count = numpy.zeros((info["height"], info["width"]), dtype="uint8")
+    for y0, y1 in iter_row_blocks(info["height"], block_rows):
+        all_valid = numpy.ones((y1 - y0, info["width"]), dtype="bool")
+        for w, mask in enumerate(masks):
+            if mask == 0:
+                continue
+            count[y0:y1] += popcount(words[detection_plane, w, y0:y1] & mask).astype("uint8")
+            all_valid &= (words[valid_plane, w, y0:y1] & mask) == mask
+        count[y0:y1][~all_valid] = out_no_data
+    words = None
+    return count
+
+
+# Count the periods each pixel was detected in (and had data in) between two period start julian days (inclusive)
+# All periods are counted if start_jd and end_jd aren't provided
+# Counts are uint16 so a history of any length fits
+def get_detection_counts(history_name, start_jd=None, end_jd=None, block_rows=256):
+    info = read_history_info(history_name)
+    start_bit = get_period_bit(info, start_jd) if start_jd != None else 0
+    end_bit = get_period_bit(info, end_jd) if end_jd != None else info["n_words"] * word_bits - 1
+    if start_bit == None or end_bit == None or end_bit < start_bit:
+        raise ValueError("Julian days {}-{} are not on the period grid of {} (first julian: {}, frequency: {})".format(start_jd, end_jd, history_name, info["first_julian"], info["frequency"]))
+
+    words = open_history(history_name)
+    masks = get_range_masks(start_bit, end_bit - start_bit + 1, info["n_words"])
+    count = numpy.zeros((info["height"], info["width"]), dtype="uint16")
+    for y0, y1 in iter_row_blocks(info["height"], block_rows):
+        for w, mask in enumerate(masks):
+            if mask != 0:
+                count[y0:y1] += popcount(words[detection_plane, w, y0:y1] & mask)
+    words = None
+    return count
+
+
+# Get the starting julian day of the first period each pixel was detected in
+# Pixels that were never detected are set to out_no_data
+def get_first_detection(history_name, out_no_data=0, block_rows=256):
+    info = read_history_info(history_name)
+    words = open_history(history_name)
+
+    first = numpy.full((info["height"], info["width"]), out_no_data, dtype="int16")
+    for y0, y1 in iter_row_blocks(info["height"], block_rows):
+        found = numpy.zeros((y1 - y0, info["width"]), dtype="bool")
+        for w in range(info["n_words"]):
+            detected = words[detection_plane, w, y0:y1]
+            new = (detected != 0) & ~found
+            if not new.any():
+                continue
+
+            # Isolate the lowest set bit (x & -x) and find its position
+            lowest = detected[new] & (~detected[new] + numpy.uint64(1))
+            bit = numpy.log2(lowest.astype("float64")).astype("int16") + w * word_bits
+            first[y0:y1][new] = info["first_julian"] + bit * info["frequency"]
+            found |= new
+    words = None
+    return first
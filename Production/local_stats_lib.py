@@ -0,0 +1,551 @@
+"""
+   Copyright 2021 Ian Housman, RedCastle Resources Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Script of the per-pixel statistics behind the local LAndscape Monitoring and Detection Application (LAMDA) engine
+# These mirror the GEE methods in LAMDA_Lib (getZ and getTrend) on numpy arrays so outputs can be made without GEE
+# Stacks are float arrays of shape (time, bands, rows, columns) with masked observations set to nan
+# Every function is vectorized across pixels (nothing loops over pixels)
+#
+# Reading and writing rasters is left to LAMDA_local_lib
+####################################################################################################
+import warnings
+import numpy
+
+# No data value and scale factors of the raw LAMDA exports (see getZ and getTrend)
+export_no_data = -32768
+z_scale_factor = 1000
+tdd_scale_factor = 10000
+
+
+####################################################################################################
+# Get a boolean index of the observations within a julian day range (inclusive) and optionally a year range (inclusive)
+# Like ee.Filter.calendarRange, the julian range wraps around the end of the year if startJulian > endJulian
+def filter_dates(years, julians, startJulian, endJulian, startYear=None, endYear=None):
+    years = numpy.asarray(years)
+    julians = numpy.asarray(julians)
+    if startJulian <= endJulian:
+        keep = (julians >= startJulian) & (julians <= endJulian)
+    else:
+        keep = (julians >= startJulian) | (julians <= endJulian)
+    if startYear != None:
+        keep &= years >= startYear
+    if endYear != None:
+        keep &= years <= endYear
+    return keep
+
+
+# Get the baseline years (inclusive) of an analysis year the same way getZ does
+def get_baseline_years(analysisYear, baselineLength=3, baselineGap=1):
+    return analysisYear - baselineGap - baselineLength, analysisYear - baselineGap - 1
+
+
+####################################################################################################
+# Get the per-pixel mean, standard deviation, and count of a stack over time, ignoring nan
+# ddof is the delta degrees of freedom of the standard deviation (0 for population, 1 for sample)
+# Pixels without more than ddof observations are nan
+def mean_std(stack, ddof=0):
+    valid = ~numpy.isnan(stack)
+    count = valid.sum(0)
+    filled = numpy.where(valid, stack, 0).astype("float64")
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        mean = filled.sum(0) / count
+        sq_dev = numpy.where(valid, (filled - mean) ** 2, 0).sum(0)
+        std = numpy.sqrt(sq_dev / (count - ddof))
+    mean[count == 0] = numpy.nan
+    std[count <= ddof] = numpy.nan
+    return mean, std, count
+
+
+# Get the per-pixel sum, sum of squares, and count of a stack over time, ignoring nan
+# Sums of different sets of observations add up to the sums of all of them (see sums_to_mean_std)
+def get_sums(stack):
+    valid = ~numpy.isnan(stack)
+    filled = numpy.where(valid, stack, 0).astype("float64")
+    return filled.sum(0), (filled * filled).sum(0), valid.sum(0)
+
+
+# Get the mean, standard deviation, and count from sums (see get_sums) the same way mean_std does
+def sums_to_mean_std(total_sum, total_sum_sq, count, ddof=0):
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        mean = total_sum / count
+        std = numpy.sqrt(numpy.maximum(total_sum_sq - total_sum * mean, 0) / (count - ddof))
+    mean[count == 0] = numpy.nan
+    std[count <= ddof] = numpy.nan
+    return mean, std, count
+
+
+# Get the z score of each observation of a stack against a mean and standard deviation
+# Pixels with a standard deviation of 0 (or nan) are nan
+def get_z_stack(stack, mean, std):
+    std = numpy.where(std > 0, std, numpy.nan)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return (stack - mean) / std
+
+
+# Get a percentile over the first axis of an array, ignoring nan
+# Same result as numpy.nanpercentile, but the array is sorted once (nan sorts last) and the ranks of every pixel
+# are gathered at once rather than reducing each pixel on its own (numpy.nanpercentile is ~50x slower on stacks)
+# method is one of linear, lower, higher, nearest, or midpoint (as in numpy.percentile)
+# Pixels without any observations are nan
+def nanpercentile(values, percentile, method="linear"):
+    values = numpy.sort(values, axis=0)
+    n = (~numpy.isnan(values)).sum(0)
+    lower, upper, fraction = get_percentile_ranks(n, percentile, method)
+    below = numpy.take_along_axis(values, lower[None], 0)[0]
+    above = numpy.take_along_axis(values, upper[None], 0)[0]
+    with numpy.errstate(invalid="ignore"):
+        out = below + (above - below) * fraction.astype(values.dtype)
+    out[n == 0] = numpy.nan
+    return out
+
+
+# Get the ranks (0 based) of the values below and above a percentile of n values and the fraction between them
+# the same way numpy.percentile does for method (linear, lower, higher, nearest, or midpoint)
+def get_percentile_ranks(n, percentile, method="linear"):
+    pos = percentile / 100.0 * numpy.maximum(n - 1, 0)
+    if method == "lower":
+        pos = numpy.floor(pos)
+    elif method == "higher":
+        pos = numpy.ceil(pos)
+    elif method == "nearest":
+        pos = numpy.around(pos)
+    elif method == "midpoint":
+        pos = (numpy.floor(pos) + numpy.ceil(pos)) / 2.0
+    elif method != "linear":
+        raise ValueError("Unknown percentile method: {}. Must be one of: linear, lower, higher, nearest, or midpoint".format(method))
+
+    lower = numpy.floor(pos).astype("int64")
+    upper = numpy.ceil(pos).astype("int64")
+    return lower, upper, pos - lower
+
+
+# Reduce a stack over time to a percentile, ignoring nan (see nanpercentile)
+# Pixels without any observations are nan
+def reduce_percentile(stack, percentile, method="linear"):
+    if stack.shape[0] == 0:
+        return numpy.full(stack.shape[1:], numpy.nan, dtype="float32")
+    return nanpercentile(stack, percentile, method).astype("float32")
+
+
+# Get the min across bands of an array of shape (bands, rows, columns), ignoring nan
+# Pixels where every band is nan are nan
+def min_across_bands(values):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return numpy.nanmin(values, axis=0)
+
+
+####################################################################################################
+# Local version of getZ for a chunk of pixels
+# stack holds every observation (all years and julian days) and years and julians are the date of each one
+# The stack is filtered to the julian range, the baseline mean and standard deviation are computed from the
+# baseline years, each analysis year observation is converted to a z score, reduced over time to the zPercentile
+# percentile (zReducer), and the min is taken across bands (indexNames)
+# Returns the z score (nan where masked) and whether it's at or below zThresh
+def get_z(stack, years, julians, startJulian, endJulian, analysisYear, baselineLength=3, baselineGap=1, zPercentile=70, zThresh=-3, ddof=0, percentile_method="linear"):
+    baselineStartYear, baselineEndYear = get_baseline_years(analysisYear, baselineLength, baselineGap)
+    baseline = filter_dates(years, julians, startJulian, endJulian, baselineStartYear, baselineEndYear)
+    analysis = filter_dates(years, julians, startJulian, endJulian, analysisYear, analysisYear)
+
+    mean, std, count = mean_std(stack[baseline], ddof)
+    return get_analysis_z(stack[analysis], mean, std, zPercentile, zThresh, percentile_method)
+
+
+# Get the z score of the analysis year observations of a chunk against a baseline mean and standard deviation
+# (e.g. from a baseline climatology) the same way get_z does
+def get_analysis_z(analysis_stack, mean, std, zPercentile=70, zThresh=-3, percentile_method="linear"):
+    z_stack = get_z_stack(analysis_stack, mean, std)
+    analysisZ = min_across_bands(reduce_percentile(z_stack, zPercentile, percentile_method))
+    with numpy.errstate(invalid="ignore"):
+        negativeDeparture = analysisZ <= zThresh
+    return analysisZ, negativeDeparture
+
+
+####################################################################################################
+# Get the epoch years (inclusive) of an analysis year the same way getTrend does
+def get_epoch_years(analysisYear, epochLength=5):
+    return analysisYear - epochLength + 1, analysisYear
+
+
+# Get the annual composites of a stack (the percentile of each year's observations within the julian range)
+# Returns an array of shape (years, bands, rows, columns) (nan where a year has no observations)
+def get_annual_composites(stack, years, julians, startJulian, endJulian, composite_years, percentile=50, method="linear"):
+    composites = numpy.empty((len(composite_years),) + stack.shape[1:], dtype="float32")
+    for i, yr in enumerate(composite_years):
+        composites[i] = reduce_percentile(stack[filter_dates(years, julians, startJulian, endJulian, yr, yr)], percentile, method)
+    return composites
+
+
+# Get the ordinary least squares slope of values of shape (time, bands, rows, columns) against x (one per time)
+# Masked (nan) values are left out of the fit of their pixel
+# If joint_mask is True, a time is left out of every band of a pixel if any band is masked
+# (like ee.Reducer.linearRegression fitting every band at once)
+# Pixels with fewer than 2 times are nan
+def ols_slope(values, x, joint_mask=True):
+    valid = ~numpy.isnan(values)
+    if joint_mask:
+        valid = numpy.broadcast_to(valid.all(1, keepdims=True), values.shape)
+
+    # Center x so the sums don't lose precision
+    x = numpy.asarray(x, dtype="float64")
+    x = (x - x.mean()).reshape((-1,) + (1,) * (values.ndim - 1))
+    w = valid.astype("float64")
+    y = numpy.where(valid, values, 0).astype("float64")
+
+    n = w.sum(0)
+    sx = (w * x).sum(0)
+    sy = y.sum(0)
+    sxx = (w * x * x).sum(0)
+    sxy = (y * x).sum(0)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+    slope[n < 2] = numpy.nan
+    return slope.astype("float32")
+
+
+# Local version of getTrend for a chunk of pixels
+# Annual composites (the annualPercentile percentile of tddAnnualReducer) are made for each year of the epoch,
+# the slope per year of each band is fit in one pass over every pixel, and the min is taken across bands (indexNames)
+# Returns the slope (nan where masked) and whether it's at or below slopeThresh
+def get_trend(stack, years, julians, startJulian, endJulian, analysisYear, epochLength=5, annualPercentile=50, slopeThresh=-0.05, percentile_method="linear", joint_mask=True):
+    epochStartYear, epochEndYear = get_epoch_years(analysisYear, epochLength)
+    composite_years = list(range(epochStartYear, epochEndYear + 1))
+    composites = get_annual_composites(stack, years, julians, startJulian, endJulian, composite_years, annualPercentile, percentile_method)
+
+    # Composites all start on startJulian so the fractional year getLinearFit uses only shifts x (the slope is the same)
+    slope = min_across_bands(ols_slope(composites, composite_years, joint_mask))
+    with numpy.errstate(invalid="ignore"):
+        negativeSlope = slope <= slopeThresh
+    return slope, negativeSlope
+
+
+####################################################################################################
+# Convert values to the int16 the raw LAMDA exports are written as
+# Values are scaled, clamped to +/-32767, and truncated toward zero (like ee.Image.int16)
+# Masked (nan) values are set to no_data
+def to_export_int16(values, scale_factor, no_data=export_no_data):
+    with numpy.errstate(invalid="ignore"):
+        scaled = numpy.clip(numpy.asarray(values, dtype="float64") * scale_factor, -32767, 32767)
+    out = numpy.full(scaled.shape, no_data, dtype="int16")
+    valid = ~numpy.isnan(scaled)
+    out[valid] = scaled[valid].astype("int16")
+    return out
+
+
+####################################################################################################
+# Get the sub-windows a season of periods is split into
+# Periods start on startJulians and are nDays long
+# The season is split into sub-windows of frequency days starting on the first startJulian so that every
+# period is made up of whole sub-windows (each startJulian must be on the frequency grid and nDays a multiple of frequency)
+# Returns the first julian day of the grid and a dictionary of startJulian: (first sub-window, last sub-window + 1)
+def get_sub_windows(startJulians, nDays, frequency):
+    first_julian = min(startJulians)
+    if nDays % frequency != 0 or any((jd - first_julian) % frequency != 0 for jd in startJulians):
+        raise ValueError("Periods of {} days starting on {} can't be split into sub-windows of {} days".format(nDays, sorted(startJulians), frequency))
+    return first_julian, {jd: ((jd - first_julian) // frequency, (jd - first_julian + nDays) // frequency) for jd in startJulians}
+
+
+# Sort a stack by date and get the key (year and sub-window) of each observation
+# Once sorted, the observations of a year within a run of sub-windows are a single slice of the stack (see get_slice)
+def sort_by_sub_window(stack, years, julians, first_julian, frequency):
+    years = numpy.asarray(years)
+    julians = numpy.asarray(julians)
+    order = numpy.lexsort((julians, years))
+    if (order != numpy.arange(len(order))).any():
+        stack, years, julians = stack[order], years[order], julians[order]
+    return stack, years * 1000 + (julians - first_julian) // frequency
+
+
+# Get the slice of a sorted stack (see sort_by_sub_window) of a year's observations in sub-windows s0 through s1 - 1
+def get_slice(keys, year, s0, s1):
+    return slice(numpy.searchsorted(keys, year * 1000 + s0), numpy.searchsorted(keys, year * 1000 + s1))
+
+
+# Local version of getZ for every period of a season of a chunk of pixels
+# Same as running get_z for each period, but the stack is only filtered once and the baseline sums of each sub-window
+# are computed once and added up for each period that covers them (see get_sub_windows)
+# Since a standard deviation above 0 makes the z score an increasing affine function of the observation,
+# the zPercentile percentile of the z scores is the z score of the zPercentile percentile of the observations
+# so only one value per pixel is converted to a z score
+# baselines can be provided as a dictionary of startJulian: (mean, std, count) (e.g. from a baseline climatology)
+# Returns a dictionary of startJulian: (analysisZ, negativeDeparture)
+def get_season_z(stack, years, julians, startJulians, nDays, frequency, analysisYear, baselineLength=3, baselineGap=1, zPercentile=70, zThresh=-3, ddof=0, percentile_method="linear", baselines=None):
+    first_julian, sub_windows = get_sub_windows(startJulians, nDays, frequency)
+    n_sub_windows = max(s1 for s0, s1 in sub_windows.values())
+    stack, keys = sort_by_sub_window(stack, years, julians, first_julian, frequency)
+
+    if baselines == None:
+        baselineStartYear, baselineEndYear = get_baseline_years(analysisYear, baselineLength, baselineGap)
+        baseline_sums = []
+        for s in range(n_sub_windows):
+            sums = [get_sums(stack[get_slice(keys, yr, s, s + 1)]) for yr in range(baselineStartYear, baselineEndYear + 1)]
+            baseline_sums.append([sum(values) for values in zip(*sums)])
+
+    out = {}
+    for startJulian, (s0, s1) in sorted(sub_windows.items()):
+        if baselines == None:
+            mean, std, count = sums_to_mean_std(*[sum(values) for values in zip(*baseline_sums[s0:s1])], ddof=ddof)
+        else:
+            mean, std, count = baselines[startJulian]
+        analysis_percentile = reduce_percentile(stack[get_slice(keys, analysisYear, s0, s1)], zPercentile, percentile_method)
+        analysisZ = min_across_bands(get_z_stack(analysis_percentile, mean, std).astype("float32"))
+        with numpy.errstate(invalid="ignore"):
+            out[startJulian] = (analysisZ, analysisZ <= zThresh)
+    return out
+
+
+# Local version of getTrend for every period of a season of a chunk of pixels
+# Same as running get_trend for each period, but the stack is only filtered once and each annual composite
+# is reduced from a slice of it rather than a copy
+# Returns a dictionary of startJulian: (slope, negativeSlope)
+def get_season_trend(stack, years, julians, startJulians, nDays, frequency, analysisYear, epochLength=5, annualPercentile=50, slopeThresh=-0.05, percentile_method="linear", joint_mask=True):
+    first_julian, sub_windows = get_sub_windows(startJulians, nDays, frequency)
+    stack, keys = sort_by_sub_window(stack, years, julians, first_julian, frequency)
+    epochStartYear, epochEndYear = get_epoch_years(analysisYear, epochLength)
+    composite_years = list(range(epochStartYear, epochEndYear + 1))
+
+    out = {}
+    for startJulian, (s0, s1) in sorted(sub_windows.items()):
+        composites = numpy.stack([reduce_percentile(stack[get_slice(keys, yr, s0, s1)], annualPercentile, percentile_method) for yr in composite_years])
+        slope = min_across_bands(ols_slope(composites, composite_years, joint_mask))
+        with numpy.errstate(invalid="ignore"):
+            out[startJulian] = (slope, slope <= slopeThresh)
+    return out
+
+
+####################################################################################################
+# Streaming percentile sketch of every pixel of a chunk
+# Each pixel keeps a histogram of n_bins equal bins over value_range (values outside it go into the end bins)
+# along with its count and exact min and max, so the percentile reducers can be run one image at a time
+# without holding every observation (memory is set by n_bins, not the number of observations)
+# Percentiles are found by walking the histogram to the bin that holds each rank and assuming the values within
+# a bin are evenly spread between its edges (narrowed to the pixel's min and max, so values outside value_range
+# are still bounded), so the error is at most the bin width within value_range and the min and max are exact
+# offset and scale (arrays of the pixel shape) put values on a per-pixel scale ((value - offset) / scale) before they
+# are binned (e.g. a baseline mean and standard deviation so the bins are in z score units)
+# Counts start as uint8 and are widened as more images are added, and sketches with the same bins can be merged
+class PercentileSketch:
+    def __init__(self, shape, value_range=(-1.0, 1.0), n_bins=256, offset=None, scale=None):
+        self.shape = tuple(shape)
+        self.value_range = tuple(value_range)
+        self.n_bins = n_bins
+        self.bin_width = (value_range[1] - value_range[0]) / float(n_bins)
+        self.offset = offset
+        self.scale = scale
+
+        # Counts are stored pixel by pixel (the bins of a pixel are next to each other) so adding an image
+        # writes to memory in order rather than all over the array
+        # Bins are also counted in groups of about sqrt(n_bins) so a rank can be found by walking the groups
+        # and then the bins of one group rather than every bin
+        self.group_size = int(numpy.ceil(numpy.sqrt(n_bins)))
+        self.n_groups = -(-n_bins // self.group_size)
+        self.counts = numpy.zeros(self.shape + (n_bins,), dtype="uint8")
+        self.group_counts = numpy.zeros(self.shape + (self.n_groups,), dtype="uint8")
+        self.n = numpy.zeros(self.shape, dtype="int32")
+        self.min = numpy.full(self.shape, numpy.inf, dtype="float32")
+        self.max = numpy.full(self.shape, -numpy.inf, dtype="float32")
+        self.n_added = 0
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes + self.group_counts.nbytes + self.n.nbytes + self.min.nbytes + self.max.nbytes
+
+    def _to_sketch(self, values):
+        values = numpy.asarray(values, dtype="float32")
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            if self.offset is not None:
+                values = values - self.offset
+            if self.scale is not None:
+                values = values / self.scale
+        return values
+
+    def _from_sketch(self, values):
+        if self.scale is not None:
+            values = values * self.scale
+        if self.offset is not None:
+            values = values + self.offset
+        return values
+
+    # Widen the counts so they can hold n_added images per bin
+    def _fit_counts(self, n_added):
+        for dtype in ["uint8", "uint16", "uint32"]:
+            if n_added <= numpy.iinfo(dtype).max:
+                break
+        if numpy.dtype(dtype).itemsize > self.counts.dtype.itemsize:
+            self.counts = self.counts.astype(dtype)
+            self.group_counts = self.group_counts.astype(dtype)
+
+    # Add an image (an array of the pixel shape, nan where masked)
+    def add(self, values):
+        self._fit_counts(self.n_added + 1)
+        values = self._to_sketch(values)
+        valid = ~numpy.isnan(values)
+        self.n += valid
+        numpy.fmin(self.min, values, out=self.min)
+        numpy.fmax(self.max, values, out=self.max)
+
+        pixels = numpy.flatnonzero(valid)
+        values = numpy.clip(values.ravel()[pixels], self.value_range[0], self.value_range[1])
+        bins = numpy.minimum(((values - self.value_range[0]) / self.bin_width).astype("intp"), self.n_bins - 1)
+
+        # Each pixel is added to once, so there are no repeated (pixel, bin) pairs to accumulate
+        self.counts.reshape(-1)[pixels * self.n_bins + bins] += 1
+        self.group_counts.reshape(-1)[pixels * self.n_groups + bins // self.group_size] += 1
+        self.n_added += 1
+
+    # Merge another sketch with the same bins, offset, and scale into this one
+    def merge(self, other):
+        if (other.shape, other.value_range, other.n_bins) != (self.shape, self.value_range, self.n_bins) or other.offset is not self.offset or other.scale is not self.scale:
+            raise ValueError("Only sketches with the same shape, bins, offset, and scale can be merged")
+        self._fit_counts(self.n_added + other.n_added)
+        self.counts += other.counts
+        self.group_counts += other.group_counts
+        self.n += other.n
+        numpy.minimum(self.min, other.min, out=self.min)
+        numpy.maximum(self.max, other.max, out=self.max)
+        self.n_added += other.n_added
+        return self
+
+    # Get the value at a rank (0 based) of each pixel of a block of pixels (counts and group_counts are pixels by bins)
+    def _value_at_rank(self, counts, group_counts, rank, n, low, high):
+        # Find the group that holds the rank and the number of values before it
+        group_cum = group_counts.cumsum(1, dtype="int32")
+        g = numpy.minimum((group_cum <= rank[:, None]).sum(1), self.n_groups - 1)
+        before = numpy.where(g > 0, numpy.take_along_axis(group_cum, numpy.maximum(g - 1, 0)[:, None], 1)[:, 0], 0)
+
+        # Then the bin within the group (the last group can be short)
+        group_bins = g[:, None] * self.group_size + numpy.arange(self.group_size)
+        in_group = numpy.take_along_axis(counts, numpy.minimum(group_bins, self.n_bins - 1), 1).astype("int32")
+        in_group[group_bins >= self.n_bins] = 0
+        bin_cum = in_group.cumsum(1) + before[:, None]
+        j = numpy.minimum((bin_cum <= rank[:, None]).sum(1), self.group_size - 1)
+        b = g * self.group_size + j
+        before = numpy.where(j > 0, numpy.take_along_axis(bin_cum, numpy.maximum(j - 1, 0)[:, None], 1)[:, 0], before)
+        in_bin = numpy.take_along_axis(in_group, j[:, None], 1)[:, 0]
+
+        # The first and last bins also hold anything outside value_range
+        bin_low = numpy.where(b == 0, -numpy.inf, self.value_range[0] + b * self.bin_width)
+        bin_high = numpy.where(b >= self.n_bins - 1, numpy.inf, self.value_range[0] + (b + 1) * self.bin_width)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            bin_low = numpy.maximum(bin_low, low)
+            bin_high = numpy.minimum(bin_high, high)
+            value = bin_low + (rank - before + 0.5) / in_bin * (bin_high - bin_low)
+        value = numpy.where(rank == 0, low, value)
+        return numpy.where(rank == n - 1, high, value)
+
+    # Get a percentile of each pixel the same way nanpercentile does for method
+    # Pixels without any observations are nan
+    # Pixels are done block_size at a time to bound memory
+    def percentile(self, percentile, method="linear", block_size=65536):
+        lower, upper, fraction = get_percentile_ranks(self.n, percentile, method)
+        lower, upper, fraction = lower.ravel(), upper.ravel(), fraction.ravel()
+        n, low, high = self.n.ravel(), self.min.ravel(), self.max.ravel()
+        counts = self.counts.reshape(-1, self.n_bins)
+        group_counts = self.group_counts.reshape(-1, self.n_groups)
+
+        out = numpy.empty(lower.shape, dtype="float64")
+        for start in range(0, out.shape[0], block_size):
+            block = slice(start, start + block_size)
+            below = self._value_at_rank(counts[block], group_counts[block], lower[block], n[block], low[block], high[block])
+            above = self._value_at_rank(counts[block], group_counts[block], upper[block], n[block], low[block], high[block])
+            with numpy.errstate(invalid="ignore"):
+                out[block] = below + (above - below) * fraction[block]
+
+        out = out.reshape(self.shape)
+        out[self.n == 0] = numpy.nan
+        with numpy.errstate(invalid="ignore"):
+            return self._from_sketch(out).astype("float32")
+
+
+# Local version of getZ for a chunk of pixels from observations streamed one image at a time
+# images is an iterable of arrays of shape (bands, rows, columns) in date order with the dates in years and julians
+# The baseline mean and standard deviation are accumulated from the baseline years (or come from baseline if provided)
+# and the analysis year observations go into a PercentileSketch in z score units (sketch_range and n_bins)
+# so only the sums and one sketch are held rather than every observation
+# shape is the (bands, rows, columns) shape of each image. It's only needed if images can be empty
+# (otherwise it comes from the images or the baseline)
+# Returns the same as get_z (within the accuracy of the sketch)
+def get_z_streaming(images, years, julians, startJulian, endJulian, analysisYear, baselineLength=3, baselineGap=1, zPercentile=70, zThresh=-3, ddof=0, percentile_method="linear", sketch_range=(-10.0, 10.0), n_bins=256, baseline=None, shape=None):
+    baselineStartYear, baselineEndYear = get_baseline_years(analysisYear, baselineLength, baselineGap)
+    in_range = filter_dates(years, julians, startJulian, endJulian)
+    if shape == None and baseline != None:
+        shape = baseline[0].shape
+    accumulate = baseline == None
+    sums = None
+    sketch = None
+    for values, year, keep in zip(images, years, in_range):
+        shape = values.shape
+        if not keep:
+            continue
+        if accumulate and year >= baselineStartYear and year <= baselineEndYear:
+            if sketch != None:
+                raise ValueError("Images must be in date order")
+            image_sums = get_sums(values[None])
+            sums = image_sums if sums == None else [a + b for a, b in zip(sums, image_sums)]
+        elif year == analysisYear:
+            if sketch == None:
+                if baseline == None:
+                    baseline = sums_to_mean_std(*sums, ddof=ddof) if sums != None else (numpy.full(values.shape, numpy.nan),) * 2
+                mean, std = baseline[:2]
+                sketch = PercentileSketch(values.shape, sketch_range, n_bins, offset=mean, scale=numpy.where(std > 0, std, numpy.nan))
+            sketch.add(values)
+
+    if sketch == None:
+        if shape == None:
+            raise ValueError("No images were provided and shape isn't known (provide shape or baseline)")
+        analysisZ = numpy.full(shape[1:], numpy.nan, dtype="float32")
+    else:
+        mean, std = baseline[:2]
+        analysisZ = min_across_bands(get_z_stack(sketch.percentile(zPercentile, percentile_method), mean, std).astype("float32"))
+    with numpy.errstate(invalid="ignore"):
+        negativeDeparture = analysisZ <= zThresh
+    return analysisZ, negativeDeparture
+
+
+# Local version of getTrend for a chunk of pixels from observations streamed one image at a time (see get_z_streaming)
+# Each epoch year's observations go into a PercentileSketch (value_range and n_bins) that is reduced to the annual
+# composite as soon as the next year starts, so only one sketch is held at a time
+# shape is the (bands, rows, columns) shape of each image. It's only needed if images can be empty
+# Returns the same as get_trend (within the accuracy of the sketch)
+def get_trend_streaming(images, years, julians, startJulian, endJulian, analysisYear, epochLength=5, annualPercentile=50, slopeThresh=-0.05, percentile_method="linear", joint_mask=True, value_range=(-1.0, 1.0), n_bins=256, shape=None):
+    epochStartYear, epochEndYear = get_epoch_years(analysisYear, epochLength)
+    composite_years = list(range(epochStartYear, epochEndYear + 1))
+    in_range = filter_dates(years, julians, startJulian, endJulian, epochStartYear, epochEndYear)
+    composites = {}
+    sketch = None
+    sketch_year = None
+    for values, year, keep in zip(images, years, in_range):
+        shape = values.shape
+        if not keep:
+            continue
+        if year != sketch_year:
+            if year in composites or (sketch_year != None and year < sketch_year):
+                raise ValueError("Images must be in date order")
+            if sketch != None:
+                composites[sketch_year] = sketch.percentile(annualPercentile, percentile_method)
+            sketch = PercentileSketch(values.shape, value_range, n_bins)
+            sketch_year = year
+        sketch.add(values)
+    if sketch != None:
+        composites[sketch_year] = sketch.percentile(annualPercentile, percentile_method)
+    elif shape == None:
+        raise ValueError("No images were provided and shape isn't known (provide shape)")
+
+    empty = numpy.full(shape, numpy.nan, dtype="float32")
+    slope = min_across_bands(ols_slope(numpy.stack([composites.get(yr, empty) for yr in composite_years]), composite_years, joint_mask))
+    with numpy.errstate(invalid="ignore"):
+        negativeSlope = slope <= slopeThresh
+    return slope, negativeSlope
@@ -0,0 +1,166 @@
+"""
+   Copyright 2021 Ian Housman, RedCastle Resources Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Script of the per-block array math behind the LAndscape Monitoring and Detection Application (LAMDA) post-processing
+# Blocks are numpy arrays of the raw int16 outputs (one native block of a band at a time)
+# Nothing here needs GDAL so the math can be checked on plain arrays
+#
+# Reading and writing rasters is left to raster_processing_lib
+####################################################################################################
+import collections
+import numpy
+
+
+####################################################################################################
+# Linearly rescale values from in_min to in_max to out_min to out_max (values outside are clipped)
+def rescale(array, in_min, in_max, out_min=0, out_max=254):
+    return ((array.clip(in_min, in_max) - in_min) * (out_max - out_min)) / (in_max - in_min)
+
+
+# Stretch a block of raw values to 8 bit (as float32 values that are converted to 8 bit when written)
+# Values are scaled by scale_factor and stretched from -stretch to stretch, with out_no_data wherever the block is in_no_data
+def stretch_block(block, in_no_data, scale_factor, stretch, out_min=0, out_max=254, out_no_data=255):
+    block = block.astype("float32")
+    out = rescale(block / scale_factor, -stretch, stretch, out_min, out_max)
+    out[block == in_no_data] = out_no_data
+    return out
+
+
+# Stretched value of all 65,536 int16 values, indexed by their uint16 view
+# so stretch_block of an int16 block is table[block.view("uint16")]
+def get_stretch_table(in_no_data, scale_factor, stretch, out_min=0, out_max=254, out_no_data=255):
+    return stretch_block(numpy.arange(65536, dtype="uint16").view("int16"), in_no_data, scale_factor, stretch, out_min, out_max, out_no_data)
+
+
+####################################################################################################
+# Running stats of the valid values of a band, added one block at a time
+# Integer input is summed with python integers so the stats are exact and match GDAL's ComputeStatistics
+# (population standard deviation) from a single read of the data
+# nan values of float input are ignored
+class RunningStats:
+    def __init__(self):
+        self.n = 0
+        self.total = 0
+        self.total_sq = 0
+        self.min = None
+        self.max = None
+
+    # Add the valid values of a block
+    def add(self, values):
+        if values.dtype.kind == "f":
+            values = values[~numpy.isnan(values)].astype("float64")
+        else:
+            values = values.astype("int64")
+        if values.size == 0:
+            return
+
+        self.n += values.size
+        if values.dtype.kind == "f":
+            self.total += float(values.sum())
+            self.total_sq += float((values * values).sum())
+        else:
+            self.total += int(values.sum())
+            self.total_sq += int((values * values).sum())
+        self.min = values.min() if self.min is None else min(self.min, values.min())
+        self.max = values.max() if self.max is None else max(self.max, values.max())
+
+    # Get the Min, Max, Mean, and Std of every value added (None if no values were added)
+    def get_stats(self):
+        if self.n == 0:
+            return None
+        Mean = self.total / float(self.n)
+        Std = max(self.total_sq / float(self.n) - Mean * Mean, 0) ** 0.5
+        return float(self.min), float(self.max), Mean, Std
+
+
+####################################################################################################
+# Get the change (below threshold) and no data masks of a block of a single period
+# Both are uint8 arrays of 0s and 1s
+def get_change_masks(block, scale_factor, thresh, in_no_data=-32768):
+    block = block.astype("float32")
+    change = ((block / scale_factor) < thresh).astype("uint8")
+    no_data = (block == in_no_data).astype("uint8")
+    return change, no_data
+
+
+# Pack the change and no data masks of a block into a single uint8 array
+# (change in bit 0 and no data in bit 1) as they are saved during fused post processing
+def pack_persistence_masks(block, scale_factor, thresh, in_no_data=-32768):
+    change, no_data = get_change_masks(block, scale_factor, thresh, in_no_data)
+    return change | (no_data << 1)
+
+
+# Unpack saved persistence masks into the change and no data masks
+def unpack_persistence_masks(masks):
+    return masks & 1, masks >> 1
+
+
+####################################################################################################
+# Rolling persistence count across a sliding window of n_periods periods
+# Periods are added in order with add. Once n_periods have been added, count gives the per-pixel
+# number of periods in the window below the threshold, with out_no_data wherever any period in the window is null
+# (must have non null values for all n periods for persistence)
+# A running detection count and no data count are kept so each period is only added and dropped once
+class PersistenceWindow:
+    def __init__(self, n_periods=3, out_no_data=255):
+        self.n_periods = n_periods
+        self.out_no_data = out_no_data
+        self.window = collections.deque()
+        self.change_count = None
+        self.no_data_count = None
+
+    # Add the newest period and drop the oldest
+    def add(self, change, no_data):
+        if self.change_count is None:
+            self.change_count = numpy.zeros(change.shape, dtype="uint8")
+            self.no_data_count = numpy.zeros(change.shape, dtype="uint8")
+
+        self.change_count += change
+        self.no_data_count += no_data
+        self.window.append((change, no_data))
+        if len(self.window) > self.n_periods:
+            old_change, old_no_data = self.window.popleft()
+            self.change_count -= old_change
+            self.no_data_count -= old_no_data
+
+    # Persistence count of the periods currently in the window
+    def count(self):
+        out = self.change_count.copy()
+        out[self.no_data_count > 0] = self.out_no_data
+        return out
+
+
+####################################################################################################
+# Generator of (w, count) for each window of periods that has an output name
+# output_names[w] is the output of the window of periods w to w + n_periods - 1 (None if it isn't needed)
+# read_masks(i) returns the (change, no_data) masks of period i. It is called once per period,
+# in order, and only for the periods the needed windows cover
+def iter_persistence_windows(read_masks, output_names, n_periods=3, out_no_data=255):
+    to_write = [w for w, output_name in enumerate(output_names) if output_name != None]
+    if len(to_write) == 0:
+        return
+
+    first = to_write[0]
+    last = to_write[-1] + n_periods - 1
+
+    window = PersistenceWindow(n_periods, out_no_data)
+    for i in range(first, last + 1):
+        window.add(*read_masks(i))
+
+        # Window ending at this period
+        w = i - n_periods + 1
+        if w >= first and output_names[w] != None:
+            yield w, window.count()
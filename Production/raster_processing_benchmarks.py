@@ -0,0 +1,512 @@
+"""
+   Copyright 2021 Ian Housman, RedCastle Resources Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Script to benchmark the local post-processing methods of the LAndscape Monitoring and Detection Application (LAMDA)
+# Synthetic rasters that look like raw LAMDA outputs are written to a scratch folder and each method is timed
+####################################################################################################
+import os, sys, shutil, tempfile, time, json, platform, argparse, multiprocessing, concurrent.futures, tracemalloc, warnings
+import numpy
+import raster_processing_lib as rpl
+import local_stats_lib as lsl
+
+gdal = rpl.gdal
+osr = rpl.osr
+
+# 240 m grids the raw LAMDA outputs are exported on (transforms from transform_dict in LAMDA_GEE_Template.py)
+# Width and height cover the CONUS export area
+grid_dict = {
+    "CONUS": {"transform": [240, 0, -2361915.0, 0, -240, 3177735.0], "width": 19274, "height": 12159},
+}
+
+# Sizes (as a fraction of the width and height of the grid) to run the benchmark suite across
+size_fractions = [0.25, 0.5, 1.0]
+
+
+####################################################################################################
+# Get a chunk of synthetic raw LAMDA-like int16 values
+# Values are z-score like (scaled by scale_factor) and spatially smooth, so they compress like real outputs
+# No data (e.g. non-tree) pixels are set in contiguous patches covering about no_data_fraction of the area
+def synthetic_values(rng, coarse, coarse_mask, yoff, rows, width, scale_factor=1000, no_data_value=-32768, cell=16):
+    rows_i = numpy.arange(yoff, yoff + rows) // cell
+    cols_i = numpy.arange(width) // cell
+    values = (coarse[rows_i][:, cols_i] + rng.normal(0, 0.3, (rows, width))) * scale_factor
+    values = values.clip(-32767, 32767).astype("int16")
+    values[coarse_mask[rows_i][:, cols_i]] = no_data_value
+    return values
+
+
+# Write out a synthetic raw LAMDA-like int16 raster
+# The crs is left as a generic EPSG:5070 so it needs updated by update_cog just like GEE exports
+def make_synthetic_raster(path, width, height, scale_factor=1000, no_data_value=-32768, no_data_fraction=0.4, transform=[240, 0, -2361915.0, 0, -240, 3177735.0], seed=0, chunk_rows=512, cell=16):
+    rng = numpy.random.default_rng(seed)
+    coarse = rng.normal(0, 1.5, (height // cell + 1, width // cell + 1))
+    coarse_mask = rng.random(coarse.shape) < no_data_fraction
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(5070)
+
+    driver = gdal.GetDriverByName("GTiff")
+    ds = driver.Create(path, width, height, 1, gdal.GDT_Int16, options=["TILED=YES", "COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER"])
+    ds.SetProjection(srs.ExportToWkt())
+    ds.SetGeoTransform(transform)
+    b = ds.GetRasterBand(1)
+    b.SetNoDataValue(no_data_value)
+
+    for yoff in range(0, height, chunk_rows):
+        rows = min(chunk_rows, height - yoff)
+        b.WriteArray(synthetic_values(rng, coarse, coarse_mask, yoff, rows, width, scale_factor, no_data_value, cell), 0, yoff)
+
+    b = None
+    ds = None
+    return path
+
+
+####################################################################################################
+# Time a function call and return the wall time in seconds
+def time_call(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+####################################################################################################
+# Print out a table of benchmark results
+def print_results(results):
+    print("{:<30}{:>12}{:>12}{:>12}".format("method", "MPix", "seconds", "MPix/s"))
+    for r in results:
+        print("{:<30}{:>12.1f}{:>12.3f}{:>12.2f}".format(r["method"], r["mpix"], r["seconds"], r["mpix_per_second"]))
+
+
+####################################################################################################
+# Compare the throughput of the fused update_cog against the original implementation
+# The fused method decodes the raw image once (stats are summed from the blocks as they are written)
+# while the original reads it for the stats and again for the copy
+def benchmark_update_cog(width=4096, height=4096, n_repeats=3, workspace=None):
+    cleanup = workspace == None
+    if workspace == None:
+        workspace = tempfile.mkdtemp()
+
+    crs = osr.SpatialReference()
+    crs.ImportFromEPSG(5070)
+    crs = crs.ExportToWkt()
+
+    raw = make_synthetic_raster(os.path.join(workspace, "CONUS_LAMDA_Z_bench_raw.tif"), width, height)
+    mpix = width * height / 1e6
+
+    # Exports that are already COGs with the right crs and no data skip the rewrite
+    raw_cog = os.path.join(workspace, "CONUS_LAMDA_Z_bench_raw_cog.tif")
+    gdal.Translate(raw_cog, raw, format="COG", outputSRS=crs, noData=-32768, creationOptions=["COMPRESS=DEFLATE"])
+
+    results = []
+    for method, source, kwargs in [
+        ("update_cog (original)", raw, {"fused": False, "header_only": False}),
+        ("update_cog (fused)", raw, {"fused": True, "header_only": False}),
+        ("update_cog (original, approx)", raw, {"fused": False, "approx_stats": True, "header_only": False}),
+        ("update_cog (header only)", raw_cog, {"header_only": True}),
+    ]:
+        seconds = []
+        for i in range(n_repeats):
+            image = os.path.join(workspace, "CONUS_LAMDA_Z_bench_{}.tif".format(i))
+            shutil.copy(source, image)
+            seconds.append(time_call(rpl.update_cog, image, crs, -32768, **kwargs))
+            gdal.GetDriverByName("GTiff").Delete(image)
+        best = min(seconds)
+        results.append({"method": method, "mpix": mpix, "seconds": best, "mpix_per_second": mpix / best})
+
+    if cleanup:
+        shutil.rmtree(workspace)
+
+    print_results(results)
+    return results
+
+
+####################################################################################################
+# Compare the original in memory 8 bit stretch against the block streamed float and lookup table stretches
+# Outputs of every method are checked to be byte identical to the original
+def benchmark_stretch_to_8bit(width=4096, height=4096, scale_factor=1000, stretch=5, n_repeats=3, workspace=None):
+    cleanup = workspace == None
+    if workspace == None:
+        workspace = tempfile.mkdtemp()
+
+    palette = ["a83800", "ff5500", "e0e0e0", "a4ff73", "38a800"]
+    raw = make_synthetic_raster(os.path.join(workspace, "CONUS_LAMDA_Z_bench_raw.tif"), width, height, scale_factor)
+    mpix = width * height / 1e6
+
+    results = []
+    reference = None
+    for method, func, kwargs in [
+        ("stretch (in memory)", rpl.stretch_to_8bit_in_memory, {}),
+        ("stretch (streaming, float)", rpl.stretch_to_8bit_streaming, {"use_lut": False}),
+        ("stretch (streaming, lut)", rpl.stretch_to_8bit_streaming, {"use_lut": True}),
+    ]:
+        seconds = []
+        for i in range(n_repeats):
+            out_image = os.path.join(workspace, "CONUS_LAMDA_Z_bench_8bit_{}.tif".format(i))
+            seconds.append(time_call(func, raw, out_image, -32768, scale_factor, stretch, palette, **kwargs))
+
+            out = gdal.Open(out_image).ReadAsArray()
+            if reference is None:
+                reference = out
+            elif not numpy.array_equal(reference, out):
+                print("Output of {} does not match the original".format(method))
+            gdal.GetDriverByName("GTiff").Delete(out_image)
+        best = min(seconds)
+        results.append({"method": method, "mpix": mpix, "seconds": best, "mpix_per_second": mpix / best})
+
+    if cleanup:
+        shutil.rmtree(workspace)
+
+    print_results(results)
+    return results
+
+
+####################################################################################################
+# Compare post processing a raw output with the separate steps (update_cog, stretch_to_8bit, and persistence masks)
+# against the fused single read (post_process_tif_fused)
+# The 8 bit outputs and persistence masks are checked to match
+def benchmark_fused_post_process(width=4096, height=4096, scale_factor=1000, stretch=5, thresh=-2.5, n_repeats=3, workspace=None):
+    cleanup = workspace == None
+    if workspace == None:
+        workspace = tempfile.mkdtemp()
+
+    crs = osr.SpatialReference()
+    crs.ImportFromEPSG(5070)
+    crs = crs.ExportToWkt()
+
+    palette = ["a83800", "ff5500", "e0e0e0", "a4ff73", "38a800"]
+    raw = make_synthetic_raster(os.path.join(workspace, "CONUS_LAMDA_Z_bench_raw.tif"), width, height, scale_factor)
+    mpix = width * height / 1e6
+
+    # Separate steps read the raw image for the COG update, the 8 bit stretch, and the persistence masks
+    def separate(image):
+        rpl.post_process_tif(image, crs, -32768, scale_factor, stretch, palette, update=True, fused=False)
+        return rpl.read_persistence_masks(image, scale_factor, thresh)[:2]
+
+    def fused(image):
+        rpl.post_process_tif(image, crs, -32768, scale_factor, stretch, palette, update=True, thresh=thresh, fused=True)
+        return rpl.read_persistence_masks(image, scale_factor, thresh)[:2]
+
+    results = []
+    reference = None
+    for method, func in [("post process (separate)", separate), ("post process (fused)", fused)]:
+        seconds = []
+        for i in range(n_repeats):
+            image = os.path.join(workspace, "CONUS_LAMDA_Z_bench_{}.tif".format(i))
+            shutil.copy(raw, image)
+            start = time.perf_counter()
+            change, no_data = func(image)
+            seconds.append(time.perf_counter() - start)
+
+            out_8bit = rpl.get_8bit_name(image, stretch)
+            out = [gdal.Open(out_8bit).ReadAsArray(), change, no_data]
+            if reference is None:
+                reference = out
+            elif not all(numpy.array_equal(a, b) for a, b in zip(reference, out)):
+                print("Outputs of {} do not match the separate steps".format(method))
+
+            for f in rpl.list_persistence_masks(image):
+                os.remove(f)
+            for f in os.listdir(workspace):
+                if f.startswith("CONUS_LAMDA_Z_bench_{}".format(i)):
+                    os.remove(os.path.join(workspace, f))
+        best = min(seconds)
+        results.append({"method": method, "mpix": mpix, "seconds": best, "mpix_per_second": mpix / best})
+
+    if cleanup:
+        shutil.rmtree(workspace)
+
+    print_results(results)
+    return results
+
+
+####################################################################################################
+# Compare percentile reducers on a synthetic chunk of n_obs observations of an n_bands band index stack
+# local_stats_lib.nanpercentile needs the whole (time, bands, rows, columns) cube while PercentileSketch is
+# updated one image at a time with n_bins bins (memory is set by n_bins, not n_obs)
+# Each method's peak memory (numpy allocations traced with tracemalloc) and its error against the exact percentile are reported
+# numpy.nanpercentile is too slow to run on a whole chunk (minutes), so it's checked against the exact percentile
+# on a check_size x check_size corner and only timed on the whole chunk if time_numpy is True
+def benchmark_percentile_sketch(width=512, height=512, n_obs=64, n_bands=2, percentile=70, bins_list=[64, 128, 256, 512], value_range=(-1.0, 1.0), masked_fraction=0.5, check_size=64, time_numpy=False, seed=0):
+    shape = (n_bands, height, width)
+    mpix = width * height / 1e6
+
+    # Images are made one at a time from a seed so the full cube is only built by the methods that need it
+    def images():
+        rng = numpy.random.default_rng(seed)
+        for i in range(n_obs):
+            values = rng.normal(0.4, 0.15, shape).astype("float32")
+            values[rng.random(shape) < masked_fraction] = numpy.nan
+            yield values
+
+    def exact(func):
+        stack = numpy.stack(list(images()))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return func(stack, percentile, axis=0) if func == numpy.nanpercentile else func(stack, percentile)
+
+    def sketch(n_bins):
+        s = lsl.PercentileSketch(shape, value_range, n_bins)
+        for values in images():
+            s.add(values)
+        return s.percentile(percentile)
+
+    methods = [("nanpercentile (exact)", lambda: exact(lsl.nanpercentile))]
+    if time_numpy:
+        methods.append(("numpy.nanpercentile", lambda: exact(numpy.nanpercentile)))
+    methods += [("sketch ({} bins)".format(n_bins), (lambda n_bins: lambda: sketch(n_bins))(n_bins)) for n_bins in bins_list]
+
+    # Time making the images on their own so it can be taken out of each method's time
+    image_seconds = time_call(lambda: [None for values in images()])
+
+    results = []
+    reference = None
+    for method, func in methods:
+        tracemalloc.start()
+        start = time.perf_counter()
+        out = func()
+        seconds = max(time.perf_counter() - start - image_seconds, 1e-9)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        if reference is None:
+            reference = out.astype("float64")
+            corner = numpy.stack([values[:, :check_size, :check_size] for values in images()])
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                numpy_corner = numpy.nanpercentile(corner, percentile, axis=0)
+            if not numpy.allclose(reference[:, :check_size, :check_size], numpy_corner, equal_nan=True):
+                print("Exact percentile does not match numpy.nanpercentile")
+        error = numpy.abs(out.astype("float64") - reference)
+        results.append(
+            {
+                "method": method,
+                "mpix": mpix,
+                "seconds": seconds,
+                "mpix_per_second": mpix / seconds,
+                "peak_mb": peak / 1024.0 / 1024.0,
+                "max_error": float(numpy.nanmax(error)),
+                "mean_error": float(numpy.nanmean(error)),
+            }
+        )
+
+    print("{:<30}{:>12}{:>12}{:>12}{:>12}{:>12}{:>12}".format("method", "MPix", "seconds", "MPix/s", "peak MB", "max error", "mean error"))
+    for r in results:
+        print("{:<30}{:>12.2f}{:>12.3f}{:>12.2f}{:>12.1f}{:>12.5f}{:>12.5f}".format(r["method"], r["mpix"], r["seconds"], r["mpix_per_second"], r["peak_mb"], r["max_error"], r["mean_error"]))
+    return results
+
+
+####################################################################################################
+# Compare output profiles (compression codecs, predictors, and threads) on synthetic int16 raw and 8 bit rasters
+# Each profile is used to write a COGtif from memory and the write time, full read time, and file size are reported
+# Profiles are dicts of raster_processing_lib.output_profiles settings
+def benchmark_output_profiles(width=4096, height=4096, profiles=None, workspace=None):
+    cleanup = workspace == None
+    if workspace == None:
+        workspace = tempfile.mkdtemp()
+
+    if profiles == None:
+        profiles = {
+            "DEFLATE": {"compress": "DEFLATE", "predictor": None, "num_threads": None},
+            "DEFLATE pred2": {"compress": "DEFLATE", "predictor": 2, "num_threads": None},
+            "DEFLATE pred2 threads": {"compress": "DEFLATE", "predictor": 2, "num_threads": "ALL_CPUS"},
+            "ZSTD pred2 threads": {"compress": "ZSTD", "predictor": 2, "num_threads": "ALL_CPUS"},
+            "LERC_ZSTD 0.5 threads": {"compress": "LERC_ZSTD", "max_z_error": 0.5, "num_threads": "ALL_CPUS"},
+            "LERC_ZSTD 5 threads": {"compress": "LERC_ZSTD", "max_z_error": 5, "num_threads": "ALL_CPUS"},
+        }
+
+    raw = make_synthetic_raster(os.path.join(workspace, "CONUS_LAMDA_Z_bench_raw.tif"), width, height)
+    raw_ds = gdal.Translate("", raw, format="MEM")
+    byte_ds = gdal.Translate("", raw, format="MEM", outputType=gdal.GDT_Byte, scaleParams=[[-5000, 5000, 0, 254]], noData=255)
+    mpix = width * height / 1e6
+    original_profiles = {kind: dict(rpl.output_profiles[kind]) for kind in rpl.output_profiles.keys()}
+
+    results = []
+    for kind, source in [("raw", raw_ds), ("byte", byte_ds)]:
+        for name, profile in profiles.items():
+            rpl.set_output_profile(kind, **profile)
+            out_image = os.path.join(workspace, "bench_{}.tif".format(kind))
+
+            write_seconds = time_call(gdal.GetDriverByName("COG").CreateCopy, out_image, source, options=rpl.get_cog_options(kind))
+            read_seconds = time_call(lambda: gdal.Open(out_image).ReadAsArray())
+            size = os.path.getsize(out_image)
+            gdal.GetDriverByName("GTiff").Delete(out_image)
+            rpl.set_output_profile(kind, **original_profiles[kind])
+
+            results.append({"kind": kind, "profile": name, "mpix": mpix, "write_seconds": write_seconds, "read_seconds": read_seconds, "mbytes": size / 1e6})
+
+    raw_ds = None
+    byte_ds = None
+    if cleanup:
+        shutil.rmtree(workspace)
+
+    print("{:<6}{:<26}{:>12}{:>12}{:>12}".format("kind", "profile", "write s", "read s", "MB"))
+    for r in results:
+        print("{:<6}{:<26}{:>12.3f}{:>12.3f}{:>12.2f}".format(r["kind"], r["profile"], r["write_seconds"], r["read_seconds"], r["mbytes"]))
+    return results
+
+
+####################################################################################################
+# Benchmark suite
+# Each (method, size, worker count) case is run in its own process so peak RSS is measured per case
+# Results are written out as JSON so regressions and improvements can be tracked across runs
+####################################################################################################
+# Get the peak resident set size (MB) of this process and any finished child processes
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+
+            return psutil.Process().memory_info().peak_wset / 1e6
+        except Exception:
+            return None
+
+    # ru_maxrss is in bytes on macOS and KB elsewhere
+    scale = 1 if sys.platform == "darwin" else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale / 1e6
+
+
+# Total size (bytes) of all files in a folder
+def folder_bytes(folder):
+    return sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+
+
+# Run a single benchmarked method on one input (used by both serial and process pool runs)
+def run_method(method, image, out_dir, crs):
+    out_image = os.path.join(out_dir, os.path.basename(image))
+    if method == "update_cog":
+        shutil.copy(image, out_image)
+        rpl.update_cog(out_image, crs, -32768, update_stats=True, stat_stretch_type="stdDev", stretch_n_stdDev=5)
+    elif method == "stretch_to_8bit":
+        rpl.stretch_to_8bit_streaming(image, os.path.splitext(out_image)[0] + "_5_8bit.tif", -32768, 1000, 5, ["a83800", "ff5500", "e0e0e0", "a4ff73", "38a800"])
+    elif method == "translate":
+        rpl.translate(image, os.path.splitext(out_image)[0] + ".jpg")
+    elif method == "translate_preview":
+        rpl.translate_preview(image, os.path.splitext(out_image)[0] + ".jpg")
+    elif method == "convert_to_cog":
+        rpl.translate(image, os.path.splitext(out_image)[0] + "_cog.tif", dict(rpl.cogArgs))
+
+
+# Run one benchmark case and put its results on the queue
+def run_case(method, inputs, out_dir, n_workers, crs, queue):
+    start = time.perf_counter()
+    if method == "calc_persistence":
+        outputs = [os.path.join(out_dir, "persistence_{}.tif".format(i)) for i in range(len(inputs) - 2)]
+        rpl.calc_persistence_rolling(inputs, outputs, 1000, -2.5, 3)
+    elif n_workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(n_workers) as pool:
+            for f in [pool.submit(run_method, method, image, out_dir, crs) for image in inputs]:
+                f.result()
+    else:
+        for image in inputs:
+            run_method(method, image, out_dir, crs)
+    seconds = time.perf_counter() - start
+
+    queue.put({"seconds": seconds, "peak_rss_mb": peak_rss_mb(), "bytes_written": folder_bytes(out_dir)})
+
+
+# Run the benchmark suite across methods, raster sizes, and worker counts
+# n_files synthetic raw rasters are made for each size (these are also the periods used for persistence)
+def run_benchmark_suite(grid="CONUS", fractions=size_fractions, worker_counts=[1, 2, 4], methods=["update_cog", "stretch_to_8bit", "calc_persistence", "translate", "translate_preview", "convert_to_cog"], n_files=4, output_json=None, workspace=None):
+    cleanup = workspace == None
+    if workspace == None:
+        workspace = tempfile.mkdtemp()
+
+    crs = osr.SpatialReference()
+    crs.ImportFromEPSG(5070)
+    crs = crs.ExportToWkt()
+
+    results = []
+    for fraction in fractions:
+        width = int(grid_dict[grid]["width"] * fraction)
+        height = int(grid_dict[grid]["height"] * fraction)
+        mpix = width * height / 1e6
+
+        # Set up synthetic raw inputs (one per 8 day period) and 8 bit versions of them for the translate methods
+        in_dir = os.path.join(workspace, "inputs_{}".format(fraction))
+        os.makedirs(in_dir)
+        raws = []
+        for i in range(n_files):
+            jd = 145 + i * 8
+            raw = os.path.join(in_dir, "{}_LAMDA_Z_NBR_bl2020-2022_ay2024_jd{}-{}.tif".format(grid, jd, jd + 15))
+            raws.append(make_synthetic_raster(raw, width, height, transform=grid_dict[grid]["transform"], seed=i))
+        stretched = []
+        for raw in raws:
+            stretched.append(os.path.splitext(raw)[0] + "_5_8bit.tif")
+            rpl.stretch_to_8bit_streaming(raw, stretched[-1], -32768, 1000, 5, ["a83800", "ff5500", "e0e0e0", "a4ff73", "38a800"])
+
+        for method in methods:
+            inputs = stretched if method.startswith("translate") else raws
+            for n_workers in worker_counts:
+                if method == "calc_persistence" and n_workers > 1:
+                    continue
+
+                out_dir = os.path.join(workspace, "outputs")
+                os.makedirs(out_dir)
+
+                queue = multiprocessing.Queue()
+                p = multiprocessing.Process(target=run_case, args=(method, inputs, out_dir, n_workers, crs, queue))
+                p.start()
+                r = queue.get()
+                p.join()
+                shutil.rmtree(out_dir)
+
+                r.update({"method": method, "grid": grid, "width": width, "height": height, "n_files": len(inputs), "n_workers": n_workers})
+                r["mpix_per_second"] = mpix * len(inputs) / r["seconds"]
+                print("{:<20}{:>8}x{:<8}{:>4} workers{:>10.2f} MPix/s{:>10.1f} MB RSS".format(method, width, height, n_workers, r["mpix_per_second"], r["peak_rss_mb"] or 0))
+                results.append(r)
+
+        shutil.rmtree(in_dir)
+
+    if cleanup:
+        shutil.rmtree(workspace)
+
+    out = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "gdal": gdal.__version__,
+        "numpy": numpy.__version__,
+        "cpu_count": os.cpu_count(),
+        "output_profiles": rpl.output_profiles,
+        "results": results,
+    }
+    if output_json != None:
+        o = open(output_json, "w")
+        o.write(json.dumps(out, indent=2))
+        o.close()
+    return out
+
+
+####################################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark LAMDA local post-processing")
+    parser.add_argument("--suite", action="store_true", help="Run the full benchmark suite instead of the quick comparisons")
+    parser.add_argument("--fractions", type=float, nargs="+", default=size_fractions, help="Sizes as fractions of the CONUS grid")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts")
+    parser.add_argument("--n_files", type=int, default=4, help="Number of synthetic rasters (periods) per size")
+    parser.add_argument("--output", default="lamda_benchmarks.json", help="JSON file to write suite results to")
+    parser.add_argument("--workspace", default=None, help="Scratch folder (a temp folder is used if not provided)")
+    args = parser.parse_args()
+
+    if args.suite:
+        run_benchmark_suite(fractions=args.fractions, worker_counts=args.workers, n_files=args.n_files, output_json=args.output, workspace=args.workspace)
+    else:
+        benchmark_update_cog()
+        benchmark_stretch_to_8bit()
+        benchmark_fused_post_process()
+        benchmark_output_profiles()
+        benchmark_percentile_sketch()
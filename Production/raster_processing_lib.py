@@ -20,15 +20,93 @@ from osgeo import gdal
 from osgeo import gdal_array
 from osgeo import osr, ogr
 from osgeo import gdalconst
-import numpy, os
+import numpy, os, time, functools
+import LAMDA_instrumentation as li
+import LAMDA_products as lp
+import raster_block_lib as rbl
 
 gdal.DontUseExceptions()
 
 
+####################################################################################################
+# Output profiles used by every COGtif writer
+# "raw" is used for raw Z and TDD outputs and "byte" is used for 8 bit and persistence outputs
+# The defaults write the same COMPRESS=DEFLATE outputs as always. Anything else is opt in with set_output_profile
+# compress: DEFLATE, ZSTD, LERC, LERC_DEFLATE, or LERC_ZSTD
+# predictor: 1 (none), 2 (horizontal differencing), or 3 (floating point) (not used with LERC) (None uses GDAL's default of none)
+# level: DEFLATE/ZSTD compression level (None uses GDAL's default)
+# max_z_error: maximum error allowed by LERC in the units of the raw values (0 is lossless)
+# blocksize: tile size (None uses the driver's default)
+# num_threads: number of threads each writer compresses with (None is a single thread)
+#   Writers already run in parallel in post processing workers (or the scheduler's cpu pool),
+#   so only raise this to about the number of cores divided by the number of workers (ALL_CPUS oversubscribes them)
+output_profiles = {
+    "raw": {"compress": "DEFLATE", "predictor": None, "level": None, "max_z_error": 0, "blocksize": None, "num_threads": None},
+    "byte": {"compress": "DEFLATE", "predictor": None, "level": None, "max_z_error": 0, "blocksize": None, "num_threads": None},
+}
+
+
+# Function to update an output profile
+# e.g. set_output_profile("raw", compress="LERC_ZSTD", max_z_error=0.5)
+def set_output_profile(kind, **kwargs):
+    output_profiles[kind].update(kwargs)
+    if kind == "raw":
+        cogArgs["creationOptions"] = get_cog_options("raw")
+
+
+# Get GTiff creation options for an output profile
+def get_gtiff_options(kind="raw"):
+    profile = output_profiles[kind]
+    options = ["TILED=YES", "COMPRESS={}".format(profile["compress"]), "BIGTIFF=IF_SAFER"]
+    if profile["blocksize"] != None:
+        options += ["BLOCKXSIZE={}".format(profile["blocksize"]), "BLOCKYSIZE={}".format(profile["blocksize"])]
+    if profile["compress"].startswith("LERC"):
+        options.append("MAX_Z_ERROR={}".format(profile["max_z_error"]))
+    elif profile["predictor"] != None:
+        options.append("PREDICTOR={}".format(profile["predictor"]))
+    if profile["level"] != None:
+        options.append("{}={}".format("ZSTD_LEVEL" if profile["compress"].endswith("ZSTD") else "ZLEVEL", profile["level"]))
+    if profile["num_threads"] != None:
+        options.append("NUM_THREADS={}".format(profile["num_threads"]))
+    return options
+
+
+# Get COG driver creation options for an output profile
+def get_cog_options(kind="raw"):
+    profile = output_profiles[kind]
+    options = ["COMPRESS={}".format(profile["compress"]), "BIGTIFF=IF_SAFER"]
+    if profile["blocksize"] != None:
+        options.append("BLOCKSIZE={}".format(profile["blocksize"]))
+    if profile["compress"].startswith("LERC"):
+        options.append("MAX_Z_ERROR={}".format(profile["max_z_error"]))
+    elif profile["predictor"] != None:
+        options.append("PREDICTOR={}".format({1: "NO", 2: "STANDARD", 3: "FLOATING_POINT"}[profile["predictor"]]))
+    if profile["level"] != None:
+        options.append("LEVEL={}".format(profile["level"]))
+    if profile["num_threads"] != None:
+        options.append("NUM_THREADS={}".format(profile["num_threads"]))
+    return options
+
+
 ####################################################################################################
 # Method for updating projection, no data, and stats of image and ensuring output is a valid COGtif
+# By default this is a fused single read of the raw image (see update_cog_fused)
+# Set fused to False to use the original in place update, overview build, and copy
+# Stats are written into the tif itself when it is rewritten
+# (or to its uploaded sidecar when it is already a COG with the right crs and no data, see update_cog_header)
+# If approx_stats is True, the original method computes stats from the overviews (or a subsample of blocks) and they are only approximate
 # Cog methods adapted from: https://geoexamples.com/other/2019/02/08/cog-tutorial.html/
-def update_cog(image, crs, no_data_value=-9999, update_stats=True, stat_stretch_type="stdDev", stretch_n_stdDev=4):
+def update_cog(image, crs, no_data_value=-9999, update_stats=True, stat_stretch_type="stdDev", stretch_n_stdDev=4, fused=True, approx_stats=False, header_only=True):
+    # If the image is already a valid COG with the right crs and no data, skip rewriting the pixels
+    if header_only and is_cog(image):
+        if update_cog_header(image, crs, no_data_value, update_stats, stat_stretch_type, stretch_n_stdDev, approx_stats):
+            return
+        print("Crs or no data need updated. Rewriting: ", image)
+
+    if fused:
+        update_cog_fused(image, crs, no_data_value, update_stats, stat_stretch_type, stretch_n_stdDev, approx_stats)
+        return
+
     print("Updating crs and no data and preserving COG layout for: ", image)
     cog_image = "{}_cog{}".format(os.path.splitext(image)[0], os.path.splitext(image)[1])
 
@@ -39,14 +117,189 @@ def update_cog(image, crs, no_data_value=-9999, update_stats=True, stat_stretch_
     # Set up COGtif bits that likely got broken when updating the projection etc
     rast = gdal.Open(image, gdal.GA_Update)
     rast.BuildOverviews("NEAREST", [2, 4, 8, 16, 32, 64])
+    size = (rast.RasterXSize, rast.RasterYSize, rast.RasterCount)
     driver = gdal.GetDriverByName("GTiff")
-    ds2 = driver.CreateCopy(cog_image, rast, options=["COPY_SRC_OVERVIEWS=YES", "TILED=YES", "COMPRESS=DEFLATE"])
+    ds2 = driver.CreateCopy(cog_image, rast, options=["COPY_SRC_OVERVIEWS=YES"] + get_gtiff_options("raw"))
     rast = None
     ds2 = None
 
-    # Remove the old file and rename the temp cog file
-    os.remove(image)
-    os.rename(cog_image, image)
+    # Replace the old file with the temp cog file
+    replace_with_copy(cog_image, image, *size)
+
+
+####################################################################################################
+# Fused version of update_cog
+# Each block of the raw image is read once and written with the corrected crs and no data to an uncompressed tiled scratch tif
+# Exact stats are summed from the same blocks as they are written (see raster_block_lib.RunningStats),
+# so the raw image is only decoded once. Overviews are then built from the scratch tif and copied into the final COGtif layout
+# approx_stats isn't used since exact stats come from the same read
+# The raw image is never modified in place
+def update_cog_fused(image, crs, no_data_value=-9999, update_stats=True, stat_stretch_type="stdDev", stretch_n_stdDev=4, approx_stats=False):
+    print("Updating crs and no data and writing COG for: ", image)
+    driver = gdal.GetDriverByName("GTiff")
+    tmp_image = "{}_raw_tmp.tif".format(os.path.splitext(image)[0])
+    cog_image = "{}_cog{}".format(os.path.splitext(image)[0], os.path.splitext(image)[1])
+
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(crs)
+
+    rast = gdal.Open(image)
+    band1 = rast.GetRasterBand(1)
+    width = rast.RasterXSize
+    height = rast.RasterYSize
+    stats = rbl.RunningStats()
+
+    ds = None
+    b = None
+    error = None
+    try:
+        ds = driver.Create(tmp_image, width, height, 1, band1.DataType, options=["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512", "BIGTIFF=IF_SAFER"])
+        ds.SetProjection(srs.ExportToWkt())
+        ds.SetGeoTransform(rast.GetGeoTransform())
+        b = ds.GetRasterBand(1)
+        b.SetNoDataValue(no_data_value)
+
+        for xoff, yoff, xsize, ysize in iter_blocks(band1):
+            block = band1.ReadAsArray(xoff, yoff, xsize, ysize)
+            b.WriteArray(block, xoff, yoff)
+            if update_stats:
+                stats.add(block[block != no_data_value])
+        rast = None
+        band1 = None
+
+        # Update stats
+        if stats.get_stats() != None:
+            set_band_stats(b, *stats.get_stats(), stat_stretch_type, stretch_n_stdDev)
+
+        # Write out the COGtif and replace the old file with it
+        ds.BuildOverviews("NEAREST", [2, 4, 8, 16, 32, 64])
+        ds2 = driver.CreateCopy(cog_image, ds, options=["COPY_SRC_OVERVIEWS=YES"] + get_gtiff_options("raw"))
+        ds2 = None
+        b = None
+        ds = None
+        replace_with_copy(cog_image, image, width, height)
+
+    except Exception as e:
+        print(e)
+        error = e
+
+    rast = None
+    band1 = None
+    b = None
+    ds = None
+
+    # Remove the scratch tifs
+    for tmp in [tmp_image, cog_image]:
+        if os.path.exists(tmp):
+            driver.Delete(tmp)
+
+    if error != None:
+        raise error
+
+
+####################################################################################################
+# Replace an image with a copy of it (e.g. its COGtif) once the copy is known to be good
+# GDAL doesn't raise when a copy fails, so the copy must open with the expected size and number of bands
+# The copy is then renamed over the image in a single step, so a failed copy never loses the image
+# Any stats sidecar of the old image is removed since it would hide the stats of the copy
+def replace_with_copy(copy_image, image, width, height, n_bands=1):
+    copy = gdal.Open(copy_image) if os.path.exists(copy_image) else None
+    ok = copy != None and copy.RasterXSize == width and copy.RasterYSize == height and copy.RasterCount == n_bands
+    copy = None
+    if not ok:
+        raise RuntimeError("Failed to write {}. Keeping {}".format(copy_image, image))
+    os.replace(copy_image, image)
+    if os.path.exists(get_stats_sidecar_name(image)):
+        os.remove(get_stats_sidecar_name(image))
+
+
+####################################################################################################
+# Check whether an image has a valid COG layout
+# Adapted from the checks in GDAL's validate_cloud_optimized_geotiff.py:
+# the image must be a tiled GeoTIFF with internal overviews, the main IFD must be at the start of the file,
+# IFDs must be in increasing order and the data of the smallest overview must come first
+def is_cog(image):
+    rast = gdal.Open(image)
+    if rast == None or rast.GetDriver().ShortName != "GTiff":
+        return False
+
+    b = rast.GetRasterBand(1)
+    width = rast.RasterXSize
+    height = rast.RasterYSize
+    block_x, block_y = b.GetBlockSize()
+    file_list = rast.GetFileList() or []
+    bands = [b] + [b.GetOverview(i) for i in range(b.GetOverviewCount())]
+    ifd_offsets = [int(band.GetMetadataItem("IFD_OFFSET", "TIFF") or 0) for band in bands]
+    data_offsets = [int(band.GetMetadataItem("BLOCK_OFFSET_0_0", "TIFF") or 0) for band in bands]
+    rast = None
+    b = None
+    bands = None
+
+    # Must be tiled and have internal overviews (if larger than a single block)
+    if block_x == width and width > 512:
+        return False
+    if len(ifd_offsets) == 1 and max(width, height) > 512:
+        return False
+    if len([f for f in file_list if os.path.splitext(f)[1].lower() == ".ovr"]) > 0:
+        return False
+
+    # Main IFD must be at the start of the file followed by the overview IFDs
+    if ifd_offsets[0] not in [8, 16]:
+        return False
+    for i in range(1, len(ifd_offsets)):
+        if ifd_offsets[i] <= ifd_offsets[i - 1]:
+            return False
+
+    # Data of each overview must come before the data of the next larger resolution
+    # (offsets of 0 are empty sparse blocks)
+    for i in range(1, len(data_offsets)):
+        if data_offsets[i] != 0 and data_offsets[i - 1] != 0 and data_offsets[i] >= data_offsets[i - 1]:
+            return False
+    return True
+
+
+####################################################################################################
+# Header only version of update_cog for images that are already valid COGs
+# Nothing in the tif is changed: adding or growing a tag (e.g. GDAL_NODATA or the GDAL_METADATA that holds stats)
+# grows the IFD, which libtiff then moves to the end of the file, breaking the COG layout
+# So this only applies if the crs and no data already match what is provided (returns False otherwise so the image is rewritten)
+# and stats are written to the image's .aux.xml sidecar, which is uploaded along with it (see get_stats_sidecar_name)
+# If approx_stats is True, stats are computed from the overviews and are only approximate
+def update_cog_header(image, crs, no_data_value=-9999, update_stats=True, stat_stretch_type="stdDev", stretch_n_stdDev=4, approx_stats=False):
+    if not header_matches(image, crs, no_data_value):
+        return False
+
+    print("Crs and no data of existing COG are already set: ", image)
+    if update_stats:
+        rast = gdal.Open(image)
+        update_band_stats(rast.GetRasterBand(1), stat_stretch_type, stretch_n_stdDev, approx_stats)
+        rast = None
+    return True
+
+
+# Check whether the crs and no data of an image already match what is provided
+def header_matches(image, crs, no_data_value):
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(crs)
+
+    rast = gdal.Open(image)
+    current_srs = rast.GetSpatialRef()
+    matches = current_srs != None and current_srs.IsSame(srs) and rast.GetRasterBand(1).GetNoDataValue() == no_data_value
+    rast = None
+    return bool(matches)
+
+
+# Get the name of the sidecar that holds the stats of an image that wasn't rewritten
+# GDAL writes stats set on an image opened read only to this sidecar
+def get_stats_sidecar_name(image):
+    return image + ".aux.xml"
+
+
+# Write already computed stats of an image to its sidecar without changing the image
+def write_stats_sidecar(image, Min, Max, Mean, Std, stat_stretch_type="stdDev", stretch_n_stdDev=4):
+    rast = gdal.Open(image)
+    set_band_stats(rast.GetRasterBand(1), Min, Max, Mean, Std, stat_stretch_type, stretch_n_stdDev)
+    rast = None
 
 
 ####################################################################################################
@@ -67,30 +320,234 @@ def set_no_data(image, no_data_value=-9999, update_stats=True, stat_stretch_type
     b = rast.GetRasterBand(1)
     b.SetNoDataValue(no_data_value)
     if update_stats:
-        Min, Max, Mean, Std = b.ComputeStatistics(0)
-        if stat_stretch_type == "stdDev":
-            Min = Mean - (stretch_n_stdDev * Std)
-            Max = Mean + (stretch_n_stdDev * Std)
-        b.SetStatistics(Min, Max, Mean, Std)
-
-        print(("Min:", Min))
-        print(("Max:", Max))
-        print(("Mean:", Mean))
-        print(("Std:", Std))
+        update_band_stats(b, stat_stretch_type, stretch_n_stdDev)
     rast = None
     b = None
 
 
+####################################################################################################
+# Compute and set the stats of a band
+# If stat_stretch_type isn't set to stdDev, min-max will be used
+def update_band_stats(b, stat_stretch_type="stdDev", stretch_n_stdDev=4, approx_ok=False):
+    Min, Max, Mean, Std = b.ComputeStatistics(approx_ok)
+    return set_band_stats(b, Min, Max, Mean, Std, stat_stretch_type, stretch_n_stdDev)
+
+
+# Set already computed stats of a band
+# If stat_stretch_type isn't set to stdDev, min-max will be used
+def set_band_stats(b, Min, Max, Mean, Std, stat_stretch_type="stdDev", stretch_n_stdDev=4):
+    if stat_stretch_type == "stdDev":
+        Min = Mean - (stretch_n_stdDev * Std)
+        Max = Mean + (stretch_n_stdDev * Std)
+    b.SetStatistics(Min, Max, Mean, Std)
+
+    print(("Min:", Min))
+    print(("Max:", Max))
+    print(("Mean:", Mean))
+    print(("Std:", Std))
+    return Min, Max, Mean, Std
+
+
+####################################################################################################
+# Set up GDAL in a post processing worker
+# Each worker gets its own GDAL block cache of gdal_cache_mb (GDAL's default is kept if None)
+# Output profiles of the parent process can be passed so spawned workers write the same outputs
+def init_worker(gdal_cache_mb=None, profiles=None):
+    if gdal_cache_mb != None:
+        gdal.SetCacheMax(int(gdal_cache_mb * 1024 * 1024))
+    if profiles != None:
+        for kind in profiles.keys():
+            set_output_profile(kind, **profiles[kind])
+
+
+####################################################################################################
+# Post process a single raw output
+# Updates the COG (if update is True) and stretches it to 8 bit
+# If fused is True, this is done in a single read of the raw image (see post_process_tif_fused)
+# and the persistence masks are saved too if thresh is provided
+# Returns the image, whether the COG was updated, and the wall time in seconds
+def post_process_tif(tif, crs, no_data_value, scale_factor, stretch, palette, update=True, thresh=None, fused=True):
+    start = time.time()
+    pixels = 0
+    if li.is_enabled():
+        rast = gdal.Open(tif)
+        pixels = rast.RasterXSize * rast.RasterYSize
+        rast = None
+
+    if fused:
+        with li.span("post_process_fused", os.path.basename(tif), update=update) as s:
+            post_process_tif_fused(tif, crs, no_data_value, scale_factor, stretch, palette, update, thresh, stat_stretch_type="stdDev", stretch_n_stdDev=5)
+            s.add(pixels=pixels)
+        return tif, update, time.time() - start
+
+    if update:
+        with li.span("cog_fix", os.path.basename(tif)) as s:
+            update_cog(tif, crs, no_data_value, update_stats=True, stat_stretch_type="stdDev", stretch_n_stdDev=5)
+            s.add(pixels=pixels)
+
+    with li.span("8bit", os.path.basename(tif)) as s:
+        stretch_to_8bit(tif, no_data_value, scale_factor, stretch, palette)
+        s.add(pixels=pixels)
+    return tif, update, time.time() - start
+
+
+####################################################################################################
+# Fused post processing of a single raw output
+# Each block of the raw image is read once and handed to every output:
+#   the raw COGtif (written with the corrected crs and no data to an uncompressed tiled scratch tif)
+#   the running stats (exact, from every valid pixel)
+#   the 8 bit stretch (written to its own scratch tif)
+#   the persistence change and no data masks (if thresh is provided, written to a compressed tif, see get_persistence_mask_name)
+# Overviews are then built from the scratch tifs and copied into the final COGtif layouts
+# and the jpg preview is made from the 8 bit overviews, so the raw image is never decoded again
+# Each output replaces its old file only once its copy is known to be good, so a failed write never loses the raw image
+# The raw COGtif is only rewritten if update is True and it isn't already a COG with the right crs and no data
+# (its stats are then written to its sidecar, see update_cog_header) and the 8 bit output is only made if it doesn't exist
+def post_process_tif_fused(tif, crs, no_data_value, scale_factor, stretch, palette, update=True, thresh=None, stat_stretch_type="stdDev", stretch_n_stdDev=4, out_min=0, out_max=254, out_no_data=255):
+    out_8bit = get_8bit_name(tif, stretch)
+    write_8bit = not os.path.exists(out_8bit)
+    write_masks = thresh != None and (update or not has_persistence_masks(tif, scale_factor, thresh))
+    if not update and not write_8bit and not write_masks:
+        return
+
+    print("Fused post processing for: ", tif)
+    driver = gdal.GetDriverByName("GTiff")
+    scratch_options = ["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512", "BIGTIFF=IF_SAFER"]
+    tmp_raw = "{}_raw_tmp.tif".format(os.path.splitext(tif)[0])
+    tmp_8bit = "{}_tmp.tif".format(os.path.splitext(out_8bit)[0])
+    cog_image = "{}_cog{}".format(os.path.splitext(tif)[0], os.path.splitext(tif)[1])
+    cog_8bit = "{}_cog{}".format(os.path.splitext(out_8bit)[0], os.path.splitext(out_8bit)[1])
+    mask_name = get_persistence_mask_name(tif, scale_factor, thresh)
+    tmp_mask = "{}_tmp.tif".format(os.path.splitext(mask_name)[0])
+
+    rast = gdal.Open(tif)
+    band1 = rast.GetRasterBand(1)
+    width = rast.RasterXSize
+    height = rast.RasterYSize
+    projection = rast.GetProjection()
+    geotransform = rast.GetGeoTransform()
+    is_int16 = band1.DataType == gdal.GDT_Int16
+    rewrite_raw = update and not (is_cog(tif) and header_matches(tif, crs, no_data_value))
+
+    raw_ds = None
+    raw_b = None
+    if rewrite_raw:
+        srs = osr.SpatialReference()
+        srs.SetFromUserInput(crs)
+        projection = srs.ExportToWkt()
+        raw_ds = driver.Create(tmp_raw, width, height, 1, band1.DataType, options=scratch_options)
+        raw_ds.SetProjection(projection)
+        raw_ds.SetGeoTransform(geotransform)
+        raw_b = raw_ds.GetRasterBand(1)
+        raw_b.SetNoDataValue(no_data_value)
+
+    ds_8bit = None
+    b_8bit = None
+    lut = None
+    if write_8bit:
+        ds_8bit = driver.Create(tmp_8bit, width, height, 1, gdal.GDT_Byte, options=scratch_options)
+        ds_8bit.SetProjection(projection)
+        ds_8bit.SetGeoTransform(geotransform)
+        b_8bit = ds_8bit.GetRasterBand(1)
+        set_8bit_band_info(b_8bit, palette, stretch, out_min, out_max, out_no_data)
+        if is_int16:
+            lut = get_stretch_lut(no_data_value, scale_factor, stretch, out_min, out_max, out_no_data)
+
+    mask_ds = None
+    mask_b = None
+    if write_masks:
+        mask_ds = create_persistence_mask_tif(tmp_mask, width, height, projection, geotransform)
+        mask_b = mask_ds.GetRasterBand(1)
+
+    # Running stats (exact, see raster_block_lib.RunningStats)
+    stats = rbl.RunningStats()
+
+    error = None
+    try:
+        for xoff, yoff, xsize, ysize in iter_blocks(band1):
+            block = band1.ReadAsArray(xoff, yoff, xsize, ysize)
+
+            if raw_b != None:
+                raw_b.WriteArray(block, xoff, yoff)
+            if update:
+                stats.add(block[block != no_data_value])
+
+            if b_8bit != None:
+                if lut is not None:
+                    out = lut[block.view("uint16")]
+                else:
+                    out = rbl.stretch_block(block, no_data_value, scale_factor, stretch, out_min, out_max, out_no_data)
+                b_8bit.WriteArray(out, xoff, yoff)
+
+            if mask_b != None:
+                mask_b.WriteArray(rbl.pack_persistence_masks(block, scale_factor, thresh, no_data_value), xoff, yoff)
+        rast = None
+        band1 = None
+
+        # Stats of a raw COGtif that is kept as is
+        if update and raw_ds == None and stats.get_stats() != None:
+            write_stats_sidecar(tif, *stats.get_stats(), stat_stretch_type, stretch_n_stdDev)
+
+        # Write out the raw COGtif and replace the raw image with it
+        if raw_ds != None:
+            if stats.get_stats() != None:
+                set_band_stats(raw_b, *stats.get_stats(), stat_stretch_type, stretch_n_stdDev)
+            raw_ds.BuildOverviews("NEAREST", [2, 4, 8, 16, 32, 64])
+            ds2 = driver.CreateCopy(cog_image, raw_ds, options=["COPY_SRC_OVERVIEWS=YES"] + get_gtiff_options("raw"))
+            ds2 = None
+            raw_b = None
+            raw_ds = None
+            replace_with_copy(cog_image, tif, width, height)
+
+        # Write out the 8 bit COGtif and its preview
+        if ds_8bit != None:
+            ds_8bit.BuildOverviews("NEAREST", [2, 4, 8, 16, 32, 64])
+            ds2 = driver.CreateCopy(cog_8bit, ds_8bit, options=["COPY_SRC_OVERVIEWS=YES"] + get_gtiff_options("byte"))
+            ds2 = None
+            b_8bit = None
+            ds_8bit = None
+            replace_with_copy(cog_8bit, out_8bit, width, height)
+            translate_preview(out_8bit, os.path.splitext(out_8bit)[0] + ".jpg")
+
+        # Put the persistence masks in place (after the raw image is replaced so they are newer than it)
+        if mask_ds != None:
+            mask_b = None
+            mask_ds = None
+            replace_with_copy(tmp_mask, mask_name, width, height)
+            os.utime(mask_name)
+
+    except Exception as e:
+        print(e)
+        error = e
+
+    rast = None
+    band1 = None
+    raw_b = None
+    raw_ds = None
+    b_8bit = None
+    ds_8bit = None
+    mask_b = None
+    mask_ds = None
+
+    # Remove the scratch tifs
+    for tmp in [tmp_raw, tmp_8bit, cog_image, cog_8bit, tmp_mask]:
+        if os.path.exists(tmp):
+            driver.Delete(tmp)
+
+    # Let the caller know so the outputs aren't logged as done
+    if error != None:
+        raise error
+
+
 ####################################################################################################
 # Function to take an image, apply a stretch to it to convert it to 8 bit, add a color ramp, and names
-def rescale(array, in_min, in_max, out_min=0, out_max=254):
-    return ((array.clip(in_min, in_max) - in_min) * (out_max - out_min)) / (in_max - in_min)
+rescale = rbl.rescale
 
 
 format_dict = {".tif": "GTiff", ".img": "HFA", ".jpg": "JPEG", ".gif": "GIF", ".grid": "AAIGrid", ".hdr": "envi", "": "envi", ".ntf": "NITF", ".vrt": "VRT"}
 ####################################################################################################
 # Options found at: https://gdal.org/python/osgeo.gdal-module.html#TranslateOptions
-cogArgs = {"format": "COG", "creationOptions": ["COMPRESS=DEFLATE"]}
+cogArgs = {"format": "COG", "creationOptions": get_cog_options("raw")}
 
 
 def translate(input, output, kwargs={"rgbExpand": "rgb", "widthPct": 6.25, "heightPct": 6.25}):
@@ -104,82 +561,237 @@ def translate(input, output, kwargs={"rgbExpand": "rgb", "widthPct": 6.25, "heig
     ds = None  # close and save ds
 
 
+####################################################################################################
+# Function to make a quick look (e.g. .jpg) of an image at pct percent of its size
+# The smallest overview that is at least the size of the quick look is read directly
+# rather than resampling from the full resolution data
+# Falls back to translate if the image has no overview that is at least that size
+# Nothing is made if the image can't be opened (e.g. its 8 bit write failed), as with translate
+def translate_preview(input, output, pct=6.25, kwargs={"rgbExpand": "rgb"}):
+    rast = gdal.Open(input)
+    if rast == None:
+        print("Could not open {}. Skipping its preview".format(input))
+        return
+    b = rast.GetRasterBand(1)
+    width = int(round(rast.RasterXSize * pct / 100.0))
+    height = int(round(rast.RasterYSize * pct / 100.0))
+
+    ov = None
+    for i in range(b.GetOverviewCount()):
+        ov_t = b.GetOverview(i)
+        if ov_t.XSize >= width and ov_t.YSize >= height and (ov == None or ov_t.XSize < ov.XSize):
+            ov = ov_t
+
+    if ov == None:
+        rast = None
+        b = None
+        translate(input, output, dict(kwargs, widthPct=pct, heightPct=pct))
+        return
+
+    # Copy the overview into memory along with the georeferencing, no data, and colors of the full image
+    geotransform = list(rast.GetGeoTransform())
+    geotransform[1] = geotransform[1] * rast.RasterXSize / ov.XSize
+    geotransform[5] = geotransform[5] * rast.RasterYSize / ov.YSize
+
+    ds = gdal.GetDriverByName("MEM").Create("", ov.XSize, ov.YSize, 1, b.DataType)
+    ds.SetProjection(rast.GetProjection())
+    ds.SetGeoTransform(geotransform)
+
+    ds_b = ds.GetRasterBand(1)
+    ds_b.WriteArray(ov.ReadAsArray())
+    if b.GetNoDataValue() != None:
+        ds_b.SetNoDataValue(b.GetNoDataValue())
+    if b.GetRasterColorTable() != None:
+        ds_b.SetRasterColorTable(b.GetRasterColorTable())
+    rast = None
+    b = None
+    ov = None
+    ds_b = None
+
+    kwargs = dict(kwargs, width=width, height=height)
+    if "format" not in kwargs.keys():
+        kwargs["format"] = format_dict[os.path.splitext(output)[1]]
+
+    print("Running gdal_translate from overview:", output)
+    out = gdal.Translate(output, ds, **kwargs)
+    out = None
+    ds = None
+
+
+####################################################################################################
+# Generator of (xoff, yoff, xsize, ysize) windows following the native block size of a band
+# Striped rasters (block is a single row or a few rows) are grouped into windows of at least min_block_pixels
+def iter_blocks(band, min_block_pixels=512 * 512):
+    width = band.XSize
+    height = band.YSize
+    block_x, block_y = band.GetBlockSize()
+
+    if block_x >= width and block_x * block_y < min_block_pixels:
+        block_y = max(block_y, int(min_block_pixels / width) + 1)
+
+    for yoff in range(0, height, block_y):
+        ysize = min(block_y, height - yoff)
+        for xoff in range(0, width, block_x):
+            xsize = min(block_x, width - xoff)
+            yield xoff, yoff, xsize, ysize
+
+
+####################################################################################################
+# Function to set the no data, stats, color table, and names of an 8 bit stretched band
+def set_8bit_band_info(b, palette, stretch, out_min=0, out_max=254, out_no_data=255):
+    b.SetNoDataValue(out_no_data)
+    b.SetStatistics(out_min, out_max, 125, 20)
+
+    ct = get_poly_gradient_ct(palette, out_min, out_max)
+    names = list(get_stretch_names(stretch, out_min, out_max))
+    b.SetRasterColorTable(ct)
+    b.SetRasterCategoryNames(names)
+
+
 ####################################################################################################
 # Function to take raw image and rescale it to 8 bit, set no data, update stats, and set a colormap and names
 # This method ensures output is a valid COGtif
+# If streaming is True, the image is processed one native block at a time and written to a tiled scratch tif
+# so peak memory depends on the block size rather than the size of the image
 # Cog methods adapted from: https://geoexamples.com/other/2019/02/08/cog-tutorial.html/
-def stretch_to_8bit(in_image, in_no_data, scale_factor, stretch, palette, out_min=0, out_max=254, out_no_data=255):
+def stretch_to_8bit(in_image, in_no_data, scale_factor, stretch, palette, out_min=0, out_max=254, out_no_data=255, streaming=True):
     # Set up a unique output name
-    out_image = os.path.splitext(in_image)[0] + "_{}_8bit.tif".format(stretch)
+    out_image = get_8bit_name(in_image, stretch)
 
     if not os.path.exists(out_image):
         print("Compressing {} to 8 bit".format(in_image))
 
-        # Read in raster as array
-        rast = gdal.Open(in_image)
-        width = rast.RasterXSize
-        height = rast.RasterYSize
+        if streaming:
+            stretch_to_8bit_streaming(in_image, out_image, in_no_data, scale_factor, stretch, palette, out_min, out_max, out_no_data)
+        else:
+            stretch_to_8bit_in_memory(in_image, out_image, in_no_data, scale_factor, stretch, palette, out_min, out_max, out_no_data)
 
-        band1 = rast.GetRasterBand(1)
-        band1_pixels = band1.ReadAsArray().astype("float32")
+        out_jpg = os.path.splitext(out_image)[0] + ".jpg"
+        translate_preview(out_image, out_jpg)
 
-        band1 = None
 
-        # Apply stretch
-        out = rescale(band1_pixels / scale_factor, -stretch, stretch, out_min, out_max)
+####################################################################################################
+# Get the name of the 8 bit version of an image
+def get_8bit_name(in_image, stretch):
+    return os.path.splitext(in_image)[0] + "_{}_8bit.tif".format(stretch)
+
 
-        # Burn in mask values
-        out[band1_pixels == in_no_data] = out_no_data
+####################################################################################################
+# Original 8 bit stretch that reads the entire image into memory
+def stretch_to_8bit_in_memory(in_image, out_image, in_no_data, scale_factor, stretch, palette, out_min=0, out_max=254, out_no_data=255):
+    # Read in raster as array
+    rast = gdal.Open(in_image)
+    width = rast.RasterXSize
+    height = rast.RasterYSize
 
-        # Write out output as a cogTif
-        try:
-            driver = gdal.GetDriverByName("MEM")
-            ds = driver.Create("", width, height, 1, gdal.GDT_Byte)
-            ds.SetProjection(rast.GetProjection())
-            ds.SetGeoTransform(rast.GetGeoTransform())
+    band1 = rast.GetRasterBand(1)
+    band1_pixels = band1.ReadAsArray().astype("float32")
 
-            b = ds.GetRasterBand(1)
-            b.WriteArray(out)
-            b.SetNoDataValue(out_no_data)
-            # if update_stats:
-            # 	Min,Max,Mean,Std = b.ComputeStatistics(0)
-            # 	if stat_stretch_type == 'stdDev':
-            # 		Min = Mean - (stretch_n_stdDev*Std)
-            # 		Max = Mean + (stretch_n_stdDev*Std)
-            b.SetStatistics(out_min, out_max, 125, 20)
+    band1 = None
 
-            ct = get_poly_gradient_ct(palette, out_min, out_max)
-            names = ["{:.4f}".format(((i / (out_max - out_min)) * (stretch + stretch)) - stretch) for i in range(out_min, out_max + 1)]
-            names.append("No Data")
-            b.SetRasterColorTable(ct)
-            b.SetRasterCategoryNames(names)
+    # Apply stretch
+    out = rescale(band1_pixels / scale_factor, -stretch, stretch, out_min, out_max)
 
-            ds.BuildOverviews("NEAREST", [2, 4, 8, 16, 32, 64])
+    # Burn in mask values
+    out[band1_pixels == in_no_data] = out_no_data
 
-            driver = gdal.GetDriverByName("GTiff")
-            ds2 = driver.CreateCopy(out_image, ds, options=["COPY_SRC_OVERVIEWS=YES", "TILED=YES", "COMPRESS=DEFLATE"])
+    # Write out output as a cogTif
+    try:
+        driver = gdal.GetDriverByName("MEM")
+        ds = driver.Create("", width, height, 1, gdal.GDT_Byte)
+        ds.SetProjection(rast.GetProjection())
+        ds.SetGeoTransform(rast.GetGeoTransform())
 
-        except Exception as e:
-            print(e)
+        b = ds.GetRasterBand(1)
+        b.WriteArray(out)
+        set_8bit_band_info(b, palette, stretch, out_min, out_max, out_no_data)
 
-        rast = None
-        band1_pixels = None
-        out = None
-        ds = None
-        ds2 = None
-        b = None
+        ds.BuildOverviews("NEAREST", [2, 4, 8, 16, 32, 64])
 
-        # #Update no data and stats
-        # set_no_data(out_image, out_no_data,update_stats = True, stat_stretch_type = 'asdf')
-        # #Update color table and names of 8 bit image
-        # ct = get_poly_gradient_ct(palette, out_min,out_max)
-        # names = ["{:.4f}".format(((i/(out_max-out_min))*(stretch+stretch))-stretch) for i in range(out_min,out_max+1)]
-        # names.append('No Data')
-        # # print(stretch,names)
-        # update_color_table_or_names(out_image,color_table = ct,names = names)
+        driver = gdal.GetDriverByName("GTiff")
+        ds2 = driver.CreateCopy(out_image, ds, options=["COPY_SRC_OVERVIEWS=YES"] + get_gtiff_options("byte"))
 
-        out_jpg = os.path.splitext(out_image)[0] + ".jpg"
-        translate(out_image, out_jpg)
+    except Exception as e:
+        print(e)
+
+    rast = None
+    band1_pixels = None
+    out = None
+    ds = None
+    ds2 = None
+    b = None
+
+
+####################################################################################################
+# Block streamed 8 bit stretch
+# Each native block of the input is stretched and written straight into a tiled scratch tif
+# Overviews are then built on disk and copied into the final COGtif layout
+# If use_lut is True and the input is int16, each block is stretched with a single lookup table gather (see get_stretch_lut)
+def stretch_to_8bit_streaming(in_image, out_image, in_no_data, scale_factor, stretch, palette, out_min=0, out_max=254, out_no_data=255, use_lut=True):
+    tmp_image = os.path.splitext(out_image)[0] + "_tmp.tif"
+    driver = gdal.GetDriverByName("GTiff")
+
+    rast = gdal.Open(in_image)
+    band1 = rast.GetRasterBand(1)
+
+    lut = None
+    if use_lut and band1.DataType == gdal.GDT_Int16:
+        lut = get_stretch_lut(in_no_data, scale_factor, stretch, out_min, out_max, out_no_data)
+    try:
+        ds = driver.Create(tmp_image, rast.RasterXSize, rast.RasterYSize, 1, gdal.GDT_Byte, options=["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512", "BIGTIFF=IF_SAFER"])
+        ds.SetProjection(rast.GetProjection())
+        ds.SetGeoTransform(rast.GetGeoTransform())
+
+        b = ds.GetRasterBand(1)
+        set_8bit_band_info(b, palette, stretch, out_min, out_max, out_no_data)
+
+        # Apply stretch and burn in mask values one block at a time
+        for xoff, yoff, xsize, ysize in iter_blocks(band1):
+            if lut is not None:
+                out = lut[band1.ReadAsArray(xoff, yoff, xsize, ysize).view("uint16")]
+            else:
+                out = rbl.stretch_block(band1.ReadAsArray(xoff, yoff, xsize, ysize), in_no_data, scale_factor, stretch, out_min, out_max, out_no_data)
+            b.WriteArray(out, xoff, yoff)
+
+        ds.BuildOverviews("NEAREST", [2, 4, 8, 16, 32, 64])
+
+        ds2 = driver.CreateCopy(out_image, ds, options=["COPY_SRC_OVERVIEWS=YES"] + get_gtiff_options("byte"))
+
+    except Exception as e:
+        print(e)
+
+    rast = None
+    band1 = None
+    block = None
+    out = None
+    ds = None
+    ds2 = None
+    b = None
+
+    # Remove the scratch tif (and any sidecar files)
+    if os.path.exists(tmp_image):
+        driver.Delete(tmp_image)
+
+
+####################################################################################################
+# Lookup table to stretch int16 values to 8 bit
+# The table has an entry for all 65,536 int16 values (including no data) and is indexed by their uint16 view
+# so a block is stretched with a single gather: lut[block.view("uint16")]
+# Entries are the float32 stretch of each value (see raster_block_lib.get_stretch_table) converted to 8 bit by GDAL
+# so output is byte identical to writing the float stretch
+@functools.lru_cache(maxsize=32)
+def get_stretch_lut(in_no_data, scale_factor, stretch, out_min=0, out_max=254, out_no_data=255):
+    out = rbl.get_stretch_table(in_no_data, scale_factor, stretch, out_min, out_max, out_no_data)
+
+    ds = gdal.GetDriverByName("MEM").Create("", 65536, 1, 1, gdal.GDT_Byte)
+    b = ds.GetRasterBand(1)
+    b.WriteArray(out.reshape(1, -1))
+    lut = b.ReadAsArray()[0]
+    b = None
+    ds = None
+
+    lut.flags.writeable = False
+    return lut
 
 
 ####################################################################################################
@@ -212,22 +824,114 @@ def calc_persistence(inputs, output_name, scale_factor, thresh, in_no_data=-3276
     count[msk] = out_no_data
 
     # Write out output as a COGtif
+    write_persistence_cog(count, output_name, rast.GetProjection(), rast.GetGeoTransform(), out_no_data)
+
+    rast = None
+    count = None
+    stack = None
+
+    out_jpg = os.path.splitext(output_name)[0] + ".jpg"
+    translate_preview(output_name, out_jpg)
+
+
+####################################################################################################
+# Compute persistence across a season of periods with a sliding window
+# Inputs must be sorted by period. output_names[i] is the output for the window inputs[i:i + n_periods]
+# Any output name set to None is not written (e.g. it already exists)
+# Each input is read exactly once (and only if a window being written needs it)
+# and added to a rolling window (see raster_block_lib.iter_persistence_windows)
+def calc_persistence_rolling(inputs, output_names, scale_factor, thresh, n_periods=3, in_no_data=-32768, out_no_data=255):
+    georef = {}
+
+    def read_masks(i):
+        change, no_data, georef["projection"], georef["geotransform"] = read_persistence_masks(inputs[i], scale_factor, thresh, in_no_data)
+        return change, no_data
+
+    for w, count in rbl.iter_persistence_windows(read_masks, output_names, n_periods, out_no_data):
+        print("Computing persistence:", output_names[w])
+        write_persistence_cog(count, output_names[w], georef["projection"], georef["geotransform"], out_no_data)
+
+        out_jpg = os.path.splitext(output_names[w])[0] + ".jpg"
+        translate_preview(output_names[w], out_jpg)
+        count = None
+
+
+####################################################################################################
+# Get the name of the persistence masks saved during fused post processing
+# Masks are a compressed uint8 tif with the change (below threshold) mask in bit 0 and the no data mask in bit 1
+# Their names are kept with the other product names (see LAMDA_products.get_persistence_mask_name)
+persistence_mask_folder = lp.persistence_mask_folder
+get_persistence_mask_name = lp.get_persistence_mask_name
+list_persistence_masks = lp.list_persistence_masks
+
+
+# Create an empty persistence mask tif (tiled and compressed with the byte output profile)
+def create_persistence_mask_tif(mask_name, width, height, projection, geotransform):
+    if not os.path.exists(os.path.dirname(mask_name)):
+        os.makedirs(os.path.dirname(mask_name), exist_ok=True)
+    ds = gdal.GetDriverByName("GTiff").Create(mask_name, width, height, 1, gdal.GDT_Byte, options=get_gtiff_options("byte"))
+    ds.SetProjection(projection)
+    ds.SetGeoTransform(geotransform)
+    return ds
+
+
+# Check whether saved persistence masks exist and are newer than the image
+def has_persistence_masks(in_image, scale_factor, thresh):
+    mask_name = get_persistence_mask_name(in_image, scale_factor, thresh)
+    return os.path.exists(mask_name) and os.path.getmtime(mask_name) >= os.path.getmtime(in_image)
+
+
+# Read the change (below threshold) and no data masks of a single period one block at a time
+# Masks saved during fused post processing are used instead of reading the image if they are newer than it
+def read_persistence_masks(in_image, scale_factor, thresh, in_no_data=-32768):
+    mask_name = get_persistence_mask_name(in_image, scale_factor, thresh)
+    if has_persistence_masks(in_image, scale_factor, thresh):
+        print("Reading in saved masks:", mask_name)
+        rast = gdal.Open(mask_name)
+        band1 = rast.GetRasterBand(1)
+        change = numpy.zeros((rast.RasterYSize, rast.RasterXSize), dtype="uint8")
+        no_data = numpy.zeros((rast.RasterYSize, rast.RasterXSize), dtype="uint8")
+        for xoff, yoff, xsize, ysize in iter_blocks(band1):
+            block_change, block_no_data = rbl.unpack_persistence_masks(band1.ReadAsArray(xoff, yoff, xsize, ysize))
+            change[yoff : yoff + ysize, xoff : xoff + xsize] = block_change
+            no_data[yoff : yoff + ysize, xoff : xoff + xsize] = block_no_data
+        projection = rast.GetProjection()
+        geotransform = rast.GetGeoTransform()
+        rast = None
+        band1 = None
+        return change, no_data, projection, geotransform
+
+    print("Reading in:", in_image)
+    rast = gdal.Open(in_image)
+    band1 = rast.GetRasterBand(1)
+
+    change = numpy.zeros((rast.RasterYSize, rast.RasterXSize), dtype="uint8")
+    no_data = numpy.zeros((rast.RasterYSize, rast.RasterXSize), dtype="uint8")
+    for xoff, yoff, xsize, ysize in iter_blocks(band1):
+        block_change, block_no_data = rbl.get_change_masks(band1.ReadAsArray(xoff, yoff, xsize, ysize), scale_factor, thresh, in_no_data)
+        change[yoff : yoff + ysize, xoff : xoff + xsize] = block_change
+        no_data[yoff : yoff + ysize, xoff : xoff + xsize] = block_no_data
+
+    projection = rast.GetProjection()
+    geotransform = rast.GetGeoTransform()
+    rast = None
+    band1 = None
+    return change, no_data, projection, geotransform
+
+
+####################################################################################################
+# Write out a persistence count array as a COGtif with detection colors and names
+def write_persistence_cog(count, output_name, projection, geotransform, out_no_data=255):
     try:
 
         driver = gdal.GetDriverByName("MEM")
         ds = driver.Create("", count.shape[1], count.shape[0], 1, gdal.GDT_Byte)
-        ds.SetProjection(rast.GetProjection())
-        ds.SetGeoTransform(rast.GetGeoTransform())
+        ds.SetProjection(projection)
+        ds.SetGeoTransform(geotransform)
 
         b = ds.GetRasterBand(1)
         b.WriteArray(count)
         b.SetNoDataValue(out_no_data)
-        # if update_stats:
-        # 	Min,Max,Mean,Std = b.ComputeStatistics(0)
-        # 	if stat_stretch_type == 'stdDev':
-        # 		Min = Mean - (stretch_n_stdDev*Std)
-        # 		Max = Mean + (stretch_n_stdDev*Std)
-        # b.SetStatistics(out_min,out_max,125,20)
 
         # Update colors and names
         ct = gdal.ColorTable()
@@ -244,35 +948,15 @@ def calc_persistence(inputs, output_name, scale_factor, thresh, in_no_data=-3276
         ds.BuildOverviews("NEAREST", [2, 4, 8, 16, 32, 64])
 
         driver = gdal.GetDriverByName("GTiff")
-        ds2 = driver.CreateCopy(output_name, ds, options=["COPY_SRC_OVERVIEWS=YES", "TILED=YES", "COMPRESS=DEFLATE"])
+        ds2 = driver.CreateCopy(output_name, ds, options=["COPY_SRC_OVERVIEWS=YES"] + get_gtiff_options("byte"))
 
     except Exception as e:
         print(e)
 
-    rast = None
-    count = None
-    out = None
     ds = None
     ds2 = None
     b = None
 
-    # #Update no data and stats
-    # set_no_data(output_name, out_no_data,update_stats = True, stat_stretch_type = 'asdf')
-
-    # #Update colors and names
-    # ct = gdal.ColorTable()
-
-    # ct.SetColorEntry(0,(225,225,225))#hex_to_rgb('#888888'))
-    # ct.SetColorEntry(1,(255,170,0))#hex_to_rgb('#888800'))
-    # ct.SetColorEntry(2,(225,0,0))#hex_to_rgb('#880000'))
-    # ct.SetColorEntry(3,(225,0,197))#hex_to_rgb('#880088'))
-
-    # names = ['{} Detection(s)'.format(i) for i in range(0,4)]
-    # update_color_table_or_names(output_name,color_table = ct,names = names)
-
-    out_jpg = os.path.splitext(output_name)[0] + ".jpg"
-    translate(output_name, out_jpg)
-
 
 ##############################################################
 def color_dict_maker(gradient):
@@ -288,67 +972,68 @@ def linear_gradient(start_hex, finish_hex="#FFFFFF", n=10):
     two hex colors. start_hex and finish_hex
     should be the full six-digit color string,
     inlcuding the number sign ("#FFFFFF")"""
+    return color_dict_maker(linear_gradient_array(start_hex, finish_hex, n).tolist())
+
+
+def linear_gradient_array(start_hex, finish_hex="#FFFFFF", n=10):
+    """returns an (n, 3) integer array of RGB colors
+    evenly spaced between two hex colors"""
     # Starting and ending colors in RGB form
-    s = hex_to_rgb(start_hex)
-    f = hex_to_rgb(finish_hex)
-    # Initilize a list of the output colors with the starting color
-    RGB_list = [s]
-    # Calcuate a color at each evenly spaced value of t from 1 to n
-    for t in range(1, n):
-        # Interpolate RGB vector for color at the current value of t
-        curr_vector = [int(s[j] + (float(t) / (n - 1)) * (f[j] - s[j])) for j in range(3)]
-        # Add it to our list of output colors
-        RGB_list.append(curr_vector)
+    s = numpy.array(hex_to_rgb(start_hex))
+    f = numpy.array(hex_to_rgb(finish_hex))
+    if n < 2:
+        return s.reshape(1, 3)
 
-    # print(RGB_list)
-    return color_dict_maker(RGB_list)
+    # Interpolate RGB vector for color at each evenly spaced value of t from 0 to n-1
+    # (truncated to integers the same way as int())
+    t = numpy.arange(n) / (n - 1)
+    return (s + t[:, None] * (f - s)).astype("int64")
 
 
 def polylinear_gradient(colors, n):
     """returns a list of colors forming linear gradients between
     all sequential pairs of colors. "n" specifies the total
     number of desired output colors"""
+    # returns dictionary defined by color_dict()
+    return color_dict_maker(polylinear_gradient_array(colors, n).tolist())
+
+
+def polylinear_gradient_array(colors, n):
+    """returns an (n, 3) integer array of RGB colors forming
+    linear gradients between all sequential pairs of colors"""
     # The number of colors per individual linear gradient
     n_out = int(float(n) / (len(colors) - 1)) + 1
-    # print(('n',n))
-    # print(('n_out',n_out))
+
     # If we don't have an even number of color values, we will remove equally spaced values at the end.
     apply_offset = False
     if n % n_out != 0:
         apply_offset = True
         n_out = n_out + 1
-        # print(('new n_out',n_out))
-
-    # returns dictionary defined by color_dict()
-    gradient_dict = linear_gradient(colors[0], colors[1], n_out)
 
-    if len(colors) > 1:
-        for col in range(1, len(colors) - 1):
-            next = linear_gradient(colors[col], colors[col + 1], n_out)
-            for k in ("hex", "r", "g", "b"):
-                # Exclude first point to avoid duplicates
-                gradient_dict[k] += next[k][1:]
+    # Exclude first point of each following gradient to avoid duplicates
+    gradient = [linear_gradient_array(colors[0], colors[1], n_out)]
+    for col in range(1, len(colors) - 1):
+        gradient.append(linear_gradient_array(colors[col], colors[col + 1], n_out)[1:])
+    gradient = numpy.concatenate(gradient)
 
     # Remove equally spaced values here.
     if apply_offset:
-        # indList = list(range(len(gradient_dict['hex'])))
-        offset = len(gradient_dict["hex"]) - n
-        sliceval = []
-        # print(('len(gradient_dict)',len(gradient_dict['hex'])))
-        # print(('offset',offset))
+        offset = len(gradient) - n
+        sliceval = [int(len(gradient) * i / float(offset + 2)) for i in range(1, offset + 1)]
+        gradient = numpy.delete(gradient, sliceval, axis=0)
+    return gradient
 
-        for i in range(1, offset + 1):
-            sliceval.append(int(len(gradient_dict["hex"]) * i / float(offset + 2)))
-        # print(('sliceval',sliceval))
-        for k in ("hex", "r", "g", "b"):
-            gradient_dict[k] = [i for j, i in enumerate(gradient_dict[k]) if j not in sliceval]
-        # print(('new len dict', len(gradient_dict['hex'])))
-    return gradient_dict
+
+# Colors of a polylinear gradient color table
+# Every product of a given type uses the same palette, so these are cached
+@functools.lru_cache(maxsize=64)
+def get_poly_gradient_colors(palette, min, max):
+    ramp = polylinear_gradient_array(list(palette), max - min + 1)
+    return tuple((int(r), int(g), int(b), 255) for r, g, b in ramp)
 
 
 def get_poly_gradient_ct(palette, min, max):
-    ramp = polylinear_gradient(palette, max - min + 1)
-    paletteT = list(zip(ramp["r"], ramp["g"], ramp["b"], [255] * len(ramp["b"])))
+    paletteT = get_poly_gradient_colors(tuple(palette), min, max)
     ct = gdal.ColorTable()
 
     for i, p in enumerate(range(min, max + 1)):
@@ -356,6 +1041,14 @@ def get_poly_gradient_ct(palette, min, max):
     return ct
 
 
+# Category names of each value of an 8 bit stretch (cached)
+@functools.lru_cache(maxsize=64)
+def get_stretch_names(stretch, out_min=0, out_max=254):
+    names = ["{:.4f}".format(((i / (out_max - out_min)) * (stretch + stretch)) - stretch) for i in range(out_min, out_max + 1)]
+    names.append("No Data")
+    return tuple(names)
+
+
 ##############################################################
 # color functions adapted from bsou.io/posts/color-gradients-with-python
 def hex_to_rgb(value):
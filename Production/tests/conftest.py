@@ -0,0 +1,40 @@
+# Shared setup for the LAMDA unit tests
+# The LAMDA modules are scripts in the Production folder (not an installed package), so it's put on the path
+# Modules that need ee aren't tested here and tests that need GDAL are skipped where it isn't installed
+# Helpers used by more than one test module are here (imported with from conftest import ...)
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import LAMDA_state_store as sl
+
+
+# Write a small file (making its folder if needed) and return its path
+def write(path, content=b"x"):
+    path = str(path)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as o:
+        o.write(content)
+    return path
+
+
+def read(path):
+    with open(path, "rb") as o:
+        return o.read()
+
+
+# Local output folder of a run
+@pytest.fixture
+def local_dir(tmp_path):
+    return str(tmp_path / "local")
+
+
+# State store of the local output folder
+@pytest.fixture
+def conn(local_dir):
+    conn = sl.open_state_store(local_dir)
+    yield conn
+    conn.close()
@@ -0,0 +1,104 @@
+# Tests of baseline_climatology_lib against local_stats_lib.mean_std on the same observations
+import numpy
+import pytest
+
+import baseline_climatology_lib as bc
+import local_stats_lib as ls
+
+first_julian, last_julian, bin_days = 145, 224, 8
+height, width, n_bands = 6, 5, 2
+
+
+@pytest.fixture
+def observations():
+    rng = numpy.random.default_rng(3)
+    years, julians = numpy.meshgrid(numpy.arange(2020, 2023), numpy.arange(145, 225, 4), indexing="ij")
+    years, julians = years.ravel(), julians.ravel()
+    stack = rng.normal(0.5, 0.1, (len(years), n_bands, height, width)).astype("float32")
+    stack[rng.random(stack.shape) < 0.2] = numpy.nan
+    return stack, years, julians
+
+
+# Make the climatology of each year in two chunks of rows
+def make_climatologies(folder, stack, years, julians):
+    names = []
+    for year in sorted(set(years)):
+        name = bc.get_climatology_name(folder, "CONUS", "NBR-NDVI", year)
+        info = bc.create_climatology(name, width, height, n_bands, first_julian, last_julian, bin_days)
+        cube = bc.open_climatology(name, "r+")
+        for b in range(info["n_bins"]):
+            start, end = bc.get_bin_range(info, b)
+            keep = (years == year) & (julians >= start) & (julians <= end)
+            bc.write_bin_chunk(cube, b, 0, 0, stack[keep][..., :4, :])
+            bc.write_bin_chunk(cube, b, 0, 4, stack[keep][..., 4:, :])
+            info = bc.set_bin_sources(name, info, b, ["obs_{}_{}".format(year, jd) for jd in julians[keep]])
+        cube.flush()
+        cube = None
+        names.append(name)
+    return names
+
+
+def test_bin_grid(tmp_path):
+    info = bc.create_climatology(str(tmp_path / "c.npy"), width, height, n_bands, first_julian, last_julian, bin_days)
+    assert info["n_bins"] == 10
+    assert bc.open_climatology(str(tmp_path / "c.npy")).shape == (3, 10, n_bands, height, width)
+    assert bc.get_bin_range(info, 0) == (145, 152)
+    assert bc.get_bin_range(info, 9) == (217, 224)
+    assert bc.get_window_bins(info, 145, 160) == [0, 1]
+    assert bc.get_window_bins(info, 153, 224) == list(range(1, 10))
+    # Windows off the grid, outside the bins, or backwards
+    assert bc.get_window_bins(info, 146, 160) == None
+    assert bc.get_window_bins(info, 145, 161) == None
+    assert bc.get_window_bins(info, 137, 152) == None
+    assert bc.get_window_bins(info, 217, 232) == None
+    assert bc.get_window_bins(info, 161, 152) == None
+
+
+def test_window_through_end_of_year(tmp_path):
+    info = bc.create_climatology(str(tmp_path / "c.npy"), width, height, n_bands, 353, 366, 8)
+    assert info["n_bins"] == 2
+    assert bc.get_window_bins(info, 353, 368) == [0, 1]
+    assert bc.get_window_bins(info, 361, 376) == [1]
+
+
+def test_has_bin(tmp_path):
+    name = str(tmp_path / "c.npy")
+    info = bc.create_climatology(name, width, height, n_bands, first_julian, last_julian, bin_days)
+    assert not bc.has_bin(info, 0)
+    bc.set_bin_sources(name, info, 0, ("a", "b"))
+    info = bc.read_climatology_info(name)
+    assert bc.has_bin(info, 0) and bc.has_bin(info, 0, ["a", "b"])
+    assert not bc.has_bin(info, 0, ["a"])
+
+
+@pytest.mark.parametrize("startJulian, endJulian", [(145, 160), (153, 184), (145, 224)])
+@pytest.mark.parametrize("ddof", [0, 1])
+def test_baseline_stats_match_mean_std(tmp_path, observations, startJulian, endJulian, ddof):
+    stack, years, julians = observations
+    names = make_climatologies(str(tmp_path), stack, years, julians)
+    keep = (julians >= startJulian) & (julians <= endJulian)
+    mean, std, count = ls.mean_std(stack[keep], ddof)
+
+    out_mean, out_std, out_count = bc.get_baseline_stats(names, startJulian, endJulian, 0, 0, width, height, ddof)
+    numpy.testing.assert_array_equal(out_count, count)
+    numpy.testing.assert_allclose(out_mean, mean, rtol=1e-5)
+    numpy.testing.assert_allclose(out_std, std, rtol=1e-3, atol=1e-5)
+
+    # A chunk of the grid
+    out_mean, out_std, out_count = bc.get_baseline_stats(names, startJulian, endJulian, 1, 2, 3, 3, ddof)
+    numpy.testing.assert_allclose(out_mean, mean[:, 2:5, 1:4], rtol=1e-5)
+    numpy.testing.assert_array_equal(out_count, count[:, 2:5, 1:4])
+
+
+def test_baseline_stats_errors(tmp_path, observations):
+    stack, years, julians = observations
+    names = make_climatologies(str(tmp_path), stack, years, julians)
+    with pytest.raises(ValueError):
+        bc.get_baseline_stats(names, 146, 160, 0, 0, width, height)
+    with pytest.raises(ValueError):
+        bc.get_baseline_stats(names, 145, 160, 3, 0, width, height)
+
+    name = bc.get_climatology_name(str(tmp_path), "CONUS", "NBR-NDVI", 2019)
+    bc.create_climatology(name, width, height, n_bands, first_julian, last_julian, bin_days)
+    with pytest.raises(ValueError):
+        bc.get_baseline_stats(names + [name], 145, 160, 0, 0, width, height)
@@ -0,0 +1,136 @@
+# Tests of detection_history_lib against direct computations on the period masks
+import os
+
+import numpy
+import pytest
+
+import detection_history_lib as dh
+
+height, width = 7, 5
+first_julian, frequency = 9, 16
+
+
+@pytest.fixture
+def periods():
+    # Change and no data masks of 70 periods so the history spans two words
+    rng = numpy.random.default_rng(0)
+    change = rng.random((70, height, width)) < 0.3
+    no_data = rng.random((70, height, width)) < 0.1
+    return change.astype("uint8"), no_data.astype("uint8")
+
+
+def make_history(tmp_path, change, no_data, block_rows=3):
+    history_name = dh.get_history_name(str(tmp_path), "CONUS", "Z", "NBR", 2024)
+    dh.create_history(history_name, width, height, first_julian, frequency, 1000, -3)
+    for p in range(change.shape[0]):
+        dh.add_period(history_name, first_julian + p * frequency, change[p], no_data[p], source_id="v{}".format(p), block_rows=block_rows)
+    return history_name
+
+
+def test_history_name(tmp_path):
+    assert dh.get_history_name("out", "CONUS", "Z", "NBR", 2024) == os.path.join("out", "CONUS_LAMDA_Z_NBR_2024_history.npy")
+    assert dh.get_history_name("out", "CONUS", "Z", "NBR", 2024, "-0000000000-0000065536").endswith("_2024-0000000000-0000065536_history.npy")
+
+
+def test_popcount():
+    words = numpy.array([0, 1, 0xFF, 2**63, 2**64 - 1], dtype="uint64")
+    assert dh.popcount(words).tolist() == [0, 1, 8, 1, 64]
+
+
+def test_iter_row_blocks():
+    assert list(dh.iter_row_blocks(7, 3)) == [(0, 3), (3, 6), (6, 7)]
+    assert list(dh.iter_row_blocks(0, 3)) == []
+
+
+def test_period_bits(tmp_path):
+    info = dh.create_history(str(tmp_path / "h.npy"), width, height, first_julian, frequency, 1000, -3)
+    assert dh.get_period_bit(info, 9) == 0
+    assert dh.get_period_bit(info, 41) == 2
+    assert dh.get_period_bit(info, 10) == None
+    assert dh.get_period_bit(info, 1) == None
+    assert dh.get_bit_julian(info, 2) == 41
+
+
+def test_add_period_grows_and_records(tmp_path, periods):
+    change, no_data = periods
+    history_name = make_history(tmp_path, change, no_data)
+    info = dh.read_history_info(history_name)
+    assert info["n_words"] == 2
+    assert dh.open_history(history_name).shape == (2, 2, height, width)
+    assert dh.has_period(info, first_julian + 69 * frequency, "v69")
+    assert not dh.has_period(info, first_julian + 69 * frequency, "v0")
+    assert not dh.has_period(info, first_julian + 70 * frequency)
+
+    with pytest.raises(ValueError):
+        dh.add_period(history_name, first_julian + 1, change[0], no_data[0])
+
+
+@pytest.mark.parametrize("n_periods, end_period", [(3, 2), (3, 40), (3, 64), (5, 69), (70, 69)])
+def test_persistence(tmp_path, periods, n_periods, end_period):
+    change, no_data = periods
+    history_name = make_history(tmp_path, change, no_data)
+    window = slice(end_period - n_periods + 1, end_period + 1)
+    expected = ((change[window] != 0) & (no_data[window] == 0)).sum(0).astype("uint8")
+    expected[no_data[window].any(0)] = 255
+    for block_rows in [2, 256]:
+        out = dh.get_persistence(history_name, first_julian + end_period * frequency, n_periods, block_rows=block_rows)
+        assert out.dtype == numpy.uint8
+        numpy.testing.assert_array_equal(out, expected)
+
+
+def test_persistence_outside_history(tmp_path, periods):
+    change, no_data = periods
+    history_name = make_history(tmp_path, change[:3], no_data[:3])
+    with pytest.raises(ValueError):
+        dh.get_persistence(history_name, first_julian + frequency, 3)
+    with pytest.raises(ValueError):
+        dh.get_persistence(history_name, first_julian + 2 * frequency + 1, 3)
+    with pytest.raises(ValueError):
+        dh.get_persistence(history_name, first_julian + 64 * frequency, 3)
+
+
+def test_periods_not_added_have_no_data(tmp_path, periods):
+    change, no_data = periods
+    history_name = dh.get_history_name(str(tmp_path), "CONUS", "Z", "NBR", 2024)
+    dh.create_history(history_name, width, height, first_julian, frequency, 1000, -3)
+    dh.add_period(history_name, first_julian, change[0], numpy.zeros((height, width), dtype="uint8"))
+    dh.add_period(history_name, first_julian + 2 * frequency, change[2], numpy.zeros((height, width), dtype="uint8"))
+    assert (dh.get_persistence(history_name, first_julian + 2 * frequency, 3) == 255).all()
+
+
+def test_add_period_again_replaces_it(tmp_path, periods):
+    change, no_data = periods
+    history_name = make_history(tmp_path, change[:3], no_data[:3])
+    dh.add_period(history_name, first_julian + frequency, 1 - change[1], numpy.zeros((height, width), dtype="uint8"), source_id="new")
+    detected = (change[:3] != 0) & (no_data[:3] == 0)
+    detected[1] = change[1] == 0
+    numpy.testing.assert_array_equal(dh.get_detection_counts(history_name), detected.sum(0))
+    assert dh.has_period(dh.read_history_info(history_name), first_julian + frequency, "new")
+
+
+def test_detection_counts(tmp_path, periods):
+    change, no_data = periods
+    history_name = make_history(tmp_path, change, no_data)
+    detected = (change != 0) & (no_data == 0)
+    out = dh.get_detection_counts(history_name, block_rows=2)
+    assert out.dtype == numpy.uint16
+    numpy.testing.assert_array_equal(out, detected.sum(0))
+    numpy.testing.assert_array_equal(dh.get_detection_counts(history_name, first_julian + 10 * frequency, first_julian + 66 * frequency), detected[10:67].sum(0))
+
+    with pytest.raises(ValueError):
+        dh.get_detection_counts(history_name, first_julian + 1)
+    with pytest.raises(ValueError):
+        dh.get_detection_counts(history_name, first_julian + 10 * frequency, first_julian + 5 * frequency)
+
+
+def test_first_detection(tmp_path, periods):
+    change, no_data = periods
+    # Leave some pixels with detections only in the second word and some never detected
+    change[:64, 0] = 0
+    change[:, 1, :2] = 0
+    history_name = make_history(tmp_path, change, no_data)
+    detected = (change != 0) & (no_data == 0)
+    expected = numpy.where(detected.any(0), first_julian + detected.argmax(0) * frequency, 0)
+    for block_rows in [2, 256]:
+        numpy.testing.assert_array_equal(dh.get_first_detection(history_name, block_rows=block_rows), expected)
+    assert (dh.get_first_detection(history_name, out_no_data=-1)[1, :2] == -1).all()
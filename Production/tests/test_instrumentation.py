@@ -0,0 +1,70 @@
+# Tests of LAMDA_instrumentation
+import os
+
+import pytest
+
+import LAMDA_instrumentation as li
+
+
+@pytest.fixture
+def jsonl(tmp_path):
+    path = str(tmp_path / "logs" / "spans.jsonl")
+    li.enable(path)
+    yield path
+    li.disable()
+
+
+def test_disabled_spans_do_nothing(tmp_path):
+    li.disable()
+    assert not li.is_enabled()
+    with li.span("sync") as s:
+        s.add(pixels=10)
+    assert s is li.null_span
+    assert li.read_spans() == []
+
+
+def test_span_records(jsonl):
+    assert li.is_enabled() and os.environ[li.env_var] == jsonl
+    with li.span("8-bit", product="a.tif", tile="0") as s:
+        s.add(pixels=100)
+        s.add(pixels=50, bands=1)
+    spans = li.read_spans()
+    assert len(spans) == 1
+    record = spans[0]
+    assert (record["stage"], record["product"], record["pixels"], record["tile"], record["bands"]) == ("8-bit", "a.tif", 150, "0", 1)
+    assert record["ok"] and record["error"] == None
+    assert record["seconds"] >= 0 and record["bytes_read"] >= 0 and record["bytes_written"] >= 0
+    assert li.read_spans(since=record["start"] + 1) == []
+
+
+def test_failed_span_is_recorded_and_raised(jsonl):
+    with pytest.raises(RuntimeError):
+        with li.span("upload"):
+            raise RuntimeError("no network")
+    record = li.read_spans()[0]
+    assert not record["ok"] and record["error"] == "no network"
+
+
+def test_traced(jsonl):
+    @li.traced("sync", product_arg="exportAreaName")
+    def sync(exportBucket, exportAreaName="CONUS"):
+        return exportBucket
+
+    assert sync("bucket") == "bucket"
+    assert sync("bucket", exportAreaName="AK") == "bucket"
+    assert [(r["stage"], r["product"]) for r in li.read_spans()] == [("sync", "CONUS"), ("sync", "AK")]
+
+
+def test_summarize(jsonl):
+    for i in range(3):
+        with li.span("cog-fixed") as s:
+            s.add(pixels=1000000)
+    with pytest.raises(ValueError):
+        with li.span("jpg"):
+            raise ValueError()
+    summary = li.summarize(li.read_spans())
+    assert list(summary.keys()) == ["cog-fixed", "jpg"]
+    assert (summary["cog-fixed"]["n"], summary["cog-fixed"]["mpix"], summary["cog-fixed"]["n_failed"]) == (3, 3.0, 0)
+    assert summary["cog-fixed"]["mean_seconds"] == pytest.approx(summary["cog-fixed"]["seconds"] / 3)
+    assert (summary["jpg"]["n"], summary["jpg"]["n_failed"]) == (1, 1)
+    assert li.print_summary() == summary
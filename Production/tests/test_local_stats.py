@@ -0,0 +1,399 @@
+# Tests of local_stats_lib against straightforward numpy versions of getZ and getTrend
+import warnings
+
+import numpy
+import pytest
+
+import local_stats_lib as ls
+
+
+# Stack of 2 bands over 6 years (2019-2024) with observations every 4 days from julian day 140 to 220
+# Some observations are masked, one pixel is never observed, and one has the same value every baseline year
+@pytest.fixture
+def observations():
+    rng = numpy.random.default_rng(1)
+    years, julians = numpy.meshgrid(numpy.arange(2019, 2025), numpy.arange(140, 221, 4), indexing="ij")
+    years, julians = years.ravel(), julians.ravel()
+    stack = rng.normal(0.5, 0.1, (len(years), 2, 6, 5)).astype("float32")
+    stack[rng.random(stack.shape) < 0.2] = numpy.nan
+    stack[:, :, 0, 0] = numpy.nan
+    stack[years < 2024, :, 0, 1] = 0.4
+    return stack, years, julians
+
+
+def reference_z(stack, years, julians, startJulian, endJulian, analysisYear, baselineLength=3, baselineGap=1, zPercentile=70, ddof=0):
+    in_range = (julians >= startJulian) & (julians <= endJulian)
+    baseline = in_range & (years >= analysisYear - baselineGap - baselineLength) & (years <= analysisYear - baselineGap - 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean = numpy.nanmean(stack[baseline].astype("float64"), 0)
+        std = numpy.nanstd(stack[baseline].astype("float64"), 0, ddof=ddof)
+        z = (stack[in_range & (years == analysisYear)] - mean) / numpy.where(std > 0, std, numpy.nan)
+        return numpy.nanmin(numpy.nanpercentile(z, zPercentile, 0), 0)
+
+
+def test_filter_dates():
+    years = numpy.array([2020, 2020, 2021, 2021, 2022])
+    julians = numpy.array([1, 200, 100, 365, 50])
+    assert ls.filter_dates(years, julians, 50, 200).tolist() == [False, True, True, False, True]
+    # Julian ranges wrap around the end of the year
+    assert ls.filter_dates(years, julians, 300, 60).tolist() == [True, False, False, True, True]
+    assert ls.filter_dates(years, julians, 1, 365, 2021, 2021).tolist() == [False, False, True, True, False]
+    assert ls.filter_dates(years, julians, 1, 365, startYear=2021).tolist() == [False, False, True, True, True]
+
+
+def test_baseline_years():
+    assert ls.get_baseline_years(2024) == (2020, 2022)
+    assert ls.get_baseline_years(2024, 5, 0) == (2019, 2023)
+
+
+@pytest.mark.parametrize("ddof", [0, 1])
+def test_mean_std(observations, ddof):
+    stack = observations[0]
+    mean, std, count = ls.mean_std(stack, ddof)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        numpy.testing.assert_allclose(mean, numpy.nanmean(stack.astype("float64"), 0), rtol=1e-6)
+        numpy.testing.assert_allclose(std, numpy.nanstd(stack.astype("float64"), 0, ddof=ddof), rtol=1e-5, atol=1e-7)
+    numpy.testing.assert_array_equal(count, (~numpy.isnan(stack)).sum(0))
+    assert numpy.isnan(mean[:, 0, 0]).all() and numpy.isnan(std[:, 0, 0]).all()
+
+
+def test_get_z_stack():
+    z = ls.get_z_stack(numpy.array([[1.0, 2.0, 3.0]]), numpy.array([1.0, 1.0, 1.0]), numpy.array([0.5, 0.0, numpy.nan]))
+    assert z[0, 0] == 0 and numpy.isnan(z[0, 1:]).all()
+
+
+def test_reduce_percentile_empty():
+    out = ls.reduce_percentile(numpy.empty((0, 2, 3), dtype="float32"), 70)
+    assert out.shape == (2, 3) and out.dtype == numpy.float32 and numpy.isnan(out).all()
+
+
+def test_min_across_bands():
+    values = numpy.array([[1.0, numpy.nan, numpy.nan], [2.0, -1.0, numpy.nan]])
+    out = ls.min_across_bands(values)
+    assert out[:2].tolist() == [1.0, -1.0] and numpy.isnan(out[2])
+
+
+@pytest.mark.parametrize("analysisYear, startJulian, endJulian, zPercentile, ddof", [(2024, 150, 181, 70, 0), (2024, 140, 220, 30, 1), (2023, 160, 175, 100, 0)])
+def test_get_z(observations, analysisYear, startJulian, endJulian, zPercentile, ddof):
+    stack, years, julians = observations
+    analysisZ, negativeDeparture = ls.get_z(stack, years, julians, startJulian, endJulian, analysisYear, zPercentile=zPercentile, zThresh=-1, ddof=ddof)
+    expected = reference_z(stack, years, julians, startJulian, endJulian, analysisYear, zPercentile=zPercentile, ddof=ddof)
+    assert analysisZ.shape == (6, 5)
+    numpy.testing.assert_allclose(analysisZ, expected, rtol=1e-4, atol=1e-4)
+    # Pixels that are never observed or have a constant baseline are masked
+    assert numpy.isnan(analysisZ[0, :2]).all() and not negativeDeparture[0, :2].any()
+    numpy.testing.assert_array_equal(negativeDeparture, expected <= -1)
+
+
+def test_to_export_int16():
+    out = ls.to_export_int16(numpy.array([-1.23456, 0.00019, numpy.nan, 40.0, -40.0]), ls.z_scale_factor)
+    assert out.dtype == numpy.int16
+    assert out.tolist() == [-1234, 0, ls.export_no_data, 32767, -32767]
+
+
+####################################################################################################
+def reference_trend(stack, years, julians, startJulian, endJulian, analysisYear, epochLength=5, annualPercentile=50, joint_mask=True):
+    composite_years = numpy.arange(analysisYear - epochLength + 1, analysisYear + 1)
+    in_range = (julians >= startJulian) & (julians <= endJulian)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        composites = numpy.stack([numpy.nanpercentile(stack[in_range & (years == yr)], annualPercentile, 0) for yr in composite_years])
+    # Fit each band of each pixel on its own with the years it (or every band if joint_mask) has a composite for
+    slope = numpy.full(composites.shape[1:], numpy.nan)
+    valid = ~numpy.isnan(composites)
+    if joint_mask:
+        valid = numpy.broadcast_to(valid.all(1, keepdims=True), valid.shape)
+    for b, y, x in numpy.ndindex(*slope.shape):
+        keep = valid[:, b, y, x]
+        if keep.sum() >= 2:
+            slope[b, y, x] = numpy.polyfit(composite_years[keep], composites[keep, b, y, x], 1)[0]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return numpy.nanmin(slope, 0)
+
+
+@pytest.mark.parametrize("method", ["linear", "lower", "higher", "nearest", "midpoint"])
+@pytest.mark.parametrize("percentile", [0, 10, 50, 70, 100])
+def test_nanpercentile(observations, method, percentile):
+    stack = observations[0]
+    out = ls.nanpercentile(stack, percentile, method)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        expected = numpy.nanpercentile(stack, percentile, 0, method=method)
+    assert out.shape == stack.shape[1:]
+    numpy.testing.assert_allclose(out, expected, rtol=1e-6)
+
+
+def test_nanpercentile_few_values():
+    values = numpy.array([[1.0, numpy.nan, numpy.nan], [3.0, 2.0, numpy.nan], [numpy.nan, numpy.nan, numpy.nan], [2.0, numpy.nan, numpy.nan]])
+    out = ls.nanpercentile(values, 70)
+    assert out[:2].tolist() == pytest.approx([numpy.nanpercentile(values[:, 0], 70), 2.0])
+    assert numpy.isnan(out[2])
+
+
+def test_unknown_percentile_method():
+    with pytest.raises(ValueError):
+        ls.nanpercentile(numpy.zeros((3, 2)), 50, "inverted_cdf")
+
+
+def test_epoch_years():
+    assert ls.get_epoch_years(2024) == (2020, 2024)
+    assert ls.get_epoch_years(2024, 3) == (2022, 2024)
+
+
+def test_ols_slope():
+    rng = numpy.random.default_rng(2)
+    x = numpy.arange(2020, 2025)
+    values = rng.normal(0, 1, (5, 2, 4))
+    slope = ls.ols_slope(values, x)
+    expected = numpy.polyfit(x, values.reshape(5, -1), 1)[0].reshape(2, 4)
+    assert slope.dtype == numpy.float32
+    numpy.testing.assert_allclose(slope, expected, rtol=1e-4, atol=1e-6)
+
+
+def test_ols_slope_masks():
+    x = numpy.arange(2020, 2025)
+    values = numpy.stack([2.0 * x, -1.0 * x]).T.reshape(5, 2, 1).astype("float64")
+    values[0, 0] = 1000
+    values[4, 1] = numpy.nan
+    # A time masked in any band is left out of every band of the pixel
+    assert ls.ols_slope(values, x)[:, 0].tolist() == pytest.approx([numpy.polyfit(x[:4], values[:4, 0, 0], 1)[0], -1.0])
+    assert ls.ols_slope(values, x, joint_mask=False)[:, 0].tolist() == pytest.approx([numpy.polyfit(x, values[:, 0, 0], 1)[0], -1.0])
+    assert numpy.isnan(ls.ols_slope(values[:1], x[:1])).all()
+
+
+def test_annual_composites(observations):
+    stack, years, julians = observations
+    composites = ls.get_annual_composites(stack, years, julians, 150, 190, [2018, 2023, 2024], 50)
+    assert composites.shape == (3, 2, 6, 5) and composites.dtype == numpy.float32
+    assert numpy.isnan(composites[0]).all()
+    keep = (years == 2023) & (julians >= 150) & (julians <= 190)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        numpy.testing.assert_allclose(composites[1], numpy.nanmedian(stack[keep], 0), rtol=1e-6)
+
+
+@pytest.mark.parametrize("joint_mask", [True, False])
+def test_get_trend(observations, joint_mask):
+    stack, years, julians = observations
+    # Leave a year out of one band of some pixels
+    stack[years == 2021, 0, 2] = numpy.nan
+    slope, negativeSlope = ls.get_trend(stack, years, julians, 150, 181, 2024, slopeThresh=-0.01, joint_mask=joint_mask)
+    assert slope.shape == (6, 5)
+    assert numpy.isnan(slope[0, 0]) and not negativeSlope[0, 0]
+    expected = reference_trend(stack, years, julians, 150, 181, 2024, joint_mask=joint_mask)
+    numpy.testing.assert_allclose(slope, expected, rtol=1e-4, atol=1e-6)
+    numpy.testing.assert_array_equal(negativeSlope, expected <= -0.01)
+
+
+def test_get_trend_drops_masked_years():
+    # A steady decline with one year without any observations
+    years = numpy.repeat(numpy.arange(2020, 2025), 2)
+    julians = numpy.tile([160, 170], 5)
+    stack = (0.8 - 0.1 * (years - 2020)).astype("float32").reshape(-1, 1, 1, 1) + numpy.zeros((1, 2, 1, 1), dtype="float32")
+    stack[years == 2022] = numpy.nan
+    slope, negativeSlope = ls.get_trend(stack, years, julians, 150, 181, 2024)
+    assert slope[0, 0] == pytest.approx(-0.1, rel=1e-5) and negativeSlope[0, 0]
+
+
+####################################################################################################
+def test_sums_to_mean_std(observations):
+    stack = observations[0]
+    sums = [ls.get_sums(stack[:40]), ls.get_sums(stack[40:])]
+    for ddof in [0, 1]:
+        mean, std, count = ls.sums_to_mean_std(*[a + b for a, b in zip(*sums)], ddof=ddof)
+        expected = ls.mean_std(stack, ddof)
+        numpy.testing.assert_allclose(mean, expected[0], rtol=1e-6)
+        numpy.testing.assert_allclose(std, expected[1], rtol=1e-4, atol=1e-6)
+        numpy.testing.assert_array_equal(count, expected[2])
+
+
+def test_get_sub_windows():
+    assert ls.get_sub_windows([169, 153, 185], 16, 8) == (153, {153: (0, 2), 169: (2, 4), 185: (4, 6)})
+    assert ls.get_sub_windows([153, 161], 16, 8) == (153, {153: (0, 2), 161: (1, 3)})
+    with pytest.raises(ValueError):
+        ls.get_sub_windows([153, 169], 16, 5)
+    with pytest.raises(ValueError):
+        ls.get_sub_windows([153, 160], 16, 8)
+
+
+def test_sort_by_sub_window():
+    years = numpy.array([2021, 2020, 2021, 2020])
+    julians = numpy.array([160, 170, 153, 153])
+    stack = numpy.arange(4.0).reshape(4, 1)
+    sorted_stack, keys = ls.sort_by_sub_window(stack, years, julians, 153, 8)
+    assert sorted_stack[:, 0].tolist() == [3.0, 1.0, 2.0, 0.0]
+    assert keys.tolist() == [2020000, 2020002, 2021000, 2021000]
+    assert sorted_stack[ls.get_slice(keys, 2021, 0, 1), 0].tolist() == [2.0, 0.0]
+    assert sorted_stack[ls.get_slice(keys, 2020, 0, 3), 0].tolist() == [3.0, 1.0]
+    assert sorted_stack[ls.get_slice(keys, 2022, 0, 3)].shape[0] == 0
+
+
+# Observations in no particular order
+@pytest.fixture
+def shuffled(observations):
+    stack, years, julians = observations
+    order = numpy.random.default_rng(4).permutation(len(years))
+    return stack[order], years[order], julians[order]
+
+
+@pytest.mark.parametrize("method", ["linear", "nearest"])
+def test_season_z_matches_get_z(shuffled, method):
+    stack, years, julians = shuffled
+    startJulians = [140, 148, 156, 196]
+    out = ls.get_season_z(stack, years, julians, startJulians, 16, 8, 2024, zThresh=-1, percentile_method=method)
+    assert sorted(out.keys()) == startJulians
+    for jd in startJulians:
+        analysisZ, negativeDeparture = ls.get_z(stack, years, julians, jd, jd + 15, 2024, zThresh=-1, percentile_method=method)
+        numpy.testing.assert_allclose(out[jd][0], analysisZ, rtol=1e-4, atol=1e-4)
+        numpy.testing.assert_array_equal(out[jd][1], negativeDeparture)
+
+
+def test_season_z_with_baselines(shuffled):
+    stack, years, julians = shuffled
+    # Baselines from a different set of years (as a climatology might provide)
+    baselines = {}
+    for jd in [140, 156]:
+        keep = ls.filter_dates(years, julians, jd, jd + 15, 2019, 2021)
+        baselines[jd] = ls.mean_std(stack[keep])
+    out = ls.get_season_z(stack, years, julians, [140, 156], 16, 8, 2024, baselines=baselines)
+    for jd in [140, 156]:
+        analysis = stack[ls.filter_dates(years, julians, jd, jd + 15, 2024, 2024)]
+        analysisZ, negativeDeparture = ls.get_analysis_z(analysis, baselines[jd][0], baselines[jd][1])
+        numpy.testing.assert_allclose(out[jd][0], analysisZ, rtol=1e-4, atol=1e-4)
+
+
+def test_season_trend_matches_get_trend(shuffled):
+    stack, years, julians = shuffled
+    startJulians = [140, 156, 172, 188]
+    out = ls.get_season_trend(stack, years, julians, startJulians, 24, 8, 2024, epochLength=4, slopeThresh=-0.01)
+    for jd in startJulians:
+        slope, negativeSlope = ls.get_trend(stack, years, julians, jd, jd + 23, 2024, epochLength=4, slopeThresh=-0.01)
+        numpy.testing.assert_allclose(out[jd][0], slope, rtol=1e-5, atol=1e-6)
+        numpy.testing.assert_array_equal(out[jd][1], negativeSlope)
+
+
+####################################################################################################
+def make_sketch(values, value_range=(-1.0, 1.0), n_bins=256, **kwargs):
+    sketch = ls.PercentileSketch(values.shape[1:], value_range, n_bins, **kwargs)
+    for image in values:
+        sketch.add(image)
+    return sketch
+
+
+@pytest.fixture
+def sketch_values():
+    rng = numpy.random.default_rng(5)
+    values = rng.normal(0.2, 0.3, (60, 8, 9)).clip(-1, 1).astype("float32")
+    values[rng.random(values.shape) < 0.2] = numpy.nan
+    values[:, 0, 0] = numpy.nan
+    values[0, 0, 1] = 0.3
+    values[1:, 0, 1] = numpy.nan
+    return values
+
+
+@pytest.mark.parametrize("method", ["linear", "lower", "higher", "nearest", "midpoint"])
+@pytest.mark.parametrize("percentile", [0, 5, 50, 70, 100])
+def test_sketch_matches_exact_percentiles(sketch_values, method, percentile):
+    sketch = make_sketch(sketch_values)
+    out = sketch.percentile(percentile, method, block_size=7)
+    expected = ls.nanpercentile(sketch_values, percentile, method)
+    assert out.shape == (8, 9) and out.dtype == numpy.float32
+    assert numpy.isnan(out[0, 0]) and numpy.isnan(expected[0, 0])
+    # Within a bin of the exact percentile, and exact for the min and max (and a pixel with one value)
+    numpy.testing.assert_allclose(out, expected, atol=sketch.bin_width)
+    if percentile in [0, 100]:
+        numpy.testing.assert_array_equal(out, expected)
+    assert out[0, 1] == sketch_values[0, 0, 1]
+
+
+def test_sketch_values_outside_range(sketch_values):
+    values = sketch_values * 10
+    sketch = make_sketch(values)
+    numpy.testing.assert_array_equal(sketch.percentile(0), ls.nanpercentile(values, 0))
+    numpy.testing.assert_array_equal(sketch.percentile(100), ls.nanpercentile(values, 100))
+    out = sketch.percentile(50)
+    valid = ~numpy.isnan(out)
+    assert (out[valid] >= ls.nanpercentile(values, 0)[valid]).all() and (out[valid] <= ls.nanpercentile(values, 100)[valid]).all()
+
+
+def test_sketch_offset_and_scale(sketch_values):
+    offset = numpy.full((8, 9), 5.0, dtype="float32")
+    scale = numpy.full((8, 9), 2.0, dtype="float32")
+    values = sketch_values * 2 + 5
+    sketch = make_sketch(values, offset=offset, scale=scale)
+    numpy.testing.assert_allclose(sketch.percentile(70), ls.nanpercentile(values, 70), atol=sketch.bin_width * 2)
+
+
+def test_sketch_merge(sketch_values):
+    merged = make_sketch(sketch_values[:25]).merge(make_sketch(sketch_values[25:]))
+    whole = make_sketch(sketch_values)
+    assert merged.n_added == whole.n_added
+    numpy.testing.assert_array_equal(merged.counts, whole.counts)
+    numpy.testing.assert_array_equal(merged.percentile(70), whole.percentile(70))
+    with pytest.raises(ValueError):
+        make_sketch(sketch_values).merge(make_sketch(sketch_values, n_bins=128))
+
+
+def test_sketch_counts_widen():
+    sketch = ls.PercentileSketch((2, 2), n_bins=16)
+    assert sketch.counts.dtype == numpy.uint8
+    for i in range(300):
+        sketch.add(numpy.full((2, 2), 0.5 if i < 299 else -0.5, dtype="float32"))
+    assert sketch.counts.dtype == numpy.uint16
+    assert (sketch.n == 300).all() and sketch.counts.sum(-1).tolist() == [[300, 300], [300, 300]]
+    assert (sketch.percentile(50) == 0.5).all()
+    assert (sketch.percentile(0) == -0.5).all()
+    assert sketch.nbytes == sketch.counts.nbytes + sketch.group_counts.nbytes + sketch.n.nbytes + sketch.min.nbytes + sketch.max.nbytes
+
+
+def test_z_streaming_matches_get_z(observations):
+    stack, years, julians = observations
+    analysisZ, negativeDeparture = ls.get_z(stack, years, julians, 150, 181, 2024, zThresh=-1)
+    out, out_negative = ls.get_z_streaming(iter(stack), years, julians, 150, 181, 2024, zThresh=-1, n_bins=1024)
+    assert out.shape == analysisZ.shape
+    numpy.testing.assert_array_equal(numpy.isnan(out), numpy.isnan(analysisZ))
+    numpy.testing.assert_allclose(out, analysisZ, atol=20.0 / 1024)
+
+    # With a baseline provided, only the analysis year is used
+    baseline = ls.mean_std(stack[ls.filter_dates(years, julians, 150, 181, 2020, 2022)])
+    analysis = ls.filter_dates(years, julians, 150, 181, 2024, 2024)
+    out, out_negative = ls.get_z_streaming(iter(stack[analysis]), years[analysis], julians[analysis], 150, 181, 2024, n_bins=1024, baseline=baseline)
+    numpy.testing.assert_allclose(out, analysisZ, atol=20.0 / 1024)
+
+
+def test_trend_streaming_matches_get_trend(observations):
+    stack, years, julians = observations
+    slope, negativeSlope = ls.get_trend(stack, years, julians, 150, 181, 2024)
+    out, out_negative = ls.get_trend_streaming(iter(stack), years, julians, 150, 181, 2024, n_bins=1024)
+    numpy.testing.assert_array_equal(numpy.isnan(out), numpy.isnan(slope))
+    # Composites are within a bin, so the slope over 5 years is within 2 bins per 2 years
+    numpy.testing.assert_allclose(out, slope, atol=2.0 / 1024)
+
+
+def test_streaming_out_of_order(observations):
+    stack, years, julians = observations
+    order = numpy.argsort(-years, kind="stable")
+    with pytest.raises(ValueError):
+        ls.get_z_streaming(iter(stack[order]), years[order], julians[order], 150, 181, 2024)
+    with pytest.raises(ValueError):
+        ls.get_trend_streaming(iter(stack[order]), years[order], julians[order], 150, 181, 2024)
+
+
+def test_streaming_empty():
+    with pytest.raises(ValueError):
+        ls.get_z_streaming(iter([]), [], [], 150, 181, 2024)
+    with pytest.raises(ValueError):
+        ls.get_trend_streaming(iter([]), [], [], 150, 181, 2024)
+
+    analysisZ, negativeDeparture = ls.get_z_streaming(iter([]), [], [], 150, 181, 2024, shape=(2, 3, 4))
+    assert analysisZ.shape == (3, 4) and numpy.isnan(analysisZ).all() and not negativeDeparture.any()
+    slope, negativeSlope = ls.get_trend_streaming(iter([]), [], [], 150, 181, 2024, shape=(2, 3, 4))
+    assert slope.shape == (3, 4) and numpy.isnan(slope).all() and not negativeSlope.any()
+
+    # Images that are all outside the julian range
+    images = numpy.zeros((2, 2, 3, 4), dtype="float32")
+    analysisZ, negativeDeparture = ls.get_z_streaming(iter(images), [2024, 2024], [10, 20], 150, 181, 2024)
+    assert analysisZ.shape == (3, 4) and numpy.isnan(analysisZ).all()
@@ -0,0 +1,171 @@
+# Tests of LAMDA_plan on hand-built snapshots
+import pytest
+
+import LAMDA_plan as lpl
+import LAMDA_transfer_lib as tl
+
+post_process_dict = {"_Z_": {"stretch": 6}, "_TDD_": {"stretch": 0.1}}
+startJulians = [153, 169, 185]
+tile = "-0000000000-0000065536"
+
+
+def get_units(exportRawZ=True, exportRawSlope=True):
+    return lpl.get_expected_units("CONUS", ["NBR", "NDVI"], 2024, startJulians, 16, 3, 5, 1, exportRawZ, exportRawSlope, post_process_dict, 2)
+
+
+def z_name(jd):
+    return "CONUS_LAMDA_Z_NBR-NDVI_bl2020-2022_ay2024_jd{}-{}".format(jd, jd + 15)
+
+
+def obj(name, crc32c="a"):
+    return tl.StorageObject(name, 10, None, crc32c, None, None)
+
+
+def snapshot(export=[], running=[], local=[], cog_fixed=[], manifest={}, deliverable=[], ingested=[]):
+    export_objs = {}
+    for name in export:
+        export_objs.setdefault(lpl.get_product_key(name), []).append(obj(name))
+    deliverable_objs = {lpl.get_product_key(name): [obj(name)] for name in deliverable}
+    return lpl.Snapshot(export_objs, set(running), set(local), set(cog_fixed), manifest, deliverable_objs, set(ingested))
+
+
+def delivered(units):
+    return [o for u in units for o in u.outputs]
+
+
+def stages_of(plan):
+    return {(u.method, u.kind, u.julians): u.stages for u in plan}
+
+
+def test_get_product_key():
+    assert lpl.get_product_key(z_name(153) + tile + ".tif") == z_name(153) + ".tif"
+    assert lpl.get_product_key("folder/" + z_name(153) + "_cog.tif") == z_name(153) + ".tif"
+    assert lpl.get_product_key(z_name(153) + tile + "_6_8bit_cog.tif") == z_name(153) + "_6_8bit.tif"
+    assert lpl.get_product_key("folder/notes.txt") == "notes.txt"
+
+
+def test_get_raw_name():
+    assert lpl.get_raw_name("CONUS", "Z", ["NBR", "NDVI"], 2024, 153, 16, 3, 5, 1) == z_name(153)
+    assert lpl.get_raw_name("AK", "TDD", ["NBR"], 2024, 1, 8, 3, 5, 1) == "AK_LAMDA_TDD_NBR_yrs2020-2024_jd1-8"
+
+
+def test_get_persistence_windows():
+    assert lpl.get_persistence_windows([185, 153, 169], 2) == [[153, 169], [169, 185]]
+    assert lpl.get_persistence_windows([153], 2) == []
+
+
+def test_get_expected_units():
+    units = get_units()
+    assert [(u.method, u.kind, u.julians) for u in units] == [
+        ("Z", "raw", (153,)),
+        ("Z", "raw", (169,)),
+        ("Z", "raw", (185,)),
+        ("Z", "persistence", (153, 169)),
+        ("Z", "persistence", (169, 185)),
+        ("TDD", "raw", (153,)),
+        ("TDD", "raw", (169,)),
+        ("TDD", "raw", (185,)),
+        ("TDD", "persistence", (153, 169)),
+        ("TDD", "persistence", (169, 185)),
+    ]
+    assert units[0].outputs == [z_name(153) + ".tif", z_name(153) + "_6_8bit.tif", z_name(153) + "_6_8bit.jpg"]
+    assert units[3].raw_names == [z_name(153), z_name(169)]
+    assert units[3].outputs == ["CONUS_LAMDA_Z_NBR-NDVI_bl2020-2022_ay2024_jds153-169_persistence.tif", "CONUS_LAMDA_Z_NBR-NDVI_bl2020-2022_ay2024_jds153-169_persistence.jpg"]
+    assert units[5].outputs[1] == "CONUS_LAMDA_TDD_NBR-NDVI_yrs2020-2024_jd153-168_0.1_8bit.tif"
+    assert all(u.stages == [] for u in units)
+    assert set(u.method for u in get_units(exportRawSlope=False)) == {"Z"}
+
+
+def test_plan_nothing_made():
+    units = get_units()
+    plan = lpl.plan_units(units, snapshot())
+    assert len(plan) == len(units)
+    for u in plan:
+        if u.kind == "raw":
+            assert u.stages == ["export", "sync", "post_process", "upload", "ingest"]
+        else:
+            assert u.stages == ["persistence", "upload", "ingest"]
+    assert lpl.get_export_groups(plan) == {(True, True): startJulians}
+    assert lpl.get_work_names(plan)[:3] == [z_name(153), z_name(169), z_name(185)]
+
+
+def test_plan_everything_done():
+    units = get_units()
+    tifs = [o for o in delivered(units) if o.endswith(".tif")]
+    plan = lpl.plan_units(units, snapshot(deliverable=delivered(units), ingested=tifs))
+    assert plan == []
+    assert lpl.get_export_groups(plan) == {}
+
+
+def test_plan_only_ingest_left():
+    units = get_units(exportRawSlope=False)
+    plan = lpl.plan_units(units, snapshot(deliverable=delivered(units)))
+    assert all(u.stages == ["ingest"] for u in plan) and len(plan) == len(units)
+    assert lpl.get_work_names(plan) == []
+    # Ingested names come from the snapshot (tiles kept, COG copies left out) plus anything just uploaded
+    names = lpl.get_ingest_names(plan, snapshot(deliverable=[z_name(153) + tile + ".tif", z_name(169) + "_cog.tif"]), uploaded_names=[z_name(185) + ".tif"])
+    assert names == [z_name(153) + tile + ".tif", z_name(185) + ".tif"]
+
+
+def test_plan_running_and_exported():
+    units = get_units(exportRawSlope=False)
+    s = snapshot(export=[z_name(153) + tile + ".tif", z_name(153) + "-0000065536-0000000000.tif"], running=[z_name(169)])
+    plan = lpl.plan_units(units, s)
+    stages = stages_of(plan)
+    assert stages[("Z", "raw", (153,))] == ["sync", "post_process", "upload", "ingest"]
+    assert stages[("Z", "raw", (169,))] == ["wait", "sync", "post_process", "upload", "ingest"]
+    assert stages[("Z", "raw", (185,))] == ["export", "sync", "post_process", "upload", "ingest"]
+    assert lpl.get_export_groups(plan) == {(True, False): [185]}
+    assert lpl.get_wait_names(plan) == [z_name(169)]
+    # Every tile of an export is synced
+    assert sorted(o.name for o in lpl.get_sync_objs(plan, s)) == sorted([z_name(153) + tile + ".tif", z_name(153) + "-0000065536-0000000000.tif"])
+
+
+def test_plan_local_work_left():
+    units = get_units(exportRawSlope=False)
+    raw, out_8bit, out_jpg = units[0].outputs
+    # Post processed locally but not uploaded
+    plan = lpl.plan_units(units[:1], snapshot(local=units[0].outputs, cog_fixed=[raw]))
+    assert plan[0].stages == ["upload", "ingest"]
+    # Synced but not post processed
+    plan = lpl.plan_units(units[:1], snapshot(local=[raw]))
+    assert plan[0].stages == ["post_process", "upload", "ingest"]
+
+
+def test_plan_persistence_needs_raws():
+    units = get_units(exportRawSlope=False)
+    persistence = [u for u in units if u.kind == "persistence"]
+    # Raw outputs are delivered and still in the export bucket, but one persistence window is missing
+    raws = [o for u in units if u.kind == "raw" for o in u.outputs]
+    s = snapshot(export=[z_name(jd) + ".tif" for jd in startJulians], deliverable=raws + persistence[0].outputs, ingested=[o for o in raws + persistence[0].outputs if o.endswith(".tif")])
+    plan = lpl.plan_units(units, s)
+    assert stages_of(plan) == {("Z", "raw", (169,)): ["sync"], ("Z", "raw", (185,)): ["sync"], ("Z", "persistence", (169, 185)): ["persistence", "upload", "ingest"]}
+    assert lpl.get_work_names(plan) == [z_name(169), z_name(185)]
+
+    # Delivered raw outputs that are gone from the export bucket are never exported again
+    s = s._replace(export_objs={})
+    stages = stages_of(lpl.plan_units(units, s))
+    assert stages == {("Z", "persistence", (169, 185)): ["persistence", "upload", "ingest"]}
+
+
+def test_plan_changed_raw():
+    units = get_units(exportRawSlope=False)
+    tifs = [o for o in delivered(units) if o.endswith(".tif")]
+    export = [z_name(jd) + ".tif" for jd in startJulians]
+    manifest = {name: {"size": 10, "crc32c": "a", "md5": None, "generation": None} for name in export}
+    s = snapshot(export=export, local=delivered(units), cog_fixed=export, manifest=manifest, deliverable=delivered(units), ingested=tifs)
+    assert lpl.plan_units(units, s) == []
+
+    # The export of the last period was made again
+    manifest[z_name(185) + ".tif"] = dict(manifest[z_name(185) + ".tif"], crc32c="b")
+    plan = lpl.plan_units(units, s)
+    assert stages_of(plan) == {("Z", "raw", (185,)): ["sync", "post_process", "upload"], ("Z", "persistence", (169, 185)): ["persistence", "upload"]}
+    assert sorted(lpl.get_work_names(plan)) == [z_name(169), z_name(185)]
+
+
+def test_print_plan(capsys):
+    units = get_units()
+    plan = lpl.plan_units(units, snapshot())
+    counts = lpl.print_plan(plan, len(units))
+    assert counts["export"] == 6 and counts["persistence"] == 4 and counts["wait"] == 0
+    assert "10 of 10 units need work" in capsys.readouterr().out
@@ -0,0 +1,119 @@
+# Tests of LAMDA_products
+import os
+
+import pytest
+
+import LAMDA_products as lp
+
+z_name = "CONUS_LAMDA_Z_NBR-NDVI_bl2020-2022_ay2024_jd153-168.tif"
+tdd_name = "AK_LAMDA_TDD_NBR-NDVI_yrs2020-2024_jd185-200.tif"
+tile = "-0000000000-0000065536"
+
+
+def test_raw_z():
+    p = lp.parse_product_name("/data/outputs/" + z_name)
+    assert p.path == "/data/outputs/" + z_name
+    assert p.name == z_name
+    assert (p.area, p.method, p.indices) == ("CONUS", "Z", "NBR-NDVI")
+    assert (p.baseline_start_year, p.baseline_end_year, p.year) == (2020, 2022, 2024)
+    assert (p.epoch_start_year, p.epoch_end_year) == (None, None)
+    assert (p.julians, p.start_julian, p.end_julian) == ((153,), 153, 168)
+    assert (p.tile, p.kind, p.stretch, p.cog, p.extension) == (None, "raw", None, False, ".tif")
+
+
+def test_raw_tdd():
+    p = lp.parse_product_name(tdd_name)
+    assert (p.area, p.method, p.indices) == ("AK", "TDD", "NBR-NDVI")
+    assert (p.epoch_start_year, p.epoch_end_year, p.year) == (2020, 2024, 2024)
+    assert (p.baseline_start_year, p.baseline_end_year) == (None, None)
+    assert (p.julians, p.start_julian, p.end_julian, p.kind) == ((185,), 185, 200, "raw")
+
+
+def test_area_with_underscores():
+    p = lp.parse_product_name("CONUS_West_LAMDA_Z_NBR_bl2020-2022_ay2024_jd1-16.tif")
+    assert (p.area, p.indices, p.start_julian, p.end_julian) == ("CONUS_West", "NBR", 1, 16)
+
+
+def test_tiled_raw():
+    p = lp.parse_product_name(z_name.replace(".tif", tile + ".tif"))
+    assert (p.tile, p.kind, p.start_julian, p.end_julian) == (tile, "raw", 153, 168)
+
+
+@pytest.mark.parametrize("stretch", ["6", "0.1", "-0.1"])
+def test_8bit(stretch):
+    name = z_name.replace(".tif", "_{}_8bit.tif".format(stretch))
+    p = lp.parse_product_name(name)
+    assert (p.kind, p.stretch, p.start_julian, p.cog) == ("8bit", stretch, 153, False)
+    assert lp.parse_product_name(os.path.splitext(name)[0] + ".jpg").extension == ".jpg"
+
+
+def test_tiled_8bit_cog():
+    p = lp.parse_product_name(tdd_name.replace(".tif", tile + "_0.1_8bit_cog.tif"))
+    assert (p.kind, p.stretch, p.tile, p.cog, p.start_julian) == ("8bit", "0.1", tile, True, 185)
+
+
+def test_raw_cog():
+    p = lp.parse_product_name(z_name.replace(".tif", "_cog.tif"))
+    assert (p.kind, p.cog) == ("raw", True)
+
+
+def test_persistence():
+    p = lp.parse_product_name("CONUS_LAMDA_Z_NBR-NDVI_bl2020-2022_ay2024_jds137-153-169_persistence.tif")
+    assert (p.kind, p.julians, p.start_julian, p.end_julian, p.tile) == ("persistence", (137, 153, 169), 169, 169, None)
+    assert lp.parse_product_name("CONUS_LAMDA_Z_NBR-NDVI_bl2020-2022_ay2024_jds137-153-169_persistence.jpg").extension == ".jpg"
+
+
+def test_tiled_persistence():
+    # The tile follows the julians and must not be read as more of them
+    p = lp.parse_product_name("CONUS_LAMDA_Z_NBR-NDVI_bl2020-2022_ay2024_jds9-25-41{}_persistence.tif".format(tile))
+    assert (p.kind, p.julians, p.tile) == ("persistence", (9, 25, 41), tile)
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "CONUS_RTFD_Z_NBR_bl2020-2022_ay2024_jd153-168.tif",
+        "CONUS_LAMDA_Q_NBR_bl2020-2022_ay2024_jd153-168.tif",
+        "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024.tif",
+        "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jd153-168",
+        "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jd153-168.tif.aux.xml",
+        ".CONUS_POST_PROCESS_DONE",
+    ],
+)
+def test_not_products(name):
+    assert lp.parse_product_name(name) == None
+
+
+def test_parse_and_list(tmp_path):
+    names = [z_name, tdd_name, "notes.txt"]
+    for name in names:
+        open(os.path.join(str(tmp_path), name), "w").close()
+    assert [p.name for p in lp.parse_product_names(names)] == [z_name, tdd_name]
+    assert sorted(p.name for p in lp.list_products(str(tmp_path))) == sorted([z_name, tdd_name])
+    assert lp.list_products(str(tmp_path / "missing")) == []
+
+
+def test_index_and_query():
+    names = [
+        "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jd169-184.tif",
+        "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jd153-168.tif",
+        "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jd153-168_6_8bit.tif",
+        "CONUS_LAMDA_Z_NBR_bl2019-2021_ay2023_jd153-168.tif",
+        "CONUS_LAMDA_TDD_NBR_yrs2020-2024_jd153-168.tif",
+        "AK_LAMDA_Z_NBR_bl2020-2022_ay2024_jd153-168.tif",
+    ]
+    products = lp.parse_product_names(names)
+    index = lp.build_product_index(products)
+    assert len(index[("CONUS", "Z", "NBR", 2024, 153)]) == 2
+
+    for source in [index, products]:
+        raws = lp.query_products(source, area="CONUS", method="Z", kind="raw")
+        assert [p.name for p in raws] == [names[3], names[1], names[0]]
+        assert [p.name for p in lp.query_products(source, year=2024, start_julian=153, kind="8bit")] == [names[2]]
+        assert len(lp.query_products(source, area="AK")) == 1
+        assert lp.query_products(source, method="TDD", extension=".jpg") == []
+
+
+def test_get_method():
+    assert lp.get_method("_Z_") == "Z"
+    assert lp.get_method("_TDD_") == "TDD"
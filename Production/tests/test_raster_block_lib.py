@@ -0,0 +1,167 @@
+# Tests of raster_block_lib against the original whole-array versions of the post-processing math
+import numpy
+import pytest
+
+import raster_block_lib as rbl
+
+no_data = -32768
+scale_factor = 1000
+thresh = -2.5
+
+
+# 7 periods of int16 z scores with scattered no data, a pixel that is always null, and one that is null in the first period only
+@pytest.fixture
+def periods():
+    rng = numpy.random.default_rng(2)
+    stack = rng.normal(-2000, 1500, (7, 9, 11)).clip(-32767, 32767).astype("int16")
+    stack[rng.random(stack.shape) < 0.1] = no_data
+    stack[:, 0, 0] = no_data
+    stack[0, 0, 1] = no_data
+    stack[1:, 0, 1] = -5000
+    return stack
+
+
+# Original calc_persistence math on a stack of periods
+def reference_persistence(stack, out_no_data=255):
+    stack = stack.astype("float32")
+    msk = numpy.max(stack == no_data, 0)
+    count = numpy.sum(stack / scale_factor < thresh, 0)
+    count[msk] = out_no_data
+    return count
+
+
+def test_change_masks(periods):
+    change, no_data_mask = rbl.get_change_masks(periods[0], scale_factor, thresh, no_data)
+    assert change.dtype == numpy.uint8 and no_data_mask.dtype == numpy.uint8
+    numpy.testing.assert_array_equal(change, periods[0].astype("float32") / scale_factor < thresh)
+    numpy.testing.assert_array_equal(no_data_mask, periods[0] == no_data)
+
+
+@pytest.mark.parametrize("n_periods", [1, 3, 7])
+def test_rolling_persistence_matches_per_window(periods, n_periods):
+    n_windows = len(periods) - n_periods + 1
+    read = []
+
+    def read_masks(i):
+        read.append(i)
+        return rbl.get_change_masks(periods[i], scale_factor, thresh, no_data)
+
+    windows = dict(rbl.iter_persistence_windows(read_masks, ["out_{}".format(w) for w in range(n_windows)], n_periods))
+    assert sorted(windows) == list(range(n_windows))
+    assert read == list(range(len(periods)))
+    for w, count in windows.items():
+        numpy.testing.assert_array_equal(count, reference_persistence(periods[w : w + n_periods]))
+
+    # The pixel null in the first period only is null in the first window only
+    assert windows[0][0, 1] == 255
+    assert (numpy.array([windows[w][0, 1] for w in range(1, n_windows)]) == n_periods).all()
+    assert (numpy.array([windows[w][0, 0] for w in range(n_windows)]) == 255).all()
+
+
+def test_rolling_persistence_only_reads_needed_periods(periods):
+    read = []
+
+    def read_masks(i):
+        read.append(i)
+        return rbl.get_change_masks(periods[i], scale_factor, thresh, no_data)
+
+    # Windows 1 and 4 of 5 (windows 0, 2, and 3 already exist)
+    windows = dict(rbl.iter_persistence_windows(read_masks, [None, "a", None, None, "b"], 3))
+    assert sorted(windows) == [1, 4]
+    assert read == list(range(1, 7))
+    for w, count in windows.items():
+        numpy.testing.assert_array_equal(count, reference_persistence(periods[w : w + 3]))
+
+    read.clear()
+    assert list(rbl.iter_persistence_windows(read_masks, [None, None], 3)) == []
+    assert read == []
+
+
+def test_persistence_window_out_no_data(periods):
+    window = rbl.PersistenceWindow(2, out_no_data=99)
+    for i in range(3):
+        window.add(*rbl.get_change_masks(periods[i], scale_factor, thresh, no_data))
+    numpy.testing.assert_array_equal(window.count(), reference_persistence(periods[1:3], 99))
+
+
+@pytest.mark.parametrize("dtype", ["int16", "float32"])
+def test_running_stats_match_whole_array(periods, dtype):
+    image = periods[0].astype(dtype)
+    if dtype == "float32":
+        image[1, :] = numpy.nan
+    stats = rbl.RunningStats()
+    # Blocks of 4 x 4 (with partial blocks along the edges)
+    for yoff in range(0, image.shape[0], 4):
+        for xoff in range(0, image.shape[1], 4):
+            block = image[yoff : yoff + 4, xoff : xoff + 4]
+            stats.add(block[block != no_data])
+
+    values = image[(image != no_data) & ~numpy.isnan(image)].astype("float64")
+    Min, Max, Mean, Std = stats.get_stats()
+    assert (Min, Max) == (values.min(), values.max())
+    assert Mean == pytest.approx(values.mean(), rel=1e-12)
+    assert Std == pytest.approx(values.std(), rel=1e-9)
+
+
+def test_running_stats_without_values():
+    stats = rbl.RunningStats()
+    stats.add(numpy.array([], dtype="int16"))
+    stats.add(numpy.array([numpy.nan], dtype="float32"))
+    assert stats.get_stats() == None
+
+
+# Original arithmetic 8 bit stretch (stretch_to_8bit_in_memory)
+def reference_stretch(block, stretch, out_min=0, out_max=254, out_no_data=255):
+    block = block.astype("float32")
+    out = ((numpy.clip(block / scale_factor, -stretch, stretch) + stretch) * (out_max - out_min)) / (2 * stretch)
+    out[block == no_data] = out_no_data
+    return out
+
+
+@pytest.mark.parametrize("stretch", [2, 5, 2.5])
+def test_stretch_table_matches_arithmetic_stretch(stretch):
+    rng = numpy.random.default_rng(3)
+    block = rng.integers(-32768, 32768, (64, 64)).astype("int16")
+    # Both clip ends, the values just inside them, and no data
+    limit = int(stretch * scale_factor)
+    block[0, :6] = [-limit - 1, -limit, -limit + 1, limit - 1, limit, limit + 1]
+    block[1, :3] = [no_data, -32767, 32767]
+
+    table = rbl.get_stretch_table(no_data, scale_factor, stretch)
+    out = table[block.view("uint16")]
+    assert out.dtype == numpy.float32
+    numpy.testing.assert_array_equal(out, rbl.stretch_block(block, no_data, scale_factor, stretch))
+    numpy.testing.assert_array_equal(out, reference_stretch(block, stretch))
+    assert out[0, :2].tolist() == [0, 0] and out[0, 4:6].tolist() == [254, 254]
+    assert out[1].tolist()[:3] == [255, 0, 254]
+
+
+def test_pack_persistence_masks_round_trip(periods):
+    masks = rbl.pack_persistence_masks(periods[0], scale_factor, thresh, no_data)
+    assert masks.dtype == numpy.uint8 and masks.max() <= 3
+    for unpacked, expected in zip(rbl.unpack_persistence_masks(masks), rbl.get_change_masks(periods[0], scale_factor, thresh, no_data)):
+        numpy.testing.assert_array_equal(unpacked, expected)
+
+
+# Fused post processing hands each block to the 8 bit stretch and the persistence masks
+# Assembled from 4 x 4 blocks (with partial blocks along the edges), the outputs must match the separate whole-image passes
+def test_fused_blocks_match_separate_passes(periods):
+    stretch = 2.5
+    table = rbl.get_stretch_table(no_data, scale_factor, stretch)
+    saved_masks = []
+    for image in periods:
+        out_8bit = numpy.zeros(image.shape, dtype="float32")
+        masks = numpy.zeros(image.shape, dtype="uint8")
+        for yoff in range(0, image.shape[0], 4):
+            for xoff in range(0, image.shape[1], 4):
+                block = image[yoff : yoff + 4, xoff : xoff + 4]
+                out_8bit[yoff : yoff + 4, xoff : xoff + 4] = table[block.view("uint16")]
+                masks[yoff : yoff + 4, xoff : xoff + 4] = rbl.pack_persistence_masks(block, scale_factor, thresh, no_data)
+
+        numpy.testing.assert_array_equal(out_8bit, reference_stretch(image, stretch))
+        saved_masks.append(masks)
+
+    # Persistence from the saved masks matches calc_persistence on the raw images
+    read = lambda i: rbl.unpack_persistence_masks(saved_masks[i])
+    for w, count in rbl.iter_persistence_windows(read, ["out"] * (len(periods) - 2), 3):
+        numpy.testing.assert_array_equal(count, reference_persistence(periods[w : w + 3]))
@@ -0,0 +1,128 @@
+# Tests of the COG updates in raster_processing_lib on small synthetic rasters
+# These need GDAL and are skipped where it isn't installed
+import os
+
+import numpy
+import pytest
+
+gdal = pytest.importorskip("osgeo.gdal")
+osr = pytest.importorskip("osgeo.osr")
+
+import raster_processing_lib as rpl
+from conftest import read
+
+crs = "EPSG:5070"
+no_data = -32768
+palette = ["a83800", "ff5500", "e0e0e0", "a4ff73", "38a800"]
+
+
+# Write an int16 COG laid out like a GEE export (tiled, internal overviews, header first)
+def make_cog(path, no_data_value=no_data, crs=crs, size=1024):
+    rng = numpy.random.default_rng(4)
+    values = rng.integers(-5000, 5000, (size, size)).astype("int16")
+    values[:100, :100] = no_data
+
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(crs)
+    ds = gdal.GetDriverByName("MEM").Create("", size, size, 1, gdal.GDT_Int16)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.SetGeoTransform([-2361915.0, 30, 0, 3177735.0, 0, -30])
+    b = ds.GetRasterBand(1)
+    b.WriteArray(values)
+    if no_data_value != None:
+        b.SetNoDataValue(no_data_value)
+    gdal.GetDriverByName("COG").CreateCopy(path, ds, options=["COMPRESS=DEFLATE", "BLOCKSIZE=256"])
+    ds = None
+    return values[values != no_data].astype("float64")
+
+
+def get_stats(path):
+    rast = gdal.Open(path)
+    stats = rast.GetRasterBand(1).GetStatistics(False, False)
+    rast = None
+    return stats
+
+
+def test_gee_style_cog_skips_rewrite(tmp_path):
+    image = str(tmp_path / "CONUS_LAMDA_Z_2024_177-192.tif")
+    valid = make_cog(image)
+    before = read(image)
+    assert rpl.is_cog(image)
+
+    rpl.update_cog(image, crs, no_data)
+
+    assert read(image) == before
+    assert os.path.exists(rpl.get_stats_sidecar_name(image))
+    Min, Max, Mean, Std = get_stats(image)
+    assert Mean == pytest.approx(valid.mean())
+    assert Std == pytest.approx(valid.std())
+
+
+@pytest.mark.parametrize("fused", [True, False])
+def test_cog_without_no_data_is_rewritten(tmp_path, fused):
+    image = str(tmp_path / "CONUS_LAMDA_Z_2024_177-192.tif")
+    valid = make_cog(image, no_data_value=None)
+    before = read(image)
+
+    rpl.update_cog(image, crs, no_data, fused=fused)
+
+    assert read(image) != before
+    assert rpl.is_cog(image)
+    assert not os.path.exists(rpl.get_stats_sidecar_name(image))
+    rast = gdal.Open(image)
+    assert rast.GetRasterBand(1).GetNoDataValue() == no_data
+    rast = None
+    Min, Max, Mean, Std = get_stats(image)
+    assert Mean == pytest.approx(valid.mean())
+    assert Std == pytest.approx(valid.std())
+
+
+def test_fused_post_process_keeps_gee_style_cog(tmp_path):
+    image = str(tmp_path / "CONUS_LAMDA_Z_2024_177-192.tif")
+    valid = make_cog(image)
+    before = read(image)
+
+    rpl.post_process_tif(image, crs, no_data, 1000, 5, palette, update=True, thresh=-2.5, fused=True)
+
+    assert read(image) == before
+    assert os.path.exists(rpl.get_8bit_name(image, 5))
+    assert rpl.has_persistence_masks(image, 1000, -2.5)
+    Min, Max, Mean, Std = get_stats(image)
+    assert Mean == pytest.approx(valid.mean())
+
+
+@pytest.mark.parametrize("use_lut", [True, False])
+def test_streaming_stretch_matches_in_memory(tmp_path, use_lut):
+    image = str(tmp_path / "CONUS_LAMDA_Z_2024_177-192.tif")
+    make_cog(image)
+    expected = str(tmp_path / "expected.tif")
+    actual = str(tmp_path / "actual.tif")
+
+    rpl.stretch_to_8bit_in_memory(image, expected, no_data, 1000, 2.5, palette)
+    rpl.stretch_to_8bit_streaming(image, actual, no_data, 1000, 2.5, palette, use_lut=use_lut)
+
+    numpy.testing.assert_array_equal(gdal.Open(actual).ReadAsArray(), gdal.Open(expected).ReadAsArray())
+
+
+def test_translate_preview_of_missing_image(tmp_path):
+    output = str(tmp_path / "missing.jpg")
+    rpl.translate_preview(str(tmp_path / "missing.tif"), output)
+    assert not os.path.exists(output)
+
+
+def test_default_output_profiles_match_baseline():
+    for kind in ["raw", "byte"]:
+        assert rpl.get_gtiff_options(kind) == ["TILED=YES", "COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER"]
+        assert rpl.get_cog_options(kind) == ["COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER"]
+
+
+def test_set_output_profile_opts_in():
+    original = dict(rpl.output_profiles["raw"])
+    try:
+        rpl.set_output_profile("raw", predictor=2, num_threads=2, blocksize=512)
+        assert "PREDICTOR=2" in rpl.get_gtiff_options("raw") and "NUM_THREADS=2" in rpl.get_gtiff_options("raw")
+        assert "PREDICTOR=STANDARD" in rpl.get_cog_options("raw") and "BLOCKSIZE=512" in rpl.get_cog_options("raw")
+        assert rpl.cogArgs["creationOptions"] == rpl.get_cog_options("raw")
+        assert "PREDICTOR=2" not in rpl.get_gtiff_options("byte")
+    finally:
+        rpl.set_output_profile("raw", **original)
@@ -0,0 +1,198 @@
+# Tests of LAMDA_scheduler
+import threading
+
+import pytest
+
+import LAMDA_scheduler as sc
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = sc.Scheduler({"cpu": 1, "network": 2})
+    yield scheduler
+    scheduler.close()
+
+
+def fail(message):
+    raise RuntimeError(message)
+
+
+def test_unknown_pool(scheduler):
+    with pytest.raises(ValueError):
+        scheduler.submit("job", "gee", print)
+
+
+def test_result(scheduler):
+    job = scheduler.submit("add", "cpu", lambda a, b=0: a + b, args=(1,), kwargs={"b": 2})
+    assert job.wait(10)
+    assert job.ok and job.result == 3 and job.error == None
+    assert job.seconds >= 0
+
+
+def test_priority_order(scheduler):
+    # Hold the only cpu worker so every other job is queued before any of them runs
+    release = threading.Event()
+    order = []
+    blocker = scheduler.submit("blocker", "cpu", release.wait)
+    for name, priority in [("c", 3), ("a", -1), ("b1", 0), ("b2", 0), ("d", 10)]:
+        scheduler.submit(name, "cpu", order.append, args=(name,), priority=priority)
+    release.set()
+    scheduler.wait(10)
+    assert blocker.ok
+    # Ties run in the order they were submitted
+    assert order == ["a", "b1", "b2", "c", "d"]
+
+
+def test_dependencies_across_pools(scheduler):
+    release = threading.Event()
+    order = []
+    download = scheduler.submit("download", "network", lambda: (release.wait(), order.append("download")))
+    process = scheduler.submit("process", "cpu", order.append, args=("process",), depends_on=[download])
+    upload = scheduler.submit("upload", "network", order.append, args=("upload",), depends_on=[process])
+    assert not process.done.is_set()
+    release.set()
+    jobs = scheduler.wait(10)
+    assert order == ["download", "process", "upload"]
+    assert all(job.ok for job in jobs)
+    assert [job.name for job in jobs] == ["download", "process", "upload"]
+
+
+def test_depends_on_finished_job(scheduler):
+    first = scheduler.submit("first", "cpu", int)
+    first.wait(10)
+    second = scheduler.submit("second", "cpu", int, depends_on=[first])
+    assert second.wait(10) and second.ok
+
+
+def test_failure_skips_dependents(scheduler):
+    failed = scheduler.submit("sync", "network", fail, args=("no network",))
+    skipped = scheduler.submit("post process", "cpu", int, depends_on=[failed])
+    skipped_too = scheduler.submit("upload", "network", int, depends_on=[skipped])
+    cleanup = scheduler.submit("cleanup", "cpu", lambda: "cleaned", depends_on=[failed], run_if_failed=True)
+    other = scheduler.submit("other area", "cpu", lambda: "ok")
+    scheduler.wait(10)
+
+    assert isinstance(failed.error, RuntimeError) and not failed.ok
+    assert skipped.error == "Skipped since sync failed" and skipped.result == None
+    assert skipped_too.error == "Skipped since post process failed"
+    assert cleanup.ok and cleanup.result == "cleaned"
+    assert other.ok
+
+
+def test_jobs_submitted_by_jobs(scheduler):
+    results = []
+
+    def sync():
+        for i in range(3):
+            scheduler.submit("post process {}".format(i), "cpu", results.append, args=(i,))
+
+    scheduler.submit("sync", "network", sync)
+    jobs = scheduler.wait(10)
+    assert len(jobs) == 4 and all(job.ok for job in jobs)
+    assert sorted(results) == [0, 1, 2]
+
+
+def test_pool_size_limits_concurrency():
+    scheduler = sc.Scheduler({"network": 2})
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def transfer():
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        threading.Event().wait(0.02)
+        with lock:
+            running[0] -= 1
+
+    for i in range(8):
+        scheduler.submit("transfer {}".format(i), "network", transfer)
+    scheduler.wait(10)
+    scheduler.close()
+    assert running[1] == 2
+
+
+def test_close_stops_workers():
+    scheduler = sc.Scheduler({"cpu": 2})
+    scheduler.submit("job", "cpu", int)
+    scheduler.wait(10)
+    scheduler.close()
+    for worker in scheduler.workers:
+        worker.join(10)
+    assert not any(worker.is_alive() for worker in scheduler.workers)
+
+
+# Fake GEE task list: each export finishes after its number of polls
+class FakeTasks:
+    def __init__(self, polls_to_finish, final_state="COMPLETED"):
+        self.polls_to_finish = polls_to_finish
+        self.final_state = final_state
+        self.polls = 0
+
+    def get_states(self):
+        self.polls += 1
+        return {name: self.final_state if self.polls >= n else "RUNNING" for name, n in self.polls_to_finish.items()}
+
+
+def test_export_watcher_waits_until_finished():
+    tasks = FakeTasks({"a": 1, "b": 3})
+    watcher = sc.ExportWatcher(tasks.get_states, poll_seconds=0.01)
+    try:
+        assert watcher.wait(["a", "b"], timeout=10) == {"a": "COMPLETED", "b": "COMPLETED"}
+        assert tasks.polls >= 3
+        # Finished exports are returned without waiting
+        assert watcher.wait(["a"], timeout=0) == {"a": "COMPLETED"}
+    finally:
+        watcher.close()
+
+
+def test_export_watcher_failed_and_missing_exports():
+    tasks = FakeTasks({"a": 1}, final_state="FAILED")
+    watcher = sc.ExportWatcher(tasks.get_states, poll_seconds=0.01)
+    try:
+        assert watcher.wait(["a", "missing"], timeout=10) == {"a": "FAILED", "missing": None}
+    finally:
+        watcher.close()
+
+
+def test_export_watcher_polls_once_for_every_waiter():
+    tasks = FakeTasks({str(i): 2 for i in range(8)})
+    watcher = sc.ExportWatcher(tasks.get_states, poll_seconds=0.2)
+    results = []
+    try:
+        threads = [threading.Thread(target=lambda i=i: results.append(watcher.wait([str(i)], timeout=10))) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(results) == 8
+        assert all(list(r.values()) == ["COMPLETED"] for r in results)
+        assert tasks.polls <= 4
+    finally:
+        watcher.close()
+
+
+def test_export_watcher_survives_failed_polls():
+    tasks = FakeTasks({"a": 3})
+    get_states = tasks.get_states
+
+    def flaky():
+        if tasks.polls == 0:
+            tasks.polls += 1
+            raise RuntimeError("task list unavailable")
+        return get_states()
+
+    watcher = sc.ExportWatcher(flaky, poll_seconds=0.01)
+    try:
+        assert watcher.wait(["a"], timeout=10) == {"a": "COMPLETED"}
+    finally:
+        watcher.close()
+
+
+def test_export_watcher_timeout_and_close():
+    tasks = FakeTasks({"a": 10**6})
+    watcher = sc.ExportWatcher(tasks.get_states, poll_seconds=0.01)
+    assert watcher.wait(["a"], timeout=0.1) == {}
+    watcher.close()
+    watcher.thread.join(5)
+    assert not watcher.thread.is_alive()
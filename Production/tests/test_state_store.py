@@ -0,0 +1,147 @@
+# Tests of LAMDA_state_store
+import os, sqlite3
+from collections import namedtuple
+
+import pytest
+
+import LAMDA_state_store as sl
+from conftest import write
+
+RemoteObj = namedtuple("RemoteObj", ["name", "size", "crc32c", "md5", "generation"])
+
+
+def test_open_creates_folder_and_store(tmp_path):
+    conn = sl.open_state_store(str(tmp_path / "new" / "folder"))
+    conn.close()
+    assert os.path.exists(sl.get_state_store_path(str(tmp_path / "new" / "folder")))
+
+
+def test_products_are_keyed_by_file_name(conn):
+    sl.mark_stage_done(conn, "/local/a/LAMDA_x.tif", "synced")
+    assert sl.is_stage_done(conn, "gs://bucket/LAMDA_x.tif", "synced")
+    assert not sl.is_stage_done(conn, "LAMDA_x.tif", "8-bit")
+    assert sl.get_done_products(conn, "synced") == {"LAMDA_x.tif"}
+
+
+def test_unknown_stage_raises(conn):
+    with pytest.raises(ValueError):
+        sl.mark_stage_done(conn, "a.tif", "not-a-stage")
+    with pytest.raises(ValueError):
+        sl.mark_stages_done(conn, ["a.tif"], "not-a-stage")
+
+
+def test_fingerprint_changes_with_content(tmp_path):
+    path = write(tmp_path / "a.tif", b"abc")
+    assert sl.get_fingerprint(str(tmp_path / "missing.tif")) == None
+    before = sl.get_fingerprint(path)
+    write(path, b"abcd")
+    assert sl.get_fingerprint(path) != before
+
+
+def test_stage_is_stale_when_fingerprint_changes(conn, tmp_path):
+    path = write(tmp_path / "a.tif", b"abc")
+    sl.mark_stage_done(conn, path, "cog-fixed", sl.get_fingerprint(path))
+    assert sl.is_stage_done(conn, path, "cog-fixed", sl.get_fingerprint(path))
+    write(path, b"abcd")
+    assert not sl.is_stage_done(conn, path, "cog-fixed", sl.get_fingerprint(path))
+    # Without a fingerprint to check against, only whether the stage was recorded matters
+    assert sl.is_stage_done(conn, path, "cog-fixed")
+
+
+def test_stage_recorded_without_fingerprint_is_stale(conn):
+    sl.mark_stage_done(conn, "a.tif", "jpg")
+    assert sl.is_stage_done(conn, "a.tif", "jpg")
+    assert not sl.is_stage_done(conn, "a.tif", "jpg", "3-123")
+
+
+def test_mark_stages_done(conn):
+    sl.mark_stages_done(conn, ["a.tif", "b.tif"], "uploaded", ["1-1", "2-2"])
+    assert sl.is_stage_done(conn, "a.tif", "uploaded", "1-1")
+    assert sl.is_stage_done(conn, "b.tif", "uploaded", "2-2")
+    sl.mark_stages_done(conn, ["c.tif"], "uploaded")
+    assert sl.get_done_products(conn, "uploaded") == {"a.tif", "b.tif", "c.tif"}
+
+
+def test_clear_stage_and_stages(conn):
+    for stage in sl.stages:
+        sl.mark_stage_done(conn, "a.tif", stage)
+        sl.mark_stage_done(conn, "b.tif", stage)
+
+    sl.clear_stage(conn, "a.tif", "jpg")
+    assert not sl.is_stage_done(conn, "a.tif", "jpg")
+    assert sl.is_stage_done(conn, "a.tif", "8-bit")
+
+    sl.clear_stage(conn, "a.tif")
+    assert not any(sl.is_stage_done(conn, "a.tif", stage) for stage in sl.stages)
+
+    sl.clear_stages(conn, "b.tif", keep=("uploaded", "ingested"))
+    assert [stage for stage in sl.stages if sl.is_stage_done(conn, "b.tif", stage)] == ["uploaded", "ingested"]
+    sl.clear_stages(conn, "b.tif")
+    assert not any(sl.is_stage_done(conn, "b.tif", stage) for stage in sl.stages)
+
+
+def test_import_done_file_fingerprints_current_files(conn, local_dir):
+    folder = local_dir
+    present = write(os.path.join(folder, "LAMDA_a.tif"))
+    done_file = os.path.join(folder, ".CONUS_POST_PROCESS_DONE")
+    # Legacy done files can hold paths from other machines, only the file name is used
+    write(done_file, b"/old/machine/LAMDA_a.tif,LAMDA_missing.tif,")
+    sl.import_done_file(conn, done_file, "cog-fixed")
+
+    assert sl.is_stage_done(conn, present, "cog-fixed", sl.get_fingerprint(present))
+    assert sl.is_stage_done(conn, "LAMDA_missing.tif", "cog-fixed")
+    assert not sl.is_stage_done(conn, "LAMDA_missing.tif", "cog-fixed", "1-1")
+
+    # A file that changes after the import is processed again
+    write(present, b"changed")
+    assert not sl.is_stage_done(conn, present, "cog-fixed", sl.get_fingerprint(present))
+
+
+def test_import_done_file_keeps_existing_entries(conn, local_dir):
+    folder = local_dir
+    sl.mark_stage_done(conn, "LAMDA_a.tif", "cog-fixed", "9-9")
+    sl.import_done_file(conn, write(os.path.join(folder, ".DONE"), b"LAMDA_a.tif"), "cog-fixed")
+    assert sl.is_stage_done(conn, "LAMDA_a.tif", "cog-fixed", "9-9")
+    sl.import_done_file(conn, os.path.join(folder, ".MISSING_DONE"), "cog-fixed")
+
+
+def test_manifest_round_trip(conn):
+    location = "gs://lamda-raw-outputs"
+    sl.update_manifest(conn, [RemoteObj("dir/a.tif", 10, "crc", "md5", 1234), RemoteObj("b.tif", 20, None, None, None)], location)
+    manifest = sl.get_manifest(conn, location)
+    assert manifest == {
+        "a.tif": {"size": 10, "crc32c": "crc", "md5": "md5", "generation": "1234"},
+        "b.tif": {"size": 20, "crc32c": None, "md5": None, "generation": None},
+    }
+    assert sl.get_manifest(conn, "gs://other") == {}
+
+    sl.update_manifest(conn, [RemoteObj("a.tif", 11, "crc2", "md52", 1235)], location)
+    assert sl.get_manifest(conn, location)["a.tif"]["size"] == 11
+
+
+def test_manifest_is_kept_per_location(conn):
+    sl.update_manifest(conn, [RemoteObj("a.tif", 10, "crc", "md5", 1)], "gs://raw")
+    sl.update_manifest(conn, [RemoteObj("a.tif", 20, "crc2", "md52", 2)], "gs://deliverables")
+    assert sl.get_manifest(conn, "gs://raw")["a.tif"]["size"] == 10
+    assert sl.get_manifest(conn, "gs://deliverables")["a.tif"]["size"] == 20
+
+
+def test_old_manifest_is_migrated(tmp_path):
+    folder = str(tmp_path / "out")
+    os.makedirs(folder)
+    old = sqlite3.connect(sl.get_state_store_path(folder))
+    old.execute("CREATE TABLE remote_manifest (product TEXT NOT NULL PRIMARY KEY, location TEXT, size INTEGER, crc32c TEXT, md5 TEXT, generation TEXT, updated REAL)")
+    old.execute("INSERT INTO remote_manifest VALUES ('a.tif', 'gs://raw', 10, 'crc', 'md5', '1', 0)")
+    old.commit()
+    old.close()
+
+    conn = sl.open_state_store(folder)
+    assert sl.get_manifest(conn, "gs://raw") == {"a.tif": {"size": 10, "crc32c": "crc", "md5": "md5", "generation": "1"}}
+    sl.update_manifest(conn, [RemoteObj("a.tif", 20, None, None, None)], "gs://deliverables")
+    assert sl.get_manifest(conn, "gs://raw")["a.tif"]["size"] == 10
+    conn.close()
+
+    # Opening again leaves the migrated manifest alone
+    conn = sl.open_state_store(folder)
+    assert len(sl.get_manifest(conn, "gs://deliverables")) == 1
+    conn.close()
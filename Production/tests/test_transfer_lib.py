@@ -0,0 +1,243 @@
+# Tests of LAMDA_transfer_lib using local folder backends
+import os
+
+import pytest
+
+import LAMDA_transfer_lib as tl
+import LAMDA_state_store as sl
+import LAMDA_products as lp
+from conftest import write, read
+
+
+@pytest.fixture
+def remote(tmp_path):
+    root = str(tmp_path / "remote")
+    write(os.path.join(root, "CONUS_LAMDA_a.tif"), b"aaa")
+    write(os.path.join(root, "CONUS_LAMDA_b.tif"), b"bbbb")
+    write(os.path.join(root, "AK_LAMDA_c.tif"), b"c")
+    write(os.path.join(root, "sub", "CONUS_LAMDA_d.tif"), b"dd")
+    write(os.path.join(root, "CONUS_LAMDA_e.tif.part"), b"partial")
+    return tl.LocalBackend(root)
+
+
+# Backend whose transfers of some names fail
+class FailingBackend(tl.LocalBackend):
+    def __init__(self, root, fail):
+        tl.LocalBackend.__init__(self, root)
+        self.fail = fail
+
+    def download(self, name, local_path):
+        if name in self.fail:
+            with open(local_path, "wb") as o:
+                o.write(b"half")
+            raise IOError("download failed")
+        tl.LocalBackend.download(self, name, local_path)
+
+    def upload(self, local_path, name):
+        if name in self.fail:
+            raise IOError("upload failed")
+        tl.LocalBackend.upload(self, local_path, name)
+
+
+def obj(size=1, crc32c=None, md5=None, generation=None):
+    return tl.StorageObject("a.tif", size, 0, crc32c, md5, generation)
+
+
+def test_same_content():
+    assert not tl.same_content(obj(size=1, crc32c="x"), obj(size=2, crc32c="x"))
+    assert tl.same_content(obj(crc32c="x", md5="1"), obj(crc32c="x", md5="2"))
+    assert not tl.same_content(obj(crc32c="x"), obj(crc32c="y"))
+    assert tl.same_content(obj(md5="1"), obj(crc32c="x", md5="1"))
+    assert not tl.same_content(obj(md5="1"), obj(md5="2"))
+    # Generations from the manifest are text
+    assert tl.same_content(obj(generation=12), obj(generation="12"))
+    assert not tl.same_content(obj(generation=12), obj(generation=13))
+    assert not tl.same_content(obj(), obj())
+    assert not tl.same_content(obj(generation=12), obj())
+
+
+def test_get_md5(tmp_path):
+    # base64 md5 of an empty file as GCS reports it
+    assert tl.get_md5(write(str(tmp_path / "empty"), b"")) == "1B2M2Y8AsgTpgAmY7PhCfg=="
+
+
+def test_local_list(remote):
+    names = [o.name for o in remote.list("*CONUS_LAMDA*")]
+    assert names == ["CONUS_LAMDA_a.tif", "CONUS_LAMDA_b.tif", "sub/CONUS_LAMDA_d.tif"]
+    a = remote.list("CONUS_LAMDA_a.tif")[0]
+    assert a.size == 3
+    assert a.md5 == None and a.crc32c == None
+    assert a.generation == os.stat(remote._path("CONUS_LAMDA_a.tif")).st_mtime_ns
+    assert tl.LocalBackend(remote.root, checksums=True).list("CONUS_LAMDA_a.tif")[0].md5 == tl.get_md5(remote._path("CONUS_LAMDA_a.tif"))
+    assert tl.LocalBackend(remote.root + "_missing").list() == []
+
+
+def test_local_generation_matches_manifest(remote, conn):
+    objs = remote.list("*CONUS_LAMDA_a*")
+    sl.update_manifest(conn, objs, remote.location)
+    listed = sl.get_manifest(conn, remote.location)["CONUS_LAMDA_a.tif"]
+    assert tl.same_content(objs[0], tl.StorageObject("CONUS_LAMDA_a.tif", listed["size"], 0, listed["crc32c"], listed["md5"], listed["generation"]))
+
+
+def test_get_backend(tmp_path):
+    backend = tl.get_backend(str(tmp_path))
+    assert isinstance(backend, tl.LocalBackend)
+    assert backend.location == str(tmp_path)
+
+
+def test_download_files(remote, tmp_path):
+    local = str(tmp_path / "local")
+    completed = []
+    results = tl.download_files(remote, ["*CONUS_LAMDA*"], local, n_workers=2, on_complete=completed.append)
+    assert sorted(r.name for r in results if r.ok) == ["CONUS_LAMDA_a.tif", "CONUS_LAMDA_b.tif", "sub/CONUS_LAMDA_d.tif"]
+    assert sorted(r.name for r in completed) == sorted(r.name for r in results)
+    assert read(os.path.join(local, "CONUS_LAMDA_d.tif")) == b"dd"
+    assert sorted(os.listdir(local)) == ["CONUS_LAMDA_a.tif", "CONUS_LAMDA_b.tif", "CONUS_LAMDA_d.tif"]
+
+    # Existing files are skipped unless they've changed or overwrite is set
+    results = tl.download_files(remote, ["*CONUS_LAMDA*"], local)
+    assert all(r.skipped and not r.ok for r in results)
+    results = tl.download_files(remote, ["*CONUS_LAMDA*"], local, is_unchanged=lambda o, path: o.name != "CONUS_LAMDA_b.tif")
+    assert [r.name for r in results if r.ok] == ["CONUS_LAMDA_b.tif"]
+    results = tl.download_files(remote, ["*CONUS_LAMDA_a*"], local, overwrite=True)
+    assert [r.name for r in results if r.ok] == ["CONUS_LAMDA_a.tif"]
+
+
+def test_download_files_listed_objs(remote, tmp_path):
+    local = str(tmp_path / "local")
+    listed = remote.list("AK_*")
+    results = tl.download_files(remote, [], local, listed_objs=listed)
+    assert [r.name for r in results if r.ok] == ["AK_LAMDA_c.tif"]
+    # listed_objs isn't changed
+    assert listed == remote.list("AK_*")
+
+
+def test_failed_download_leaves_no_file(remote, tmp_path):
+    local = str(tmp_path / "local")
+    backend = FailingBackend(remote.root, ["CONUS_LAMDA_a.tif"])
+    results = {r.name: r for r in tl.download_files(backend, ["CONUS_LAMDA_[ab].tif"], local)}
+    assert not results["CONUS_LAMDA_a.tif"].ok and not results["CONUS_LAMDA_a.tif"].skipped
+    assert results["CONUS_LAMDA_a.tif"].error == "download failed"
+    assert results["CONUS_LAMDA_b.tif"].ok
+    assert os.listdir(local) == ["CONUS_LAMDA_b.tif"]
+
+
+def test_upload_files(remote, tmp_path):
+    paths = [write(str(tmp_path / "local" / name), name.encode()) for name in ["CONUS_LAMDA_a.tif", "CONUS_LAMDA_f.tif"]]
+    results = {r.name: r for r in tl.upload_files(remote, paths)}
+    assert results["CONUS_LAMDA_a.tif"].skipped
+    assert results["CONUS_LAMDA_f.tif"].ok
+    assert read(remote._path("CONUS_LAMDA_a.tif")) == b"aaa"
+    assert read(remote._path("CONUS_LAMDA_f.tif")) == b"CONUS_LAMDA_f.tif"
+
+    results = tl.upload_files(remote, paths[:1], overwrite=True)
+    assert results[0].ok
+    assert read(remote._path("CONUS_LAMDA_a.tif")) == b"CONUS_LAMDA_a.tif"
+
+    results = tl.upload_files(remote, paths, prefix="outputs/")
+    assert all(r.ok for r in results)
+    assert remote.exists("outputs/CONUS_LAMDA_f.tif")
+    assert not any(name.endswith(".part") for name in os.listdir(remote._path("outputs")))
+
+
+def test_summarize_transfers(remote, tmp_path):
+    local = str(tmp_path / "local")
+    tl.download_files(remote, ["CONUS_LAMDA_a.tif"], local)
+    backend = FailingBackend(remote.root, ["CONUS_LAMDA_b.tif"])
+    results = tl.download_files(backend, ["CONUS_LAMDA_[abc].tif", "AK_*"], local)
+    summary = tl.summarize_transfers(results, print_summary=False)
+    assert (summary["n_transferred"], summary["bytes_transferred"]) == (1, 1)
+    assert (summary["n_skipped"], summary["bytes_skipped"]) == (1, 3)
+    assert summary["n_failed"] == 1
+
+
+raw_name = "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jd153-168.tif"
+other_name = "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jd185-200.tif"
+derived_names = [
+    "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jd153-168_5_8bit.tif",
+    "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jd153-168_5_8bit.jpg",
+    "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jds137-153-169_persistence.tif",
+    "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jds153-169-185_persistence.jpg",
+]
+kept_names = ["CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jd185-200_5_8bit.tif", "CONUS_LAMDA_Z_NBR_bl2020-2022_ay2024_jds169-185-201_persistence.tif"]
+
+
+# Export bucket with two raw tifs and a local folder with outputs made from them
+@pytest.fixture
+def synced(tmp_path, conn, local_dir):
+    exports = tl.LocalBackend(str(tmp_path / "exports"))
+    write(exports._path(raw_name), b"raw")
+    write(exports._path(other_name), b"other")
+    local = local_dir
+    tl.sync_tracked(conn, exports, ["CONUS_LAMDA*"], local)
+    for name in derived_names + kept_names:
+        sl.mark_stage_done(conn, write(os.path.join(local, name)), "uploaded")
+    mask = write(lp.get_persistence_mask_name(os.path.join(local, raw_name), 1000, -2.5))
+    sl.mark_stage_done(conn, os.path.join(local, raw_name), "cog-fixed", sl.get_fingerprint(os.path.join(local, raw_name)))
+    sl.mark_stage_done(conn, os.path.join(local, raw_name), "uploaded")
+    return conn, exports, local, mask
+
+
+def test_sync_tracked_skips_unchanged(synced):
+    conn, exports, local, mask = synced
+    assert sl.is_stage_done(conn, raw_name, "synced", sl.get_fingerprint(os.path.join(local, raw_name)))
+    assert set(sl.get_manifest(conn, exports.location).keys()) == {raw_name, other_name}
+
+    results = tl.sync_tracked(conn, exports, ["CONUS_LAMDA*"], local)
+    assert all(r.skipped for r in results)
+    assert all(os.path.exists(os.path.join(local, name)) for name in derived_names) and os.path.exists(mask)
+
+
+def test_sync_tracked_redownloads_changed_object(synced):
+    conn, exports, local, mask = synced
+    write(exports._path(raw_name), b"new raw")
+
+    results = {r.name: r for r in tl.sync_tracked(conn, exports, ["CONUS_LAMDA*"], local)}
+    assert results[raw_name].ok and results[other_name].skipped
+    assert read(os.path.join(local, raw_name)) == b"new raw"
+    assert sl.get_manifest(conn, exports.location)[raw_name]["size"] == 7
+
+    # Outputs made from it are removed, outputs of other periods are kept
+    assert not any(os.path.exists(os.path.join(local, name)) for name in derived_names) and not os.path.exists(mask)
+    assert all(os.path.exists(os.path.join(local, name)) for name in kept_names)
+    assert not sl.is_stage_done(conn, raw_name, "cog-fixed")
+    assert sl.is_stage_done(conn, raw_name, "uploaded") and sl.is_stage_done(conn, raw_name, "synced")
+    # Their uploaded stage is kept so the remade outputs are uploaded over the old ones
+    assert sl.is_stage_done(conn, derived_names[0], "uploaded")
+
+
+def test_sync_tracked_checks_files_without_manifest_entry(tmp_path, conn, local_dir):
+    exports = tl.LocalBackend(str(tmp_path / "exports"), checksums=True)
+    write(exports._path(raw_name), b"raw")
+    write(exports._path(other_name), b"other")
+    local = local_dir
+
+    # Synced before the manifest existed: one matches, one is stale (same size but a different md5)
+    write(os.path.join(local, raw_name), b"raw")
+    write(os.path.join(local, other_name), b"stale")
+    write(os.path.join(local, kept_names[0]))
+
+    results = {r.name: r for r in tl.sync_tracked(conn, exports, ["CONUS_LAMDA*"], local)}
+    assert results[raw_name].skipped and results[other_name].ok
+    assert read(os.path.join(local, other_name)) == b"other"
+    assert not os.path.exists(os.path.join(local, kept_names[0]))
+    assert set(sl.get_manifest(conn, exports.location).keys()) == {raw_name, other_name}
+
+    # A different size is stale without an md5 to compare
+    write(os.path.join(local, raw_name), b"short")
+    conn.execute("DELETE FROM remote_manifest")
+    results = {r.name: r for r in tl.sync_tracked(conn, tl.LocalBackend(exports.root), ["CONUS_LAMDA*"], local)}
+    assert results[raw_name].ok and results[other_name].skipped
+
+
+def test_upload_tracked(remote, conn, local_dir):
+    paths = [write(os.path.join(local_dir, name), name.encode()) for name in ["CONUS_LAMDA_a.tif", "CONUS_LAMDA_f.tif"]]
+    results = {r.name: r for r in tl.upload_tracked(conn, remote, paths)}
+    assert results["CONUS_LAMDA_a.tif"].skipped and results["CONUS_LAMDA_f.tif"].ok
+    assert all(sl.is_stage_done(conn, path, "uploaded", sl.get_fingerprint(path)) for path in paths)
+
+    # Unchanged files are skipped without listing and remade files are uploaded over the old copy
+    write(paths[1], b"remade")
+    results = {r.name: r for r in tl.upload_tracked(conn, remote, paths)}
+    assert results["CONUS_LAMDA_a.tif"].skipped and results["CONUS_LAMDA_f.tif"].ok
+    assert read(remote._path("CONUS_LAMDA_f.tif")) == b"remade"